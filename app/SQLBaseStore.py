@@ -60,7 +60,8 @@ def _get_storage_stores() -> Any:
             cls, session: Session, name: str
         ) -> Optional["CollectionStore"]:
             # type: ignore
-            return session.query(cls).filter(cls.name == name).first()
+            # Processes creating the collection at the same time all use the same one
+            return session.query(cls).filter(cls.name == name).order_by(cls.uuid).first()
 
         @classmethod
         def get_or_create(
@@ -101,7 +102,7 @@ def _get_storage_stores() -> Any:
         content = sqlalchemy.Column(sqlalchemy.String, nullable=True)
 
         # custom_id : any user defined id
-        custom_id = sqlalchemy.Column(sqlalchemy.String, nullable=True)
+        custom_id = sqlalchemy.Column(sqlalchemy.String, nullable=True, index=True)
 
     _classes = (ItemStore, CollectionStore)
 
@@ -178,7 +179,8 @@ class SQLBaseStore(BaseStore[str, V], Generic[V]):
         self.collection_metadata = collection_metadata
         self.pre_delete_collection = pre_delete_collection
         self.engine_args = engine_args or {}
-        # Create a connection if not provided, otherwise use the provided connection
+        # Sessions bound to the engine check out a pooled connection each, so the store can be
+        # shared by threads. A provided connection is used as is.
         self._conn = connection if connection else self.__connect()
         self.__post_init__()
 
@@ -192,14 +194,11 @@ class SQLBaseStore(BaseStore[str, V], Generic[V]):
         self.__create_tables_if_not_exists()
         self.__create_collection()
 
-    def __connect(self) -> sqlalchemy.engine.Connection:
-        engine = sqlalchemy.create_engine(self.connection_string, **self.engine_args)
-        conn = engine.connect()
-        return conn
+    def __connect(self) -> sqlalchemy.engine.Engine:
+        return sqlalchemy.create_engine(self.connection_string, **self.engine_args)
 
     def __create_tables_if_not_exists(self) -> None:
-        with self._conn.begin():
-            Base.metadata.create_all(self._conn)
+        Base.metadata.create_all(self._conn)
 
     def __create_collection(self) -> None:
         if self.pre_delete_collection:
@@ -221,8 +220,8 @@ class SQLBaseStore(BaseStore[str, V], Generic[V]):
         return self.CollectionStore.get_by_name(session, self.collection_name)
 
     def __del__(self) -> None:
-        if self._conn:
-            self._conn.close()
+        if isinstance(self._conn, sqlalchemy.engine.Engine):
+            self._conn.dispose()
 
     def __serialize_value(self, obj: V) -> str:
         if isinstance(obj, Serializable):
@@ -230,6 +229,9 @@ class SQLBaseStore(BaseStore[str, V], Generic[V]):
         return obj
 
     def __deserialize_value(self, obj: V) -> str:
+        # Only `Serializable` objects were dumped, plain strings are stored as is
+        if not (isinstance(obj, str) and obj.startswith('{"lc":')):
+            return obj
         try:
             return loads(obj)
         except Exception:
@@ -269,7 +271,7 @@ class SQLBaseStore(BaseStore[str, V], Generic[V]):
         return [ordered_values[key] for key in keys]
 
     def mset(self, key_value_pairs: Sequence[Tuple[str, V]]) -> None:
-        """Set the values for the given keys.
+        """Set the values for the given keys, replacing their previous values.
 
         Args:
             key_value_pairs (Sequence[Tuple[str, V]]): A sequence of key-value pairs.
@@ -281,6 +283,14 @@ class SQLBaseStore(BaseStore[str, V], Generic[V]):
             collection = self.__get_collection(session)
             if not collection:
                 raise ValueError("Collection not found")
+            session.execute(
+                sqlalchemy.delete(self.ItemStore).where(
+                    sqlalchemy.and_(
+                        self.ItemStore.custom_id.in_([key for key, _ in key_value_pairs]),
+                        self.ItemStore.collection_id == (collection.uuid),
+                    )
+                )
+            )
             for id, item in key_value_pairs:
                 content = self.__serialize_value(item)
                 item_store = self.ItemStore(
@@ -0,0 +1,352 @@
+"""Admission control of the chat requests: per-session rate limits, bounded queues with a deadline & load shedding."""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional
+
+from metrics import record_admission_rejection, record_queue_wait, set_admission_load
+
+# Requests answered at the same time, each by its own worker thread
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+# Requests waiting for a slot, beyond which new requests are rejected right away
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+# Seconds a request may spend waiting in the request & stage queues before being rejected
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+# Concurrency limits of the stages of a query, as comma-separated `stage=limit` pairs
+ADMISSION_STAGE_LIMITS = os.getenv("ADMISSION_STAGE_LIMITS", "generate=16")
+# Sustained requests per second & burst allowed per session id, a rate of 0 disables the limit
+SESSION_RATE_LIMIT = float(os.getenv("SESSION_RATE_LIMIT", "1.0"))
+SESSION_BURST = int(os.getenv("SESSION_BURST", "20"))
+# Under pressure, answer from the cache of stateless answers or skip the chat history
+DEGRADED_MODE = os.getenv("DEGRADED_MODE", "false").lower() == "true"
+# Request queue depth from which requests are degraded
+DEGRADE_QUEUE_DEPTH = int(os.getenv("DEGRADE_QUEUE_DEPTH", str(ADMISSION_MAX_QUEUE // 4)))
+# Stateless answers kept for the degraded mode
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))
+
+# Time by which the current request must have been admitted to all its stages
+_deadline: ContextVar[Optional[float]] = ContextVar("admission_deadline", default=None)
+
+
+class Rejected(Exception):
+    """A request refused by admission control.
+
+    Args:
+        status_code (int): HTTP status of the response, 429 or 503
+        reason (str): `rate_limited`, `queue_full` or `queue_timeout`
+        retry_after (Optional[float]): Seconds after which the request may succeed
+    """
+
+    def __init__(self, status_code: int, reason: str, retry_after: Optional[float] = None):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _remaining(timeout: float) -> float:
+    """`timeout`, shortened to the time left before the deadline of the current request."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return timeout
+    return max(0.0, min(timeout, deadline - time.monotonic()))
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst` events."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Takes a token.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds until the next one
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SessionRateLimiter:
+    """Token bucket per session id.
+
+    Only the `max_sessions` most recently seen sessions are tracked; a forgotten session
+    starts again with a full bucket, which it would have refilled while idle anyway.
+    """
+
+    def __init__(self, rate: float = SESSION_RATE_LIMIT, burst: int = SESSION_BURST, max_sessions: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_sessions = max_sessions
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, session_id: str) -> None:
+        """Counts a request of the session.
+
+        Raises:
+            Rejected: 429 when the session exceeded its rate limit
+        """
+        if self.rate <= 0:
+            return
+        with self._lock:
+            bucket = self._buckets.pop(session_id, None) or TokenBucket(self.rate, self.burst)
+            self._buckets[session_id] = bucket
+            if len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+            retry_after = bucket.take(time.monotonic())
+        if retry_after:
+            record_admission_rejection("session", "rate_limited")
+            raise Rejected(429, "rate_limited", retry_after)
+
+
+class StageLimiter:
+    """Bounds the number of threads running a stage, with a bounded queue & a deadline.
+
+    Threads beyond `max_concurrency` wait for a slot, unless `max_queue` threads are already
+    waiting, and for at most `queue_timeout` seconds or until the deadline of their request.
+    Waiting threads get the freed slots first come, first served: a thread arriving while
+    others wait queues behind them even if a slot is free.
+    """
+
+    def __init__(
+            self,
+            stage: str,
+            max_concurrency: int,
+            max_queue: int = ADMISSION_MAX_QUEUE,
+            queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+            ):
+        self.stage = stage
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._condition = threading.Condition()
+        # Tickets of the waiting threads, in arrival order
+        self._waiters: "deque[object]" = deque()
+
+    def _reject(self, reason: str) -> Rejected:
+        record_admission_rejection(self.stage, reason)
+        return Rejected(503, reason, retry_after=self.queue_timeout)
+
+    def acquire(self) -> None:
+        """Takes a slot of the stage.
+
+        Raises:
+            Rejected: 503 when the queue is full or no slot was freed before the deadline
+        """
+        start = time.monotonic()
+        with self._condition:
+            if self.in_flight >= self.max_concurrency or self._waiters:
+                if self.queued >= self.max_queue:
+                    raise self._reject("queue_full")
+                ticket = object()
+                self._waiters.append(ticket)
+                self.queued += 1
+                set_admission_load(self.stage, self.in_flight, self.queued)
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._waiters[0] is ticket and self.in_flight < self.max_concurrency,
+                        _remaining(self.queue_timeout),
+                    )
+                finally:
+                    self._waiters.remove(ticket)
+                    self.queued -= 1
+                    # The next waiter may be first in line now, & take a slot still free
+                    self._condition.notify_all()
+                if not admitted:
+                    set_admission_load(self.stage, self.in_flight, self.queued)
+                    raise self._reject("queue_timeout")
+            self.in_flight += 1
+            set_admission_load(self.stage, self.in_flight, self.queued)
+        record_queue_wait(self.stage, time.monotonic() - start)
+
+    def release(self) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            set_admission_load(self.stage, self.in_flight, self.queued)
+            # Only the first waiter may take the slot, & it can't be told apart from the others
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Holds a slot of the stage during the enclosed block."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def build_stage_limiters(spec: str = ADMISSION_STAGE_LIMITS) -> Dict[str, StageLimiter]:
+    """Stage limiters from comma-separated `stage=limit` pairs, e.g. `retrieve=32,generate=16`."""
+    limiters = {}
+    for pair in spec.split(","):
+        if pair.strip():
+            stage, _, limit = pair.partition("=")
+            limiters[stage.strip()] = StageLimiter(stage.strip(), int(limit))
+    return limiters
+
+
+class RequestAdmission:
+    """Runs the requests on a fixed pool of worker threads behind a bounded queue with a deadline.
+
+    At most `max_in_flight` requests run & `max_queue` wait for a worker; any other request is
+    rejected right away instead of piling up in an unbounded executor backlog. A request that
+    waits longer than `queue_timeout` is rejected as well. Its deadline also bounds the waits in
+    the stage queues of the worker thread.
+    """
+
+    stage = "request"
+
+    def __init__(
+            self,
+            max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+            max_queue: int = ADMISSION_MAX_QUEUE,
+            queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+            ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="admitted-request")
+
+    def _reject(self, reason: str) -> Rejected:
+        record_admission_rejection(self.stage, reason)
+        return Rejected(503, reason, retry_after=self.queue_timeout)
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        set_admission_load(self.stage, self.in_flight, self.queued)
+        self._semaphore.release()
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        """Runs `func(*args)` on a worker thread once admitted.
+
+        Raises:
+            Rejected: 503 when the queue is full or no worker was freed before the deadline
+        """
+        deadline = await self.admit()
+        return await asyncio.shield(self.submit(deadline, func, *args))
+
+    async def admit(self) -> float:
+        """Waits for a worker, which must then be given its work with `submit`.
+
+        Returns:
+            float: Deadline of the request, to pass to `submit`
+
+        Raises:
+            Rejected: 503 when the queue is full or no worker was freed before the deadline
+        """
+        start = time.monotonic()
+        deadline = start + self.queue_timeout
+        if self._semaphore.locked():
+            if self.queued >= self.max_queue:
+                raise self._reject("queue_full")
+            self.queued += 1
+            set_admission_load(self.stage, self.in_flight, self.queued)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._reject("queue_timeout")
+            finally:
+                self.queued -= 1
+        else:
+            await self._semaphore.acquire()
+        self.in_flight += 1
+        set_admission_load(self.stage, self.in_flight, self.queued)
+        record_queue_wait(self.stage, time.monotonic() - start)
+        return deadline
+
+    def submit(self, deadline: Optional[float], func: Callable, *args: Any) -> "asyncio.Future":
+        """Runs `func(*args)` on the worker of a request admitted by `admit`.
+
+        Args:
+            deadline (Optional[float]): Deadline of the request, bounding its waits in the stage
+                queues, `None` to only bound them by the queue timeout of each stage
+            func (Callable): Work of the request
+
+        Returns:
+            asyncio.Future: The result of `func`
+        """
+        context = copy_context()
+        context.run(_deadline.set, deadline)
+        future = asyncio.wrap_future(self._executor.submit(context.run, func, *args))
+        # The worker is only released once the thread is done, even if the client went away
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+
+class AnswerCache:
+    """LRU cache of answers with a time to live, to answer repeated questions in degraded mode."""
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._answers: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self._lock:
+            entry = self._answers.get(key)
+            if entry is None:
+                return None
+            answer, expires = entry
+            if expires < time.monotonic():
+                del self._answers[key]
+                return None
+            self._answers.move_to_end(key)
+            return answer
+
+    def put(self, key: Hashable, answer: str) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._answers[key] = (answer, time.monotonic() + self.ttl)
+            self._answers.move_to_end(key)
+            while len(self._answers) > self.max_size:
+                self._answers.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+
+if __name__ == "__main__":
+    # 4 slots, 4 waiting threads at most, 0.3s deadline: 20 threads of 0.2s each
+    limiter = StageLimiter("generate", max_concurrency=4, max_queue=4, queue_timeout=0.3)
+
+    def generate(_):
+        try:
+            with limiter.slot():
+                time.sleep(0.2)
+            return "ok"
+        except Rejected as error:
+            return error.reason
+
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        print(sorted(pool.map(generate, range(20))))
+
+    rate_limiter = SessionRateLimiter(rate=1.0, burst=3)
+    for i in range(5):
+        try:
+            rate_limiter.check("12345")
+            print(i, "admitted")
+        except Rejected as error:
+            print(i, error.status_code, error.reason, f"retry after {error.retry_after:.2f}s")
@@ -1,24 +1,38 @@
+import os
 from operator import itemgetter
+from typing import Dict, List
 
 from langchain import hub
-from langchain_community.chat_message_histories import SQLChatMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough, RunnableParallel
+from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnablePassthrough, RunnableParallel
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_openai import ChatOpenAI
-from retriever import build_retriever
+from retriever import build_retriever, with_policy_filter
+from corpus import load_corpus
+from chat_history import get_session_history
+from context_compression import compress_context
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # ============================= Build Retriever ===============================
-collection_name="healthcare_demo"
+collection_name = os.getenv("QDRANT_COLLECTION_NAME", "healthcare_demo")
+
+# Policies served by the assistant, requests can only filter on them
+corpus = load_corpus()
 
 retriever = build_retriever(
     vectorstore_collection_name=collection_name,
+    corpus=corpus,
 )
 
+
+def retrieve_context(inputs: Dict, config: RunnableConfig) -> List:
+    """Retrieves the context of the `question`, only from the policies matching the optional `policy_filter`."""
+    policy_retriever = with_policy_filter(retriever, inputs.get("policy_filter"))
+    return policy_retriever.invoke(inputs["question"], config=config)
+
 # ============================= Semi-structured Chain ===============================
 def format_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
@@ -42,21 +56,26 @@ model = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
 # `rag_chain_with_history` manages the invokation, 
 # so we removed `{"context": retriever, "question": RunnablePassthrough()}  ` in `rag_chain `
 # The output of MultiVectorRetriever is text, so no need to pass its output to `format_docs()`
-rag_chain = (
-    RunnablePassthrough.assign(
-        context=itemgetter("question") | retriever
-        )
+# `rag_answer_chain` answers from an already retrieved `context`, e.g. when retrieval runs speculatively
+# The parent chunks are pruned to their most relevant sentences before filling the prompt
+rag_answer_chain = (
+    RunnablePassthrough.assign(context=RunnableLambda(compress_context))
     | prompt 
     | model 
     | StrOutputParser()
 )
 
+rag_chain = (
+    RunnablePassthrough.assign(
+        context=RunnableLambda(retrieve_context)
+        )
+    | rag_answer_chain
+)
+
 # Semi Structured Pipeline with Chat History
 rag_chain_with_history = RunnableWithMessageHistory(
     rag_chain,
-    lambda session_id: SQLChatMessageHistory(
-        session_id=session_id, connection_string="sqlite:///rag_chat_history.db"
-    ),
+    get_session_history,
     input_messages_key="question",
     history_messages_key="chat_history",
 )
@@ -64,7 +83,11 @@ rag_chain_with_history = RunnableWithMessageHistory(
 # We get the question & context, then assign the output of `rag_chain_with_history` to `answer` key
 # `rag_chain_with_history` will run `rag_chain`, which will get `{"context": ..., "question": ...}` from previous step
 rag_chain_with_history_and_sources = RunnableParallel(
-    {"context": itemgetter("question") | retriever, "question": itemgetter("question")}
+    {
+        "context": RunnableLambda(retrieve_context),
+        "question": itemgetter("question"),
+        "policy_filter": lambda x: x.get("policy_filter"),
+    }
 ).assign(answer=rag_chain_with_history)
 
 
@@ -101,9 +124,7 @@ chitchat_chain = (
 # ChitChat Pipeline with Chat History
 chitchat_chain_with_history = RunnableWithMessageHistory(
     chitchat_chain,
-    lambda session_id: SQLChatMessageHistory(
-        session_id=session_id, connection_string="sqlite:///rag_chat_history.db"
-    ),
+    get_session_history,
     input_messages_key="question",
     history_messages_key="chat_history",
 )
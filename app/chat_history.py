@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import List
+
+from langchain_community.chat_message_histories import SQLChatMessageHistory
+from langchain_core.messages import BaseMessage
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from metrics import stage
+
+CHAT_HISTORY_CONNECTION_STRING = "sqlite:///rag_chat_history.db"
+
+# Last activity & number of messages of every session, used by the retention of `retention.py`
+SESSION_ACTIVITY_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS session_activity ("
+    "session_id TEXT PRIMARY KEY, last_active REAL NOT NULL, message_count INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_session_activity_last_active ON session_activity (last_active)",
+    # History loads filter on the session & sort by id, without this index they scan the whole table
+    "CREATE INDEX IF NOT EXISTS ix_message_store_session_id ON message_store (session_id, id)",
+]
+_TOUCH_SESSION = text(
+    "INSERT INTO session_activity (session_id, last_active, message_count) VALUES (:session_id, :now, 1) "
+    "ON CONFLICT (session_id) DO UPDATE SET last_active = excluded.last_active, "
+    "message_count = session_activity.message_count + 1"
+)
+
+_prepared_databases = set()
+_prepare_lock = threading.Lock()
+
+
+def prepare_database(engine: Engine) -> None:
+    """Creates the session activity table & the indexes of the chat history database, once per process.
+
+    The database is switched to WAL mode so that history reads & the retention job don't block
+    the writers. Sessions written before the activity table existed are counted as active now.
+
+    Args:
+        engine (Engine): Engine of the chat history database, whose `message_store` table exists
+    """
+    url = str(engine.url)
+    with _prepare_lock:
+        if url in _prepared_databases:
+            return
+        with engine.begin() as connection:
+            if engine.dialect.name == "sqlite":
+                connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+            backfill = not engine.dialect.has_table(connection, "session_activity")
+            for statement in SESSION_ACTIVITY_SCHEMA:
+                connection.exec_driver_sql(statement)
+            if backfill:
+                connection.execute(
+                    text(
+                        "INSERT INTO session_activity (session_id, last_active, message_count) "
+                        "SELECT session_id, :now, COUNT(*) FROM message_store GROUP BY session_id"
+                    ),
+                    {"now": time.time()},
+                )
+        _prepared_databases.add(url)
+
+
+class InstrumentedSQLChatMessageHistory(SQLChatMessageHistory):
+    """`SQLChatMessageHistory` reporting its reads & writes as `history_load` & `history_write` stages.
+
+    Each message is written separately, so a chat turn records two `history_write` spans.
+    Writes also update the activity of the session, in the same transaction.
+    """
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore
+        with stage("history_load"):
+            return super().messages
+
+    def add_message(self, message: BaseMessage) -> None:
+        with stage("history_write"):
+            with self.Session() as session:
+                session.add(self.converter.to_sql_model(message, self.session_id))
+                session.execute(_TOUCH_SESSION, {"session_id": self.session_id, "now": time.time()})
+                session.commit()
+
+    def has_messages(self) -> bool:
+        """Whether the session has any message, without loading them."""
+        with self.Session() as session:
+            session_id = getattr(self.sql_model_class, self.session_id_field_name)
+            return session.query(self.sql_model_class.id).where(session_id == self.session_id).first() is not None
+
+    def clear(self) -> None:
+        super().clear()
+        with self.Session() as session:
+            session.execute(text("DELETE FROM session_activity WHERE session_id = :session_id"), {"session_id": self.session_id})
+            session.commit()
+
+
+def get_session_history(session_id: str) -> InstrumentedSQLChatMessageHistory:
+    """Chat history of a session, persisted in `rag_chat_history.db`.
+
+    Args:
+        session_id (str): Session ID of the chat session
+
+    Returns:
+        InstrumentedSQLChatMessageHistory: The chat history of the session
+    """
+    history = InstrumentedSQLChatMessageHistory(
+        session_id=session_id, connection_string=CHAT_HISTORY_CONNECTION_STRING
+    )
+    prepare_database(history.engine)
+    return history
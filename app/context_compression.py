@@ -0,0 +1,185 @@
+"""Packs the most relevant sentences of the retrieved parent chunks under a token budget."""
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from langchain.schema.document import Document
+
+from metrics import record_context_tokens, stage
+
+# Approximate number of context tokens kept in the RAG prompt, 0 disables the compression
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+(?=[A-Z0-9(\"“])")
+_TABLE_ROW = re.compile(r"<tr>.*?</tr>", re.S)
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i if in is it its me my of on or "
+    "our should that the their them there these this to us was we what when where which who will "
+    "with you your".split()
+)
+
+# BM25 parameters
+_K1 = 1.2
+_B = 0.75
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count (~4 characters per token for English text), computed locally."""
+    return max(1, len(text) // 4)
+
+
+def _text(doc: Any) -> str:
+    return doc.page_content if isinstance(doc, Document) else str(doc)
+
+
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased, lightly stemmed words of the text without stopwords."""
+    return [_stem(w) for w in _WORD.findall(text.lower()) if w not in _STOPWORDS]
+
+
+def split_units(text: str) -> List[str]:
+    """Splits a parent chunk into sentences, keeping table rows whole.
+
+    Table rows are HTML `<tr>` rows or lines with `|` separated cells.
+
+    Args:
+        text (str): Parent chunk
+
+    Returns:
+        List[str]: The sentences & table rows of the chunk, in order
+    """
+    if "<tr>" in text:
+        return [row.strip() for row in _TABLE_ROW.findall(text)]
+
+    units = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if "|" in line:
+            units.append(line)
+        else:
+            units.extend(s.strip() for s in _SENTENCE_END.split(line) if s.strip())
+    return units
+
+
+def score_units(question: str, units: List[str]) -> List[float]:
+    """Lexical relevance (BM25) of each unit to the question.
+
+    Args:
+        question (str): Input user question
+        units (List[str]): Sentences or table rows
+
+    Returns:
+        List[float]: Score of each unit, 0 when it shares no term with the question
+    """
+    query_terms = set(tokenize(question))
+    documents = [Counter(tokenize(unit)) for unit in units]
+    if not query_terms or not documents:
+        return [0.0] * len(units)
+
+    n_documents = len(documents)
+    average_length = sum(sum(d.values()) for d in documents) / n_documents or 1.0
+    idf = {}
+    for term in query_terms:
+        frequency = sum(1 for d in documents if term in d)
+        idf[term] = math.log(1 + (n_documents - frequency + 0.5) / (frequency + 0.5))
+
+    scores = []
+    for document in documents:
+        length = sum(document.values())
+        score = 0.0
+        for term in query_terms:
+            tf = document.get(term, 0)
+            if tf:
+                score += idf[term] * tf * (_K1 + 1) / (tf + _K1 * (1 - _B + _B * length / average_length))
+        scores.append(score)
+    return scores
+
+
+def pack_context(question: str, docs: List[Any], token_budget: Optional[int] = None) -> List[Any]:
+    """Keeps the sentences & table rows of `docs` most relevant to the question under a token budget.
+
+    Units sharing terms with the question are selected first, by relevance, then the other
+    units in document order while they fit. Selected units are kept in their original order,
+    and parents without any selected unit are dropped. Docs already fitting in the budget are
+    returned unchanged.
+
+    Args:
+        question (str): Input user question
+        docs (List[Any]): Retrieved parent chunks, as strings or `Document`s
+        token_budget (Optional[int]): Approximate token budget, defaults to `CONTEXT_TOKEN_BUDGET`
+
+    Returns:
+        List[Any]: The packed parent chunks, of the same type as `docs`
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    texts = [_text(doc) for doc in docs]
+    if token_budget <= 0 or sum(estimate_tokens(text) for text in texts) <= token_budget:
+        return docs
+
+    units = [(doc_index, unit) for doc_index, text in enumerate(texts) for unit in split_units(text)]
+    scores = score_units(question, [unit for _, unit in units])
+
+    # The matching units first, best first, then the room left is filled with the other units
+    # in document order: a sentence sharing no word with the question may still answer it
+    matches = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+    candidates = matches + [i for i, score in enumerate(scores) if score <= 0]
+
+    selected = set()
+    used = 0
+    for i in candidates:
+        cost = estimate_tokens(units[i][1])
+        if used + cost <= token_budget:
+            selected.add(i)
+            used += cost
+
+    packed = []
+    for doc_index, doc in enumerate(docs):
+        kept = [unit for i, (index, unit) in enumerate(units) if index == doc_index and i in selected]
+        if not kept:
+            continue
+        text = "\n".join(kept)
+        packed.append(Document(page_content=text, metadata=doc.metadata) if isinstance(doc, Document) else text)
+    return packed
+
+
+def compress_context(inputs: Dict) -> List[Any]:
+    """`context` of the RAG prompt inputs packed under `CONTEXT_TOKEN_BUDGET`.
+
+    Args:
+        inputs (Dict): Prompt inputs with the `question` & the retrieved `context`
+
+    Returns:
+        List[Any]: The packed context
+    """
+    with stage("compress"):
+        context = pack_context(inputs["question"], inputs["context"])
+    record_context_tokens(
+        raw=sum(estimate_tokens(_text(doc)) for doc in inputs["context"]),
+        packed=sum(estimate_tokens(_text(doc)) for doc in context),
+    )
+    return context
+
+
+if __name__ == "__main__":
+    import json
+
+    with open("./data/processed/pdf_texts.json", "r") as file:
+        texts = json.load(file)
+
+    question = "What is covered in case of emergency medical evacuation?"
+    packed = pack_context(question, texts[:4], token_budget=300)
+    print(sum(estimate_tokens(t) for t in texts[:4]), "->", sum(estimate_tokens(t) for t in packed), "tokens")
+    print("\n\n".join(packed))
@@ -0,0 +1,120 @@
+"""Corpus of the policy documents served by the assistant, each with its `policy_id` & product."""
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+logging.basicConfig(level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Manifest listing the policies of the corpus & where their processed elements are
+CORPUS_PATH = os.getenv("CORPUS_PATH", "./data/corpus.json")
+PROCESSED_DIR = "./data/processed"
+
+# The single PDF the assistant was built for, used when there's no corpus manifest
+DEFAULT_POLICY_ID = "travel_health_insurance"
+DEFAULT_PRODUCT = "travel_health"
+
+# Metadata of the indexed documents that requests can filter on
+POLICY_FIELDS = ("policy_id", "product")
+
+
+def policy_dir(policy_id: str) -> str:
+    """Directory of the processed elements of a policy."""
+    return os.path.join(PROCESSED_DIR, policy_id)
+
+
+def load_corpus(path: Optional[str] = None) -> List[Dict]:
+    """Policies of the corpus.
+
+    Args:
+        path (Optional[str]): Corpus manifest, defaults to `CORPUS_PATH`
+
+    Returns:
+        List[Dict]: `policy_id`, `product` & `processed_dir` of every policy. Without a manifest,
+            the single policy whose elements were processed directly into `PROCESSED_DIR`.
+    """
+    path = path or CORPUS_PATH
+    if not os.path.exists(path):
+        return [{"policy_id": DEFAULT_POLICY_ID, "product": DEFAULT_PRODUCT, "processed_dir": PROCESSED_DIR}]
+
+    with open(path, "r") as file:
+        return json.load(file)["policies"]
+
+
+def register_policy(
+        policy_id: str,
+        product: str,
+        processed_dir: Optional[str] = None,
+        path: Optional[str] = None,
+) -> Dict:
+    """Adds a policy to the corpus manifest, replacing any previous entry with the same `policy_id`.
+
+    Args:
+        policy_id (str): Unique ID of the policy
+        product (str): Product the policy belongs to
+        processed_dir (Optional[str]): Directory of its processed elements, defaults to `policy_dir(policy_id)`
+        path (Optional[str]): Corpus manifest, defaults to `CORPUS_PATH`
+
+    Returns:
+        Dict: The registered policy
+    """
+    path = path or CORPUS_PATH
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            policies = json.load(file)["policies"]
+    else:
+        # Keep the PDF processed before the corpus had a manifest
+        legacy = os.path.exists(os.path.join(PROCESSED_DIR, "pdf_texts.json"))
+        policies = load_corpus(path) if legacy else []
+
+    policy = {"policy_id": policy_id, "product": product, "processed_dir": processed_dir or policy_dir(policy_id)}
+    policies = [p for p in policies if p["policy_id"] != policy_id] + [policy]
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, "w") as file:
+        json.dump({"policies": policies}, file, indent=2)
+
+    logger.info(f"Registered policy {policy_id} ({product}), {len(policies)} policies in the corpus")
+    return policy
+
+
+def load_policy_elements(policy: Dict) -> Dict[str, List]:
+    """Processed elements of a policy, as saved by `pdf_utils.process_pdf`.
+
+    Args:
+        policy (Dict): Policy of the corpus
+
+    Returns:
+        Dict[str, List]: `texts`, `text_summaries`, `tables`, `table_summaries` & `tables_html`,
+            the latter being empty for elements processed before the table HTML was saved
+    """
+    elements = {}
+    for key in ("texts", "text_summaries", "tables", "table_summaries", "tables_html"):
+        filename = os.path.join(policy["processed_dir"], f"pdf_{key}.json")
+        if key == "tables_html" and not os.path.exists(filename):
+            elements[key] = []
+            continue
+        with open(filename, "r") as file:
+            elements[key] = json.load(file)
+    return elements
+
+
+def policy_filter(policy_id: Optional[str] = None, product: Optional[str] = None) -> Optional[Dict[str, str]]:
+    """Metadata filter restricting retrieval to a policy and/or a product.
+
+    Returns:
+        Optional[Dict[str, str]]: The filter, `None` to search the whole corpus
+    """
+    fields = {"policy_id": policy_id, "product": product}
+    return {key: value for key, value in fields.items() if value} or None
+
+
+def matching_policies(policy_filter: Optional[Dict[str, str]], corpus: List[Dict]) -> List[Dict]:
+    """Policies of `corpus` matching every field of `policy_filter`, all of them without a filter."""
+    return [
+        policy for policy in corpus
+        if all(policy.get(key) == value for key, value in (policy_filter or {}).items())
+    ]
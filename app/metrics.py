@@ -0,0 +1,315 @@
+"""Per-stage latency instrumentation exposed in the Prometheus format."""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Fraction of requests whose stages are timed, to keep the overhead small at high QPS
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1.0"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+REQUESTS = Counter(
+    "hia_requests_total",
+    "Number of queries handled by the QueryService.",
+    ["route"],
+)
+STAGE_LATENCY = Histogram(
+    "hia_stage_latency_seconds",
+    "Latency of each stage of a query (sampled requests only).",
+    ["stage", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "hia_llm_tokens_total",
+    "Number of LLM tokens consumed (sampled requests only).",
+    ["route", "type"],
+)
+PROMPT_TOKENS = Histogram(
+    "hia_prompt_tokens",
+    "Number of prompt tokens per LLM call (sampled requests only).",
+    ["route"],
+    buckets=TOKEN_BUCKETS,
+)
+CONTEXT_TOKENS = Histogram(
+    "hia_context_tokens",
+    "Approximate number of RAG context tokens before (raw) & after (packed) compression.",
+    ["stage"],
+    buckets=TOKEN_BUCKETS,
+)
+CACHE_EVENTS = Counter(
+    "hia_cache_requests_total",
+    "Number of cache lookups by result.",
+    ["cache", "result"],
+)
+SPECULATIVE_RETRIEVALS = Counter(
+    "hia_speculative_retrievals_total",
+    "Number of retrievals started before routing, by whether the result was used or discarded.",
+    ["result"],
+)
+COALESCED_REQUESTS = Counter(
+    "hia_coalesced_requests_total",
+    "Number of coalescable queries, by whether they ran the computation (leader) or shared it.",
+    ["result"],
+)
+DEDUP_RATIO = Gauge(
+    "hia_coalescing_dedup_ratio",
+    "Fraction of coalescable queries answered by another in-flight identical query.",
+)
+ADMISSION_REJECTIONS = Counter(
+    "hia_admission_rejections_total",
+    "Number of requests rejected by admission control, by stage & reason.",
+    ["stage", "reason"],
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "hia_admission_in_flight",
+    "Number of requests holding a slot of a stage under admission control.",
+    ["stage"],
+)
+ADMISSION_QUEUED = Gauge(
+    "hia_admission_queued",
+    "Number of requests waiting for a slot of a stage under admission control.",
+    ["stage"],
+)
+ADMISSION_QUEUE_WAIT = Histogram(
+    "hia_admission_queue_wait_seconds",
+    "Time spent waiting for a slot of a stage under admission control.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+DEGRADED_REQUESTS = Counter(
+    "hia_degraded_requests_total",
+    "Number of requests answered in degraded mode, from the answer cache or without chat history.",
+    ["mode"],
+)
+HISTORY_DELETED_MESSAGES = Counter(
+    "hia_history_deleted_messages_total",
+    "Number of chat history messages deleted by the retention, by reason (expired session or trimmed).",
+    ["reason"],
+)
+HISTORY_ARCHIVED_SESSIONS = Counter(
+    "hia_history_archived_sessions_total",
+    "Number of expired chat sessions archived before deletion.",
+)
+RETENTION_BATCH = Histogram(
+    "hia_history_retention_batch_seconds",
+    "Duration of a retention delete batch, during which the chat history writers wait.",
+    buckets=LATENCY_BUCKETS,
+)
+HISTORY_MAINTENANCE = Histogram(
+    "hia_history_maintenance_seconds",
+    "Duration of the chat history database maintenance operations.",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+
+_current_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("current_trace", default=None)
+
+
+class RequestTrace:
+    """Collects the stage timings & token counts of one query.
+
+    Observations are buffered until `finish` because the route label is only known
+    once routing is done, and some stages may start before that.
+    """
+
+    def __init__(self, sampled: bool, count_request: bool = True):
+        self.sampled = sampled
+        self.count_request = count_request
+        self.route: Optional[str] = None
+        self._spans: List[Tuple[str, float]] = []
+        self._tokens: List[Tuple[int, int]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """Times the enclosed block as `stage`."""
+        if not self.sampled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, time.perf_counter() - start)
+
+    def add_span(self, stage: str, seconds: float) -> None:
+        if self.sampled:
+            with self._lock:
+                self._spans.append((stage, seconds))
+
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int) -> None:
+        if self.sampled:
+            with self._lock:
+                self._tokens.append((prompt_tokens, completion_tokens))
+
+    @property
+    def callbacks(self) -> List[BaseCallbackHandler]:
+        """LangChain callbacks to pass in the chain config to time retrieval & generation."""
+        return [StageMetricsCallbackHandler(self)] if self.sampled else []
+
+    def finish(self) -> None:
+        """Exports the buffered observations labelled with the final route."""
+        if _current_trace.get() is self:
+            _current_trace.set(None)
+        route = self.route or "none"
+        if self.count_request:
+            REQUESTS.labels(route=route).inc()
+        if not self.sampled:
+            return
+        with self._lock:
+            spans, self._spans = self._spans, []
+            tokens, self._tokens = self._tokens, []
+        for stage, seconds in spans:
+            STAGE_LATENCY.labels(stage=stage, route=route).observe(seconds)
+        for prompt_tokens, completion_tokens in tokens:
+            PROMPT_TOKENS.labels(route=route).observe(prompt_tokens)
+            LLM_TOKENS.labels(route=route, type="prompt").inc(prompt_tokens)
+            LLM_TOKENS.labels(route=route, type="completion").inc(completion_tokens)
+
+
+class StageMetricsCallbackHandler(BaseCallbackHandler):
+    """Times the retriever & LLM runs of a chain invocation into a `RequestTrace`."""
+
+    def __init__(self, trace: RequestTrace):
+        self.trace = trace
+        self._starts: Dict[UUID, float] = {}
+
+    def _end(self, run_id: UUID, stage: str) -> None:
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            self.trace.add_span(stage, time.perf_counter() - start)
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, "retrieve")
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts.pop(run_id, None)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, "generate")
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if token_usage:
+            self.trace.add_tokens(
+                token_usage.get("prompt_tokens", 0),
+                token_usage.get("completion_tokens", 0),
+            )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts.pop(run_id, None)
+
+
+def start_trace(count_request: bool = True) -> RequestTrace:
+    """Starts the trace of a new query, sampled with probability `METRICS_SAMPLE_RATE`.
+
+    The trace is also made the current one so that nested components (e.g. chat history)
+    can report their own stages through `stage`.
+
+    Args:
+        count_request (bool): Whether the trace counts as a query in `hia_requests_total`,
+            not the case of the stages shared by the queries of a batch
+    """
+    trace = RequestTrace(sampled=random.random() < METRICS_SAMPLE_RATE, count_request=count_request)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times the enclosed block as `name` in the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+def record_cache_event(cache: str, hit: bool) -> None:
+    """Counts a cache lookup of the cache named `cache`."""
+    CACHE_EVENTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def record_context_tokens(raw: int, packed: int) -> None:
+    """Observes the RAG context size before & after compression."""
+    CONTEXT_TOKENS.labels(stage="raw").observe(raw)
+    CONTEXT_TOKENS.labels(stage="packed").observe(packed)
+
+
+def record_speculative_retrieval(used: bool) -> None:
+    """Counts a speculative retrieval whose result was used (RAG route) or discarded."""
+    SPECULATIVE_RETRIEVALS.labels(result="used" if used else "discarded").inc()
+
+
+def record_coalesced_request(shared: bool, dedup_ratio: float) -> None:
+    """Counts a coalescable query & updates the dedup ratio."""
+    COALESCED_REQUESTS.labels(result="shared" if shared else "leader").inc()
+    DEDUP_RATIO.set(dedup_ratio)
+
+
+def record_admission_rejection(stage: str, reason: str) -> None:
+    """Counts a request rejected while entering `stage` (rate limited, queue full or queue timeout)."""
+    ADMISSION_REJECTIONS.labels(stage=stage, reason=reason).inc()
+
+
+def record_queue_wait(stage: str, seconds: float) -> None:
+    """Observes the time a request waited for a slot of `stage`."""
+    ADMISSION_QUEUE_WAIT.labels(stage=stage).observe(seconds)
+
+
+def set_admission_load(stage: str, in_flight: int, queued: int) -> None:
+    """Updates the number of requests running & waiting for `stage`."""
+    ADMISSION_IN_FLIGHT.labels(stage=stage).set(in_flight)
+    ADMISSION_QUEUED.labels(stage=stage).set(queued)
+
+
+def record_degraded_request(mode: str) -> None:
+    """Counts a request answered in degraded mode (`cache` or `no_history`)."""
+    DEGRADED_REQUESTS.labels(mode=mode).inc()
+
+
+def record_history_deletion(reason: str, messages: int) -> None:
+    """Counts chat history messages deleted by the retention (`expired` or `trimmed`)."""
+    HISTORY_DELETED_MESSAGES.labels(reason=reason).inc(messages)
+
+
+def record_history_archive(sessions: int) -> None:
+    """Counts expired chat sessions archived before deletion."""
+    HISTORY_ARCHIVED_SESSIONS.inc(sessions)
+
+
+def record_retention_batch(seconds: float) -> None:
+    """Observes the duration of a retention delete batch."""
+    RETENTION_BATCH.observe(seconds)
+
+
+def record_history_maintenance(operation: str, seconds: float) -> None:
+    """Observes the duration of a chat history database maintenance operation (`analyze` or `vacuum`)."""
+    HISTORY_MAINTENANCE.labels(operation=operation).observe(seconds)
+
+
+def export_metrics() -> Tuple[bytes, str]:
+    """Returns the Prometheus exposition of all metrics & its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,3 +1,4 @@
+import argparse
 import json
 import logging
 import os
@@ -8,16 +9,16 @@ from langchain import hub
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.output_parser import StrOutputParser
 from langchain_openai import ChatOpenAI
+from corpus import DEFAULT_POLICY_ID, DEFAULT_PRODUCT, policy_dir, register_policy
 from unstructured.documents.elements import Element
 from unstructured.partition.pdf import partition_pdf
 from unstructured.staging.base import elements_from_json, elements_to_json
 
 logging.basicConfig(level = logging.INFO)
 logger = logging.getLogger(__name__)
- 
-pdf_file_path = "./data/travel_health_insurance_policy.pdf"
 
-def chunk_pdf(pdf_file_path: str):
+
+def chunk_pdf(pdf_file_path: str, output_path: str = "./data/raw_elements_chunked.json"):
     #Get elements
     raw_pdf_elements = partition_pdf(
         filename=pdf_file_path,
@@ -32,7 +33,7 @@ def chunk_pdf(pdf_file_path: str):
         combine_text_under_n_chars=2000, # Attempt to keep chunks > 2000 chars
     )
 
-    elements_to_json(elements=raw_pdf_elements, filename="./data/raw_elements_chunked.json")
+    elements_to_json(elements=raw_pdf_elements, filename=output_path)
 
 def count_elements(pdf_file_path: str):
 
@@ -70,14 +71,14 @@ def summarize_table_or_text(texts: List[str]):
     return summaries
 
 
-def process_pdf(filename: str):
+def process_pdf(filename: str, directory: str = "./data/processed/"):
     """Categorize, summarize & save PDF elements.
 
     Args:
-        filename (str): PDF file to be processed
+        filename (str): Chunked elements of the PDF to be processed
+        directory (str): Directory where the processed elements are saved
     """
 
-    directory = "./data/processed/"
     # Check if the directory exists, if not, create it
     if not os.path.exists(directory):
         os.makedirs(directory)
@@ -91,29 +92,61 @@ def process_pdf(filename: str):
     texts = text_elements
     text_summaries = summarize_table_or_text(texts=texts)
 
-    with open("./data/processed/pdf_texts.json", "w") as file:
+    with open(os.path.join(directory, "pdf_texts.json"), "w") as file:
         json.dump(texts, file)
 
-    with open("./data/processed/pdf_text_summaries.json", "w") as file:
+    with open(os.path.join(directory, "pdf_text_summaries.json"), "w") as file:
         json.dump(text_summaries, file)
 
     # Apply to tables
     tables = [i.text for i in table_elements]
     table_summaries = summarize_table_or_text(texts=tables)
 
-    with open("./data/processed/pdf_tables.json", "w") as file:
+    with open(os.path.join(directory, "pdf_tables.json"), "w") as file:
         json.dump(tables, file)
 
-    with open("./data/processed/pdf_table_summaries.json", "w") as file:
+    with open(os.path.join(directory, "pdf_table_summaries.json"), "w") as file:
         json.dump(table_summaries, file)
 
+    # Keep the HTML of the tables to store them with their rows & columns
+    tables_html = [i.metadata.text_as_html for i in table_elements]
+
+    with open(os.path.join(directory, "pdf_tables_html.json"), "w") as file:
+        json.dump(tables_html, file)
+
     logger.info("Categorized & processed PDF elements")
 
+
+def add_policy(pdf_file_path: str, policy_id: str, product: str) -> dict:
+    """Chunks & processes the PDF of a policy, then registers it in the corpus.
+
+    The policy is indexed with its `policy_id` & `product` the next time the retriever is built.
+
+    Args:
+        pdf_file_path (str): PDF of the policy
+        policy_id (str): Unique ID of the policy
+        product (str): Product the policy belongs to
+
+    Returns:
+        dict: The registered policy
+    """
+    directory = policy_dir(policy_id)
+    raw_elements_chunked = os.path.join(directory, "raw_elements_chunked.json")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    chunk_pdf(pdf_file_path=pdf_file_path, output_path=raw_elements_chunked)
+    process_pdf(filename=raw_elements_chunked, directory=directory)
+    return register_policy(policy_id=policy_id, product=product, processed_dir=directory)
+
+
 if __name__ == "__main__":
 
-    # Chunk & process the PDF -- saves the result automatically
-    pdf_file_path = "./data/travel_health_insurance_policy.pdf"
-    raw_elements_chunked="./data/raw_elements_chunked.json"
-    
-    chunk_pdf(pdf_file_path=pdf_file_path)
-    process_pdf(filename=raw_elements_chunked)
\ No newline at end of file
+    # Chunk & process a policy PDF, then add it to the corpus -- saves the result automatically
+    parser = argparse.ArgumentParser(description="Adds a policy PDF to the corpus of the assistant")
+    parser.add_argument("--pdf", default="./data/travel_health_insurance_policy.pdf", help="PDF of the policy")
+    parser.add_argument("--policy-id", default=DEFAULT_POLICY_ID, help="Unique ID of the policy")
+    parser.add_argument("--product", default=DEFAULT_PRODUCT, help="Product the policy belongs to")
+    args = parser.parse_args()
+
+    add_policy(pdf_file_path=args.pdf, policy_id=args.policy_id, product=args.product)
@@ -1,29 +1,111 @@
 from uuid import uuid4
-from langchain.schema import AIMessage
-from chain import rag_chain_with_history, chitchat_chain_with_history
-from router import route_layer
-from typing import Dict
+from langchain.schema import AIMessage, HumanMessage
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from chain import (
+    chitchat_chain,
+    chitchat_chain_with_history,
+    rag_answer_chain,
+    rag_chain_with_history,
+    retriever,
+)
+from chat_history import get_session_history
+from retriever import batch_retrieve, with_policy_filter
+from router import route_batch, route_layer
+from metrics import (
+    RequestTrace,
+    record_cache_event,
+    record_coalesced_request,
+    record_speculative_retrieval,
+    start_trace,
+)
+from admission import AnswerCache, StageLimiter, build_stage_limiters
+from singleflight import SingleFlight, normalize_question
+from concurrent.futures import as_completed
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Dict, Hashable, Iterator, List, Optional, Tuple
 import logging
+import os
+import time
 
 logging.basicConfig(level = logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Start retrieval & history loading while the question is being routed
+SPECULATIVE_ROUTING = os.getenv("SPECULATIVE_ROUTING", "false").lower() == "true"
+SPECULATIVE_MAX_WORKERS = int(os.getenv("SPECULATIVE_MAX_WORKERS", "32"))
+# Share one in-flight computation between identical questions without chat history
+COALESCE_QUESTIONS = os.getenv("COALESCE_QUESTIONS", "false").lower() == "true"
+# Maximum number of concurrent LLM calls of a batch query
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+# Maximum number of questions of a batch query
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "64"))
+
+
+def _timed(func: Callable, *args) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    return func(*args), time.perf_counter() - start
+
+
+def _question_key(question: str, policy_filter: Optional[Dict[str, str]]) -> Tuple[Hashable, ...]:
+    """Key of the questions getting the same answer without chat history."""
+    return (normalize_question(question), tuple(sorted((policy_filter or {}).items())))
+
+
 class QueryService:
 
+    def __init__(
+            self,
+            speculative: bool = SPECULATIVE_ROUTING,
+            coalesce: bool = COALESCE_QUESTIONS,
+            stage_limiters: Optional[Dict[str, StageLimiter]] = None,
+            answer_cache: Optional[AnswerCache] = None,
+            ):
+        self.speculative = speculative
+        self.coalesce = coalesce
+        # Concurrency limits of the stages, e.g. of the LLM calls
+        self.stage_limiters = build_stage_limiters() if stage_limiters is None else stage_limiters
+        # Answers of questions without chat history, served by the degraded mode of the server
+        self.answer_cache = AnswerCache() if answer_cache is None else answer_cache
+        self._single_flight = SingleFlight()
+        # Workers are only spawned on first use, so this is free when speculation is off
+        self._executor = ContextThreadPoolExecutor(max_workers=SPECULATIVE_MAX_WORKERS)
+
     def _create_session_id(self):
         session_id = uuid4()
         return session_id
+
+    def _limit(self, stage: str) -> ContextManager:
+        """Slot of the stage limiter of `stage`, if it has one."""
+        limiter = self.stage_limiters.get(stage)
+        return limiter.slot() if limiter else nullcontext()
+
+    def _limited_retrieval(self, policy_retriever: Any, question: str) -> List:
+        """Retrieval of `question` under the `retrieve` limit, run in the background in speculative mode."""
+        with self._limit("retrieve"):
+            return policy_retriever.invoke(question)
+
+    def cached_answer(self, question: str, policy_filter: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """Answer of the same question recently asked without chat history, if any."""
+        answer = self.answer_cache.get(_question_key(question, policy_filter))
+        record_cache_event("answer", answer is not None)
+        return answer
     
     def query(
             self,
             question:str,
             session_id:str,
+            policy_filter: Optional[Dict[str, str]] = None,
+            use_history: bool = True,
             ) -> AIMessage:
         """Query method for normal usage without LangServe Server
 
         Args:
             question (str): Input user question
             session_id (str): Session ID of the chat session
+            policy_filter (Optional[Dict[str, str]]): Restricts retrieval to the documents with these
+                `policy_id` and/or `product` metadata values, the whole corpus is searched without it
+            use_history (bool): Whether to load & extend the chat history of the session, it's
+                skipped in the degraded mode of the server
 
         Returns:
             AIMessage: The output of the chain call
@@ -32,32 +114,232 @@ class QueryService:
         # Get or create Session ID
         session_id = session_id if session_id else self._create_session_id()
 
-        # Configure the session id for the chains
-        config = {"configurable": {"session_id": session_id}}
+        # Time the stages of this query, the route label is set once it's known
+        trace = start_trace()
 
-        # Route the input query to the relevant chain
-        route = route_layer(question)
+        # Configure the session id & the metrics callbacks for the chains
+        config = {"configurable": {"session_id": session_id}, "callbacks": trace.callbacks}
 
-        if route.name == "chitchat" or route.name is None:
-            logger.info(f"Selected Route is: {route.name}")
-            output = chitchat_chain_with_history.invoke({"question": question}, config=config)
-            return output
+        try:
+            # The chains with history don't expose their retrieval, so a `retrieve` limit needs the stages
+            if self.speculative or self.coalesce or not use_history or "retrieve" in self.stage_limiters:
+                return self._staged_query(question, session_id, config, trace, policy_filter, use_history)
 
-        elif route.name == "healthcare_insurance":
-            logger.info(f"Selected Route is: {route.name}")
-            output = rag_chain_with_history.invoke({"question": question}, config=config)
+            # Answers of sessions without history are cached for the degraded mode of the server
+            cache_answer = self.answer_cache.max_size > 0 and not get_session_history(session_id).has_messages()
+
+            # Route the input query to the relevant chain
+            with trace.span("route"):
+                route = route_layer(question)
+
+            if route.name == "chitchat" or route.name is None:
+                logger.info(f"Selected Route is: {route.name}")
+                trace.route = "chitchat"
+                # The chains with history don't expose their stages, so they run under the `generate` limit
+                with self._limit("generate"):
+                    output = chitchat_chain_with_history.invoke({"question": question}, config=config)
+
+            else:
+                logger.info(f"Selected Route is: {route.name}")
+                trace.route = route.name
+                with self._limit("generate"):
+                    output = rag_chain_with_history.invoke(
+                        {"question": question, "policy_filter": policy_filter}, config=config
+                    )
+
+            if cache_answer:
+                self.answer_cache.put(_question_key(question, policy_filter), output)
             return output
+        finally:
+            trace.finish()
+
+    def _staged_query(
+            self,
+            question: str,
+            session_id: str,
+            config: Dict,
+            trace: RequestTrace,
+            policy_filter: Optional[Dict[str, str]] = None,
+            use_history: bool = True,
+            ) -> str:
+        """Runs the query stage by stage instead of through the chains with history.
+
+        - In speculative mode, retrieval & history loading already run in the background while
+        the question is routed. The retrieved documents are used if the question is routed to
+        `healthcare_insurance`, otherwise the retrieval is cancelled if it hasn't started yet,
+        or its result discarded.
+        - With coalescing, identical questions of sessions without chat history share the
+        in-flight retrieval & generation. Each session still gets its own history entry.
+
+        Args:
+            question (str): Input user question
+            session_id (str): Session ID of the chat session
+            config (Dict): Config of the chains
+            trace (RequestTrace): Trace of the query
+            policy_filter (Optional[Dict[str, str]]): Metadata filter of the retrieval
+            use_history (bool): Whether to load & extend the chat history of the session
+
+        Returns:
+            str: The output of the chain call
+        """
+
+        history = get_session_history(session_id) if use_history else None
+        policy_retriever = with_policy_filter(retriever, policy_filter)
+        if self.speculative:
+            history_future = self._executor.submit(lambda: history.messages if history else [])
+            # Retrieval is timed here rather than by the trace callbacks, so a discarded
+            # retrieval isn't reported under the `chitchat` route
+            retrieval_future = self._executor.submit(_timed, self._limited_retrieval, policy_retriever, question)
+
+        with trace.span("route"):
+            route = route_layer(question)
+        logger.info(f"Selected Route is: {route.name}")
+        trace.route = "healthcare_insurance" if route.name == "healthcare_insurance" else "chitchat"
+
+        if trace.route == "chitchat" and self.speculative:
+            retrieval_future.cancel()
+            record_speculative_retrieval(used=False)
+
+        if self.speculative:
+            chat_history = history_future.result()
+        else:
+            chat_history = history.messages if history else []
+
+        def retrieve() -> Any:
+            if not self.speculative:
+                with self._limit("retrieve"):
+                    return policy_retriever.invoke(question, config=config)
+            context, seconds = retrieval_future.result()
+            trace.add_span("retrieve", seconds)
+            record_speculative_retrieval(used=True)
+            return context
+
+        def generate() -> str:
+            if trace.route == "healthcare_insurance":
+                inputs = {"question": question, "context": retrieve(), "chat_history": chat_history}
+                with self._limit("generate"):
+                    return rag_answer_chain.invoke(inputs, config=config)
+            with self._limit("generate"):
+                return chitchat_chain.invoke({"question": question, "chat_history": chat_history}, config=config)
+
+        # Without chat history, the answer only depends on the route, the question & the searched policies
+        if self.coalesce and not chat_history:
+            key = (trace.route,) + _question_key(question, policy_filter)
+            output, shared = self._single_flight.do(key, generate)
+            record_coalesced_request(shared, self._single_flight.dedup_ratio)
+            if shared and trace.route == "healthcare_insurance" and self.speculative:
+                record_speculative_retrieval(used=False)
+        else:
+            output = generate()
+
+        if not chat_history:
+            self.answer_cache.put(_question_key(question, policy_filter), output)
+
+        # Same messages as `RunnableWithMessageHistory` appends after a turn
+        if history:
+            history.add_message(HumanMessage(content=question))
+            history.add_message(AIMessage(content=output))
+        return output
     
+    def batch_query(
+            self,
+            questions: List[str],
+            session_ids: Optional[List[Optional[str]]] = None,
+            max_concurrency: int = BATCH_MAX_CONCURRENCY,
+            policy_filters: Optional[List[Optional[Dict[str, str]]]] = None,
+            ) -> Iterator[Dict]:
+        """Answers many questions at once, yielding each answer as soon as it's ready.
+
+        All questions are routed with one embedding call, the insurance questions are
+        retrieved with one vectorized search sharing the parent documents they have in
+        common, then the LLM is called for each question with a bounded concurrency.
+
+        Args:
+            questions (List[str]): Input user questions
+            session_ids (Optional[List[Optional[str]]]): Session ID of each question. Questions
+                with a session ID use & extend its chat history, the others are stateless.
+            max_concurrency (int): Maximum number of concurrent LLM calls
+            policy_filters (Optional[List[Optional[Dict[str, str]]]]): Metadata filter of the
+                retrieval of each question, `None` to search the whole corpus
+
+        Yields:
+            Dict: `index`, `question`, `route` & `answer` (or `error`) of a completed question
+        """
+        session_ids = session_ids or [None] * len(questions)
+        if len(session_ids) != len(questions):
+            raise ValueError("Please provide one session ID per question")
+        policy_filters = policy_filters or [None] * len(questions)
+        if len(policy_filters) != len(questions):
+            raise ValueError("Please provide one policy filter per question")
+
+        # The shared routing & retrieval are reported under the `batch` route, each question counts as a query
+        batch_trace = start_trace(count_request=False)
+        batch_trace.route = "batch"
+        try:
+            with batch_trace.span("route"):
+                routes = [
+                    "healthcare_insurance" if route.name == "healthcare_insurance" else "chitchat"
+                    for route in route_batch(questions)
+                ]
+
+            rag_indexes = [i for i, route in enumerate(routes) if route == "healthcare_insurance"]
+            with batch_trace.span("retrieve"), self._limit("retrieve"):
+                rag_contexts = batch_retrieve(
+                    retriever,
+                    [questions[i] for i in rag_indexes],
+                    policy_filters=[policy_filters[i] for i in rag_indexes],
+                )
+            contexts = dict(zip(rag_indexes, rag_contexts))
+        finally:
+            batch_trace.finish()
+        logger.info(f"Routed batch of {len(questions)} questions, {len(rag_indexes)} to RAG")
+
+        def answer(index: int) -> Dict:
+            question, session_id, route = questions[index], session_ids[index], routes[index]
+            trace = start_trace()
+            trace.route = route
+            config = {"callbacks": trace.callbacks}
+            result = {"index": index, "question": question, "route": route}
+            try:
+                history = get_session_history(session_id) if session_id else None
+                chat_history = history.messages if history else []
+                if route == "healthcare_insurance":
+                    inputs = {"question": question, "context": contexts[index], "chat_history": chat_history}
+                    chain = rag_answer_chain
+                else:
+                    inputs = {"question": question, "chat_history": chat_history}
+                    chain = chitchat_chain
+                with self._limit("generate"):
+                    result["answer"] = chain.invoke(inputs, config=config)
+                if history:
+                    history.add_message(HumanMessage(content=question))
+                    history.add_message(AIMessage(content=result["answer"]))
+            except Exception as error:
+                # One failing question shouldn't fail the whole batch
+                logger.exception(f"Batch question {index} failed")
+                result["error"] = str(error)
+            finally:
+                trace.finish()
+            return result
+
+        with ContextThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = [executor.submit(answer, index) for index in range(len(questions))]
+            for future in as_completed(futures):
+                yield future.result()
+
     def server_query(self, params: Dict):
         """To be used for RunnableLambda in LangServe Server
 
         Args:
-            params (Dict): Dictionary contains the keys of `question` & `session_id`
+            params (Dict): Dictionary contains the keys of `question`, `session_id` & optionally
+                `policy_filter` & `use_history`
         """
 
         return self.query(
             question=params["question"],
             session_id=params["session_id"],
+            policy_filter=params.get("policy_filter"),
+            use_history=params.get("use_history", True),
         )
 
         # # Get question
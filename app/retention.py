@@ -0,0 +1,314 @@
+"""Retention of the chat history: session TTL, per-session message cap, archiving & compaction of `rag_chat_history.db`."""
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from langchain_community.chat_message_histories.sql import DefaultMessageConverter
+from sqlalchemy import bindparam, create_engine, text
+
+from chat_history import CHAT_HISTORY_CONNECTION_STRING, prepare_database
+from metrics import (
+    record_history_archive,
+    record_history_deletion,
+    record_history_maintenance,
+    record_retention_batch,
+)
+
+logging.basicConfig(level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Run the retention job in the background of the server, off by default: it deletes chat history
+HISTORY_RETENTION = os.getenv("HISTORY_RETENTION", "false").lower() == "true"
+# Sessions inactive for longer are archived & deleted, 0 keeps them forever
+HISTORY_TTL_SECONDS = float(os.getenv("HISTORY_TTL_SECONDS", str(30 * 24 * 3600)))
+# Only the latest messages of a session are kept, 0 keeps them all
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "200"))
+# Messages deleted per transaction & pause between transactions, to let the writers in
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.01"))
+# Seconds between two sweeps & between two ANALYZE/VACUUM maintenances
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "300"))
+HISTORY_MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("HISTORY_MAINTENANCE_INTERVAL_SECONDS", "86400"))
+# VACUUM only once this fraction of the database pages is free
+VACUUM_MIN_FREE_RATIO = float(os.getenv("VACUUM_MIN_FREE_RATIO", "0.2"))
+# Expired sessions are appended to a gzipped JSONL file per day in this directory, empty disables archiving
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "./data/history_archive")
+
+# Sessions handled per step of a sweep
+_SESSIONS_PER_STEP = 100
+
+
+class HistoryRetention:
+    """Prunes the `message_store` table of the chat history.
+
+    - Sessions inactive for longer than `ttl` seconds are archived to gzipped JSONL, then deleted.
+    - Sessions with more than `max_messages` messages lose their oldest messages.
+    - Deletes run in transactions of `batch_size` messages with a pause in between, so chat
+    history writers only wait for one small batch at a time.
+    - `maintain` refreshes the query planner statistics (ANALYZE) & gives the free pages back
+    to the file system (VACUUM) once enough of them accumulated.
+    """
+
+    def __init__(
+            self,
+            connection_string: str = CHAT_HISTORY_CONNECTION_STRING,
+            ttl: float = HISTORY_TTL_SECONDS,
+            max_messages: int = HISTORY_MAX_MESSAGES,
+            batch_size: int = RETENTION_BATCH_SIZE,
+            batch_pause: float = RETENTION_BATCH_PAUSE,
+            archive_dir: Optional[str] = HISTORY_ARCHIVE_DIR,
+            vacuum_min_free_ratio: float = VACUUM_MIN_FREE_RATIO,
+            ):
+        self.engine = create_engine(connection_string)
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.archive_dir = archive_dir
+        self.vacuum_min_free_ratio = vacuum_min_free_ratio
+
+        DefaultMessageConverter("message_store").get_sql_model_class().metadata.create_all(self.engine)
+        prepare_database(self.engine)
+
+    def sweep(self, now: Optional[float] = None) -> Dict[str, int]:
+        """Runs one retention pass over all sessions.
+
+        Args:
+            now (Optional[float]): Current UNIX time, to compute the expiry
+
+        Returns:
+            Dict[str, int]: Number of `expired_sessions`, `expired_messages` & `trimmed_messages`
+        """
+        now = time.time() if now is None else now
+        stats = {"expired_sessions": 0, "expired_messages": 0, "trimmed_messages": 0}
+        if self.ttl > 0:
+            self._expire_sessions(now - self.ttl, stats)
+        if self.max_messages > 0:
+            self._trim_sessions(stats)
+        if any(stats.values()):
+            logger.info(f"Chat history retention: {stats}")
+        return stats
+
+    def _delete_in_batches(self, condition: str, params: Dict) -> int:
+        """Deletes the messages matching `condition`, `batch_size` messages per transaction."""
+        statement = text(
+            f"DELETE FROM message_store WHERE id IN "
+            f"(SELECT id FROM message_store WHERE {condition} LIMIT :batch_size)"
+        )
+        if "session_ids" in params:
+            statement = statement.bindparams(bindparam("session_ids", expanding=True))
+
+        deleted = 0
+        while True:
+            start = time.perf_counter()
+            with self.engine.begin() as connection:
+                rowcount = connection.execute(statement, {**params, "batch_size": self.batch_size}).rowcount
+            record_retention_batch(time.perf_counter() - start)
+            deleted += rowcount
+            if rowcount < self.batch_size:
+                return deleted
+            time.sleep(self.batch_pause)
+
+    def _expire_sessions(self, cutoff: float, stats: Dict[str, int]) -> None:
+        while True:
+            with self.engine.connect() as connection:
+                sessions = connection.execute(
+                    text(
+                        "SELECT session_id, last_active FROM session_activity WHERE last_active < :cutoff "
+                        "ORDER BY last_active LIMIT :limit"
+                    ),
+                    {"cutoff": cutoff, "limit": _SESSIONS_PER_STEP},
+                ).all()
+            if not sessions:
+                return
+
+            session_ids = [session_id for session_id, _ in sessions]
+            max_id = self._archive(sessions) if self.archive_dir else None
+
+            if max_id is not None:
+                # The archived messages are deleted even if their session is active again since,
+                # otherwise they would be archived again when it expires. Its new messages are
+                # kept: they always get a greater id than the archived ones
+                condition = "session_id IN :session_ids AND id <= :max_id"
+                params = {"session_ids": session_ids, "max_id": max_id}
+            else:
+                # Nothing archived, sessions active again since they were selected keep their messages
+                condition = (
+                    "session_id IN :session_ids "
+                    "AND session_id IN (SELECT session_id FROM session_activity WHERE last_active < :cutoff)"
+                )
+                params = {"session_ids": session_ids, "cutoff": cutoff}
+            deleted = self._delete_in_batches(condition, params)
+
+            with self.engine.begin() as connection:
+                connection.execute(
+                    text(
+                        "DELETE FROM session_activity WHERE session_id IN :session_ids AND last_active < :cutoff"
+                    ).bindparams(bindparam("session_ids", expanding=True)),
+                    {"session_ids": session_ids, "cutoff": cutoff},
+                )
+                # Recount the sessions that came back, only their messages newer than the archive are left
+                connection.execute(
+                    text(
+                        "UPDATE session_activity SET message_count = "
+                        "(SELECT COUNT(*) FROM message_store WHERE message_store.session_id = session_activity.session_id) "
+                        "WHERE session_id IN :session_ids"
+                    ).bindparams(bindparam("session_ids", expanding=True)),
+                    {"session_ids": session_ids},
+                )
+
+            stats["expired_sessions"] += len(sessions)
+            stats["expired_messages"] += deleted
+            record_history_deletion("expired", deleted)
+
+    def _archive(self, sessions: List) -> Optional[int]:
+        """Appends the messages of the sessions to the archive of the day.
+
+        Returns:
+            Optional[int]: The greatest archived message id, `None` if no message was archived
+        """
+        session_ids = [session_id for session_id, _ in sessions]
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, session_id, message FROM message_store WHERE session_id IN :session_ids "
+                    "ORDER BY session_id, id"
+                ).bindparams(bindparam("session_ids", expanding=True)),
+                {"session_ids": session_ids},
+            ).all()
+        if not rows:
+            return None
+
+        messages: Dict[str, List] = {session_id: [] for session_id in session_ids}
+        for _, session_id, message in rows:
+            messages[session_id].append(json.loads(message))
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"message_store-{time.strftime('%Y%m%d')}.jsonl.gz")
+        archived_at = time.time()
+        # Appending creates a new gzip member, which gzip readers read as one stream
+        with gzip.open(path, "at", encoding="utf-8") as file:
+            for session_id, last_active in sessions:
+                if messages[session_id]:
+                    record = {
+                        "session_id": session_id,
+                        "last_active": last_active,
+                        "archived_at": archived_at,
+                        "messages": messages[session_id],
+                    }
+                    file.write(json.dumps(record) + "\n")
+
+        record_history_archive(sum(1 for session_id in session_ids if messages[session_id]))
+        return max(row[0] for row in rows)
+
+    def _trim_sessions(self, stats: Dict[str, int]) -> None:
+        with self.engine.connect() as connection:
+            session_ids = connection.execute(
+                text("SELECT session_id FROM session_activity WHERE message_count > :max_messages"),
+                {"max_messages": self.max_messages},
+            ).scalars().all()
+
+        for session_id in session_ids:
+            with self.engine.connect() as connection:
+                # Greatest id of the messages beyond the `max_messages` latest ones
+                cutoff_id = connection.execute(
+                    text(
+                        "SELECT id FROM message_store WHERE session_id = :session_id "
+                        "ORDER BY id DESC LIMIT 1 OFFSET :max_messages"
+                    ),
+                    {"session_id": session_id, "max_messages": self.max_messages},
+                ).scalar()
+            deleted = 0
+            if cutoff_id is not None:
+                deleted = self._delete_in_batches(
+                    "session_id = :session_id AND id <= :cutoff_id",
+                    {"session_id": session_id, "cutoff_id": cutoff_id},
+                )
+            with self.engine.begin() as connection:
+                connection.execute(
+                    text(
+                        "UPDATE session_activity SET message_count = "
+                        "(SELECT COUNT(*) FROM message_store WHERE session_id = :session_id) "
+                        "WHERE session_id = :session_id"
+                    ),
+                    {"session_id": session_id},
+                )
+            stats["trimmed_messages"] += deleted
+            record_history_deletion("trimmed", deleted)
+
+    def maintain(self, force_vacuum: bool = False) -> Dict[str, float]:
+        """Runs ANALYZE, then VACUUM if enough pages are free.
+
+        VACUUM rewrites the whole database & blocks the writers meanwhile, hence the free
+        pages threshold. Its copy goes through the WAL, which is truncated afterwards.
+
+        Args:
+            force_vacuum (bool): VACUUM whatever the number of free pages
+
+        Returns:
+            Dict[str, float]: Duration in seconds of each operation that ran
+        """
+        durations = {}
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            start = time.perf_counter()
+            connection.exec_driver_sql("ANALYZE")
+            durations["analyze"] = time.perf_counter() - start
+
+            page_count = connection.exec_driver_sql("PRAGMA page_count").scalar()
+            freelist_count = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+            free_ratio = freelist_count / page_count if page_count else 0.0
+            if force_vacuum or free_ratio >= self.vacuum_min_free_ratio:
+                start = time.perf_counter()
+                connection.exec_driver_sql("VACUUM")
+                connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+                durations["vacuum"] = time.perf_counter() - start
+
+        for operation, seconds in durations.items():
+            record_history_maintenance(operation, seconds)
+        logger.info(f"Chat history maintenance: {durations}, {free_ratio:.0%} free pages before")
+        return durations
+
+
+class RetentionWorker(threading.Thread):
+    """Background thread sweeping the chat history every `interval` seconds & maintaining it every `maintenance_interval`."""
+
+    def __init__(
+            self,
+            retention: Optional[HistoryRetention] = None,
+            interval: float = RETENTION_INTERVAL_SECONDS,
+            maintenance_interval: float = HISTORY_MAINTENANCE_INTERVAL_SECONDS,
+            ):
+        super().__init__(name="history-retention", daemon=True)
+        self.retention = retention
+        self.interval = interval
+        self.maintenance_interval = maintenance_interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        # Created in the thread, so a missing database doesn't slow down the server startup
+        self.retention = self.retention or HistoryRetention()
+        next_maintenance = time.monotonic() + self.maintenance_interval
+        while not self._stopped.is_set():
+            try:
+                self.retention.sweep()
+                if time.monotonic() >= next_maintenance:
+                    self.retention.maintain()
+                    next_maintenance = time.monotonic() + self.maintenance_interval
+            except Exception:
+                logger.exception("Chat history retention failed")
+            self._stopped.wait(self.interval)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+if __name__ == "__main__":
+
+    # One retention pass & maintenance of `rag_chat_history.db`, e.g. from a cron job
+    retention = HistoryRetention()
+    print(retention.sweep())
+    print(retention.maintain())
@@ -0,0 +1,162 @@
+"""Cache of the retrieved parent doc ids, keyed by the query embedding with SimHash buckets."""
+import itertools
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, Hashable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+# Cache the retrieval results of the retriever built by `build_retriever`
+RETRIEVAL_CACHE = os.getenv("RETRIEVAL_CACHE", "true").lower() == "true"
+# Queries whose retrieved ids are kept, least recently used first out
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "2048"))
+# Minimum cosine similarity between two query embeddings for one to reuse the ids of the other
+RETRIEVAL_CACHE_MIN_SIMILARITY = float(os.getenv("RETRIEVAL_CACHE_MIN_SIMILARITY", "0.95"))
+# SimHash tables & bits per table: more tables find more paraphrases, more bits compare fewer candidates
+RETRIEVAL_CACHE_TABLES = int(os.getenv("RETRIEVAL_CACHE_TABLES", "16"))
+RETRIEVAL_CACHE_BITS = int(os.getenv("RETRIEVAL_CACHE_BITS", "16"))
+
+
+class _Entry:
+    """Retrieved ids of a query, with its normalized embedding & the buckets it's filed in."""
+
+    def __init__(self, vector: np.ndarray, ids: Tuple[str, ...], buckets: List[Hashable]):
+        self.vector = vector
+        self.ids = ids
+        self.buckets = buckets
+
+
+class RetrievalCache:
+    """LRU cache of the parent doc ids retrieved for a query embedding.
+
+    Embeddings are filed under one SimHash signature per table: the signs of their
+    projections on `bits` random hyperplanes. Close embeddings share a signature in at
+    least one table with a high probability, so a lookup only compares the query to the
+    entries of its buckets, & reuses the ids of the most similar one above `min_similarity`.
+    An identical query always lands in the same buckets.
+
+    Only doc ids are stored: the parents are still read from the docstore, & the table rows
+    still selected for the new query. Entries are scoped to the `index_version` of the
+    retriever, so retrievers of different indexes can share the cache & the entries of a
+    rebuilt index are never served, only evicted as the least recently used. They are also
+    scoped to the search parameters, so filtered & unfiltered searches never share results.
+    """
+
+    def __init__(
+            self,
+            max_size: int = RETRIEVAL_CACHE_SIZE,
+            min_similarity: float = RETRIEVAL_CACHE_MIN_SIMILARITY,
+            tables: int = RETRIEVAL_CACHE_TABLES,
+            bits: int = RETRIEVAL_CACHE_BITS,
+            seed: int = 0,
+            ):
+        self.max_size = max_size
+        self.min_similarity = min_similarity
+        self.tables = tables
+        self.bits = bits
+        self.seed = seed
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._buckets: Dict[Hashable, Set[int]] = defaultdict(set)
+        self._hyperplanes: Dict[int, np.ndarray] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _signatures(self, vector: np.ndarray) -> List[int]:
+        """SimHash signature of `vector` in each table."""
+        hyperplanes = self._hyperplanes.get(vector.shape[0])
+        if hyperplanes is None:
+            rng = np.random.default_rng(self.seed)
+            hyperplanes = rng.standard_normal((self.tables * self.bits, vector.shape[0])).astype(np.float32)
+            self._hyperplanes[vector.shape[0]] = hyperplanes
+        signs = (hyperplanes @ vector > 0).reshape(self.tables, self.bits)
+        weights = 1 << np.arange(self.bits, dtype=np.int64)
+        return (signs * weights).sum(axis=1).tolist()
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding: Sequence[float], index_version: str, scope: Hashable) -> Optional[List[str]]:
+        """Retrieved ids of the most similar cached query, if similar enough.
+
+        Args:
+            embedding (Sequence[float]): Embedding of the query
+            index_version (str): Version of the index the query is searched in
+            scope (Hashable): Search parameters of the query, e.g. its filter & `k`
+
+        Returns:
+            Optional[List[str]]: The parent doc ids in retrieval order, `None` on a miss
+        """
+        vector = self._normalize(embedding)
+        signatures = self._signatures(vector)
+        with self._lock:
+            candidates = set()
+            for table, signature in enumerate(signatures):
+                candidates.update(self._buckets.get((index_version, scope, table, signature), ()))
+            if not candidates:
+                return None
+
+            candidates = list(candidates)
+            similarities = np.stack([self._entries[key].vector for key in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.min_similarity:
+                return None
+            self._entries.move_to_end(candidates[best])
+            return list(self._entries[candidates[best]].ids)
+
+    def put(self, embedding: Sequence[float], index_version: str, scope: Hashable, ids: Sequence[str]) -> None:
+        """Caches the parent doc ids retrieved for a query.
+
+        Args:
+            embedding (Sequence[float]): Embedding of the query
+            index_version (str): Version of the index the ids were retrieved from
+            scope (Hashable): Search parameters of the query
+            ids (Sequence[str]): The parent doc ids in retrieval order
+        """
+        if self.max_size <= 0:
+            return
+        vector = self._normalize(embedding)
+        buckets = [
+            (index_version, scope, table, signature) for table, signature in enumerate(self._signatures(vector))
+        ]
+        with self._lock:
+            key = next(self._ids)
+            self._entries[key] = _Entry(vector, tuple(ids), buckets)
+            for bucket in buckets:
+                self._buckets[bucket].add(key)
+            while len(self._entries) > self.max_size:
+                self._evict(*self._entries.popitem(last=False))
+
+    def _evict(self, key: int, entry: _Entry) -> None:
+        for bucket in entry.buckets:
+            keys = self._buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[bucket]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    cache = RetrievalCache(max_size=2)
+    query = rng.standard_normal(1536)
+    paraphrase = query + 0.2 * rng.standard_normal(1536)
+    print(f"Similarity of the paraphrase: {float(RetrievalCache._normalize(query) @ RetrievalCache._normalize(paraphrase)):.3f}")
+
+    cache.put(query, "v1", scope="k=4", ids=["doc-1", "doc-2"])
+    print("Same query:", cache.get(query, "v1", scope="k=4"))
+    print("Paraphrase:", cache.get(paraphrase, "v1", scope="k=4"))
+    print("Other query:", cache.get(rng.standard_normal(1536), "v1", scope="k=4"))
+    print("Other filter:", cache.get(query, "v1", scope="k=4,policy_id=dental"))
+    print("Other index:", cache.get(query, "v2", scope="k=4"), len(cache))
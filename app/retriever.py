@@ -1,99 +1,460 @@
+import hashlib
 import json
 import logging
+import os
 import uuid
+from typing import Any, Dict, Hashable, List, Optional
 
-from langchain.retrievers.multi_vector import MultiVectorRetriever
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.retrievers.multi_vector import MultiVectorRetriever, SearchType
 from langchain.schema.document import Document
-from langchain.storage import InMemoryStore
 from langchain_community.vectorstores import Qdrant
 from langchain_openai import OpenAIEmbeddings
+from langchain_core.pydantic_v1 import Field
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+from qdrant_client.http.exceptions import UnexpectedResponse
+from corpus import POLICY_FIELDS, load_corpus, load_policy_elements
+from metrics import record_cache_event
+from retrieval_cache import RETRIEVAL_CACHE, RetrievalCache
+from SQLBaseStore import SQLStrStore
+from table_store import TableStore
 
 logging.basicConfig(level = logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Qdrant server, e.g. http://localhost:6333. Without it, Qdrant runs embedded on the local path,
+# which scans every point's payload to filter instead of using the payload indexes.
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_PATH = os.getenv("QDRANT_PATH", "./qdrant_db")
+# Parent documents, shared by the replicas of the server like the Qdrant collection
+DOCSTORE_CONNECTION_STRING = os.getenv("DOCSTORE_CONNECTION_STRING", "sqlite:///docstore.db")
 
+# Shared by the retrievers of all builds, each only reading the entries of its `index_version`
+retrieval_cache = RetrievalCache() if RETRIEVAL_CACHE else None
 
-def build_retriever(
-        vectorstore_collection_name: str,
-)-> MultiVectorRetriever:
-    """Builds a MultiVector Retriever with Qdrant as Vector Store & InMemory Doc Store
 
-    Args:
-        vectorstore_collection_name (str): Collection name to be created in Qdrant
+def _cache_scope(search_type: SearchType, search_kwargs: Dict) -> Hashable:
+    """Key of the search parameters, e.g. `k` & the policy filter, of the cached retrievals."""
+    return repr((search_type, sorted(search_kwargs.items())))
+
+
+def index_version(collection_name: str, fingerprints: Dict[str, str]) -> str:
+    """Version of the index of a collection holding the policies of `fingerprints`, by policy id.
+
+    Doc ids are derived from the policy ids, so two builds of the same policies share a version.
+    """
+    content = json.dumps([collection_name, fingerprints], sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()[:12]
+
+
+class TableAwareMultiVectorRetriever(MultiVectorRetriever):
+    """MultiVector Retriever resolving table hits to the table rows matching the query.
+
+    Text hits resolve to their parent chunk in the docstore as usual.
+    With a `cache`, the query is embedded first & the parent ids retrieved for the same or a
+    paraphrased query of the same `index_version` are reused instead of searching Qdrant.
+    """
+
+    table_store: TableStore = Field(default_factory=TableStore)
+    cache: Optional[RetrievalCache] = None
+    index_version: str = ""
+
+    def _search(self, query: str) -> List[Document]:
+        if self.search_type == SearchType.mmr:
+            return self.vectorstore.max_marginal_relevance_search(query, **self.search_kwargs)
+        return self.vectorstore.similarity_search(query, **self.search_kwargs)
+
+    def _search_by_vector(self, embedding: List[float]) -> List[Document]:
+        if self.search_type == SearchType.mmr:
+            return self.vectorstore.max_marginal_relevance_search_by_vector(embedding, **self.search_kwargs)
+        return self.vectorstore.similarity_search_by_vector(embedding, **self.search_kwargs)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List:
+        if self.cache is None:
+            sub_docs = self._search(query)
+        else:
+            embedding = self.vectorstore.embeddings.embed_query(query)
+            scope = _cache_scope(self.search_type, self.search_kwargs)
+            ids = self.cache.get(embedding, self.index_version, scope)
+            record_cache_event("retrieval", ids is not None)
+            if ids is not None:
+                return self.resolve_parents(ids, query)
+            sub_docs = self._search_by_vector(embedding)
+
+        # We do this to maintain the order of the ids that are returned
+        ids = []
+        for d in sub_docs:
+            if self.id_key in d.metadata and d.metadata[self.id_key] not in ids:
+                ids.append(d.metadata[self.id_key])
+        if self.cache is not None:
+            self.cache.put(embedding, self.index_version, scope, ids)
+        return self.resolve_parents(ids, query)
+
+    def resolve_parents(
+        self,
+        ids: List[str],
+        query: str,
+        parents: Optional[Dict[str, Any]] = None,
+    ) -> List:
+        """Parent documents of the retrieved ids.
+
+        Args:
+            ids (List[str]): Doc ids of the retrieved summaries, in order
+            query (str): The query, to select the relevant table rows
+            parents (Optional[Dict[str, Any]]): Docstore values already fetched by id, e.g. shared
+                by the queries of a batch. Fetched from the docstore if not provided.
+
+        Returns:
+            List: Matching rows of the tables & docstore values of the other ids
+        """
+        if parents is None:
+            doc_ids = [doc_id for doc_id in ids if doc_id not in self.table_store]
+            parents = dict(zip(doc_ids, self.docstore.mget(doc_ids)))
+        docs = [
+            self.table_store.lookup(doc_id, query) if doc_id in self.table_store else parents.get(doc_id)
+            for doc_id in ids
+        ]
+        return [d for d in docs if d is not None]
+
+
+def _ensure_collection(qdrant: Qdrant) -> None:
+    """Creates the Qdrant collection unless it exists, e.g. created by another replica or a previous run."""
+    existing = {collection.name for collection in qdrant.client.get_collections().collections}
+    if qdrant.collection_name in existing:
+        return
+    vector_size = len(qdrant.embeddings.embed_query("vector size"))
+    try:
+        qdrant.client.create_collection(
+            collection_name=qdrant.collection_name,
+            vectors_config=rest.VectorParams(size=vector_size, distance=rest.Distance.COSINE),
+        )
+    except (UnexpectedResponse, ValueError):
+        # Created by another replica in the meantime
+        pass
+
+
+def _policy_doc_ids(policy: Dict, kind: str, count: int) -> List[str]:
+    """Ids of the texts or tables of a policy, the same in every process & run."""
+    return [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{policy['policy_id']}/{kind}/{i}")) for i in range(count)]
+
+
+def _policy_fingerprint(policy: Dict, elements: Dict[str, List]) -> str:
+    """Hash of what a policy contributes to the index, its points are re-embedded when it changes."""
+    content = {key: elements[key] for key in ("texts", "text_summaries", "tables", "table_summaries")}
+    content["product"] = policy["product"]
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _policy_condition(qdrant: Qdrant, field: str, value: str) -> rest.FieldCondition:
+    return rest.FieldCondition(key=f"{qdrant.metadata_payload_key}.{field}", match=rest.MatchValue(value=value))
+
+
+def _index_policy(retriever: TableAwareMultiVectorRetriever, policy: Dict, elements: Dict[str, List], fingerprint: str) -> bool:
+    """Adds the summaries & parents of a policy to the stores, unless they are already there.
 
     Returns:
-        MultiVectorRetriever: An instance of MultiVectorRetriever
+        bool: Whether the summaries of the policy were embedded
     """
+    qdrant, id_key = retriever.vectorstore, retriever.id_key
+    doc_ids = _policy_doc_ids(policy, "text", len(elements["texts"]))
+    table_ids = _policy_doc_ids(policy, "table", len(elements["tables"]))
+
+    indexed = qdrant.client.count(
+        collection_name=qdrant.collection_name,
+        count_filter=rest.Filter(must=[
+            _policy_condition(qdrant, "policy_id", policy["policy_id"]),
+            _policy_condition(qdrant, "fingerprint", fingerprint),
+        ]),
+        exact=True,
+    ).count
+    # Parents are written before the points, so indexed points always have their parents
+    if indexed == len(doc_ids) + len(table_ids) and None not in retriever.docstore.mget(doc_ids + table_ids):
+        return False
 
-    with open("./data/processed/pdf_texts.json", "r") as file:
-        texts = json.load(file)
+    # Texts & whole tables in the docstore, matching rows through the table store when their HTML is known
+    retriever.docstore.mset(list(zip(doc_ids, elements["texts"])) + list(zip(table_ids, elements["tables"])))
 
-    with open("./data/processed/pdf_text_summaries.json", "r") as file:
-        text_summaries = json.load(file)
+    # Points of a previous version of the policy
+    qdrant.client.delete(
+        collection_name=qdrant.collection_name,
+        points_selector=rest.FilterSelector(filter=rest.Filter(must=[
+            _policy_condition(qdrant, "policy_id", policy["policy_id"]),
+        ])),
+    )
+    metadata = {"policy_id": policy["policy_id"], "product": policy["product"], "fingerprint": fingerprint}
+    summary_docs = [
+        Document(page_content=s, metadata={id_key: doc_id, **metadata})
+        for doc_id, s in zip(doc_ids, elements["text_summaries"])
+    ] + [
+        Document(page_content=s, metadata={id_key: table_id, **metadata})
+        for table_id, s in zip(table_ids, elements["table_summaries"])
+    ]
+    # The summary of a parent is stored under the id of the parent
+    qdrant.add_documents(summary_docs, ids=[doc.metadata[id_key] for doc in summary_docs])
+    return True
 
-    with open("./data/processed/pdf_tables.json", "r") as file:
-        tables = json.load(file)
-    
-    with open("./data/processed/pdf_table_summaries.json", "r") as file:
-        table_summaries = json.load(file)
 
-    logger.info("Loaded PDF elements")
+def build_retriever(
+        vectorstore_collection_name: str,
+        corpus: Optional[List[Dict]] = None,
+        cache: Optional[RetrievalCache] = retrieval_cache,
+)-> TableAwareMultiVectorRetriever:
+    """Builds a MultiVector Retriever with Qdrant as Vector Store, a SQL Doc Store & a Table Store
+
+    Every summary is stored with the `policy_id` & `product` of its policy. On a Qdrant server
+    these fields are indexed, so searches filtered on them only visit the points of the
+    matching policies.
+
+    The index persists across runs & is shared by the replicas of the server: doc ids are
+    derived from the policy ids, the collection is only created if missing, and only the
+    policies that are new or changed since the last build are embedded. Policies removed from
+    the corpus are left in place, since other replicas may still serve them: remove them with
+    `prune_index`.
+
+    Args:
+        vectorstore_collection_name (str): Collection name in Qdrant, & of the parents in the doc store
+        corpus (Optional[List[Dict]]): Policies to index, defaults to the policies of the corpus manifest
+        cache (Optional[RetrievalCache]): Cache of the retrieved parent ids, `None` disables it
+
+    Returns:
+        TableAwareMultiVectorRetriever: An instance of TableAwareMultiVectorRetriever
+    """
+    corpus = corpus if corpus is not None else load_corpus()
 
     # ============================ Retriever ================================
     # q_client = QdrantVectorStore()
     # qdrant = Qdrant(client=q_client.client, collection_name="healthcare_demo", embeddings=OpenAIEmbeddings())
-    qdrant = Qdrant.construct_instance(
-        texts=["test"],
-        embedding=OpenAIEmbeddings(model="text-embedding-3-small"),
+    location = {"url": QDRANT_URL, "api_key": QDRANT_API_KEY} if QDRANT_URL else {"path": QDRANT_PATH}
+    qdrant = Qdrant(
+        client=QdrantClient(**location),
         collection_name=vectorstore_collection_name,
-        path="./qdrant_db",
+        embeddings=OpenAIEmbeddings(model="text-embedding-3-small"),
     )
+    _ensure_collection(qdrant)
+    # Embedded Qdrant has no payload indexes, it filters by scanning the payloads
+    if QDRANT_URL:
+        for field in POLICY_FIELDS:
+            qdrant.client.create_payload_index(
+                collection_name=vectorstore_collection_name,
+                field_name=f"{qdrant.metadata_payload_key}.{field}",
+                field_schema=rest.PayloadSchemaType.KEYWORD,
+            )
+    elif len(corpus) > 1:
+        logger.warning(
+            f"Embedded Qdrant filters the {len(corpus)} policies of the corpus by scanning every point: "
+            "set QDRANT_URL to a Qdrant server for filtered searches whose cost follows the size of one policy"
+        )
 
     # The storage layer for the parent documents
-    store = InMemoryStore()
+    store = SQLStrStore(connection_string=DOCSTORE_CONNECTION_STRING, collection_name=vectorstore_collection_name)
     id_key = "doc_id"
 
     # The retriever (empty to start)
-    retriever = MultiVectorRetriever(
+    retriever = TableAwareMultiVectorRetriever(
         vectorstore=qdrant,
         docstore=store,
         id_key=id_key,
+        cache=cache,
     )
 
-    # Add texts to MultiVector Retriever
-    doc_ids = [str(uuid.uuid4()) for _ in texts]
-    summary_text_docs = [
-        Document(page_content=s, metadata={id_key: doc_ids[i]})
-        for i, s in enumerate(text_summaries)
-    ]
+    fingerprints = {}
+    embedded = 0
+    for policy in corpus:
+        elements = load_policy_elements(policy)
+        fingerprints[policy["policy_id"]] = _policy_fingerprint(policy, elements)
+        embedded += _index_policy(retriever, policy, elements, fingerprints[policy["policy_id"]])
+        table_ids = _policy_doc_ids(policy, "table", len(elements["tables"]))
+        for table_id, table_html in zip(table_ids, elements["tables_html"]):
+            if table_html:
+                retriever.table_store.add(table_id, table_html)
+
+    retriever.index_version = index_version(vectorstore_collection_name, fingerprints)
+
+    logger.info(f"Indexed {len(corpus)} policies in the retriever, {embedded} of them (re)embedded")
 
-    retriever.vectorstore.add_documents(
-        documents=summary_text_docs,
-        # embedding=OpenAIEmbeddings(model="text-embedding-3-small"),
-        # collection_name="healthcare_demo",
-        # path="/qdrant_db",
+    return retriever
+
+
+def prune_index(retriever: TableAwareMultiVectorRetriever, corpus: List[Dict]) -> int:
+    """Removes the policies missing from `corpus` from the index, i.e. their points & parents.
+
+    Run it as an admin step once every replica serves `corpus`: `build_retriever` keeps the
+    policies it doesn't know, as another replica may be serving them, e.g. in a rolling deploy.
+
+    Args:
+        retriever (TableAwareMultiVectorRetriever): Retriever returned by `build_retriever`
+        corpus (List[Dict]): Policies to keep, not empty
+
+    Returns:
+        int: Number of removed points
+    """
+    if not corpus:
+        raise ValueError("Refusing to prune the index to an empty corpus")
+
+    qdrant = retriever.vectorstore
+    removed = rest.Filter(must_not=[
+        rest.FieldCondition(
+            key=f"{qdrant.metadata_payload_key}.policy_id",
+            match=rest.MatchAny(any=[policy["policy_id"] for policy in corpus]),
+        ),
+    ])
+    doc_ids, offset = [], None
+    while True:
+        points, offset = qdrant.client.scroll(
+            collection_name=qdrant.collection_name, scroll_filter=removed, limit=256, offset=offset, with_payload=True,
         )
-    retriever.docstore.mset(list(zip(doc_ids, texts)))
-    logger.info("Added text documents to retriever")
-
-    # Add tables to MultiVector Retriever
-    table_ids = [str(uuid.uuid4()) for _ in tables]
-    summary_table_docs = [
-        Document(page_content=s, metadata={id_key: table_ids[i]})
-        for i, s in enumerate(table_summaries)
+        doc_ids += [point.payload[qdrant.metadata_payload_key][retriever.id_key] for point in points]
+        if offset is None:
+            break
+
+    if doc_ids:
+        retriever.docstore.mdelete(doc_ids)
+        qdrant.client.delete(collection_name=qdrant.collection_name, points_selector=rest.FilterSelector(filter=removed))
+    logger.info(f"Pruned {len(doc_ids)} points of the policies missing from the corpus")
+    return len(doc_ids)
+
+
+def to_qdrant_filter(
+        retriever: TableAwareMultiVectorRetriever,
+        policy_filter: Optional[Dict[str, str]],
+) -> Optional[rest.Filter]:
+    """Qdrant filter matching the summaries whose metadata has all the values of `policy_filter`.
+
+    Args:
+        retriever (TableAwareMultiVectorRetriever): Retriever returned by `build_retriever`
+        policy_filter (Optional[Dict[str, str]]): Metadata values, e.g. from `corpus.policy_filter`
+
+    Returns:
+        Optional[rest.Filter]: The filter, `None` without `policy_filter`
+    """
+    if not policy_filter:
+        return None
+    return rest.Filter(must=[
+        rest.FieldCondition(
+            key=f"{retriever.vectorstore.metadata_payload_key}.{key}",
+            match=rest.MatchValue(value=value),
+        )
+        for key, value in policy_filter.items()
+    ])
+
+
+def with_policy_filter(
+        retriever: TableAwareMultiVectorRetriever,
+        policy_filter: Optional[Dict[str, str]],
+) -> TableAwareMultiVectorRetriever:
+    """Retriever searching only the summaries matching `policy_filter`.
+
+    Args:
+        retriever (TableAwareMultiVectorRetriever): Retriever returned by `build_retriever`
+        policy_filter (Optional[Dict[str, str]]): Metadata values, e.g. from `corpus.policy_filter`
+
+    Returns:
+        TableAwareMultiVectorRetriever: A shallow copy sharing the stores of `retriever`,
+            or `retriever` itself without `policy_filter`
+    """
+    if not policy_filter:
+        return retriever
+    search_kwargs = {**retriever.search_kwargs, "filter": to_qdrant_filter(retriever, policy_filter)}
+    return retriever.copy(update={"search_kwargs": search_kwargs})
+
+
+def batch_retrieve(
+        retriever: TableAwareMultiVectorRetriever,
+        queries: List[str],
+        policy_filters: Optional[List[Optional[Dict[str, str]]]] = None,
+) -> List[List]:
+    """Retrieves the parent documents of many queries at once.
+
+    Equivalent to calling `retriever.invoke` on each query, but the queries are embedded
+    in one call, searched in one Qdrant batch request & the parent documents shared by
+    several queries are fetched once from the docstore. Queries found in the retrieval
+    cache of the retriever aren't searched.
+
+    Args:
+        retriever (TableAwareMultiVectorRetriever): Retriever returned by `build_retriever`
+        queries (List[str]): Queries to retrieve documents for
+        policy_filters (Optional[List[Optional[Dict[str, str]]]]): Metadata filter of each query,
+            `None` to search the whole corpus
+
+    Returns:
+        List[List]: The parent documents of each query, in the order of `queries`
+    """
+    if not queries:
+        return []
+
+    qdrant = retriever.vectorstore
+    k = retriever.search_kwargs.get("k", 4)
+    vectors = qdrant.embeddings.embed_documents(queries)
+    policy_filters = policy_filters or [None] * len(queries)
+
+    filters = [to_qdrant_filter(retriever, policy_filter) for policy_filter in policy_filters]
+
+    # Same scopes as the single similarity searches of `with_policy_filter(retriever, policy_filter)`
+    ids_per_query: List[Optional[List[str]]] = [None] * len(queries)
+    scopes = [None] * len(queries)
+    if retriever.cache is not None:
+        for i, (vector, qdrant_filter) in enumerate(zip(vectors, filters)):
+            search_kwargs = {**retriever.search_kwargs, "filter": qdrant_filter} if qdrant_filter else retriever.search_kwargs
+            scopes[i] = _cache_scope(SearchType.similarity, search_kwargs)
+            ids_per_query[i] = retriever.cache.get(vector, retriever.index_version, scopes[i])
+            record_cache_event("retrieval", ids_per_query[i] is not None)
+
+    misses = [i for i, ids in enumerate(ids_per_query) if ids is None]
+    requests = [
+        rest.SearchRequest(
+            vector=vectors[i] if qdrant.vector_name is None else rest.NamedVector(name=qdrant.vector_name, vector=vectors[i]),
+            filter=filters[i],
+            limit=k,
+            with_payload=True,
+        )
+        for i in misses
     ]
-    retriever.vectorstore.add_documents(summary_table_docs)
-    logger.info("Added table documents to retriever")
+    results = qdrant.client.search_batch(collection_name=qdrant.collection_name, requests=requests) if requests else []
 
-    return retriever
+    # Keep the order of the ids that are returned per query, like `MultiVectorRetriever`
+    for i, points in zip(misses, results):
+        ids = []
+        for point in points:
+            metadata = point.payload.get(qdrant.metadata_payload_key) or {}
+            doc_id = metadata.get(retriever.id_key)
+            if doc_id is not None and doc_id not in ids:
+                ids.append(doc_id)
+        ids_per_query[i] = ids
+        if retriever.cache is not None:
+            retriever.cache.put(vectors[i], retriever.index_version, scopes[i], ids)
+
+    unique_ids = list(dict.fromkeys(
+        doc_id for ids in ids_per_query for doc_id in ids if doc_id not in retriever.table_store
+    ))
+    parents = dict(zip(unique_ids, retriever.docstore.mget(unique_ids)))
+
+    return [
+        retriever.resolve_parents(ids, query, parents=parents)
+        for ids, query in zip(ids_per_query, queries)
+    ]
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Builds the index of the corpus & runs sample searches")
+    parser.add_argument("--prune", action="store_true", help="Remove the policies missing from the corpus manifest")
+    args = parser.parse_args()
 
     # Check if retriever is built correctly
-    collection_name="healthcare_demo"
+    collection_name = os.getenv("QDRANT_COLLECTION_NAME", "healthcare_demo")
     retriever = build_retriever(
         vectorstore_collection_name=collection_name,
     )
+    if args.prune:
+        prune_index(retriever, load_corpus())
+
+    print(retriever.vectorstore.similarity_search("provider of insurance"))
 
-    print(retriever.vectorstore.similarity_search("provider of insurance"))
\ No newline at end of file
+    # Only the summaries of one policy
+    policy_retriever = with_policy_filter(retriever, {"policy_id": "travel_health_insurance"})
+    print(policy_retriever.invoke("provider of insurance"))
\ No newline at end of file
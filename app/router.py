@@ -1,4 +1,7 @@
+from typing import List
+
 from semantic_router import Route
+from semantic_router.schema import RouteChoice
 from semantic_router.encoders import OpenAIEncoder
 from semantic_router.layer import RouteLayer
 from dotenv import load_dotenv
@@ -33,6 +36,21 @@ encoder = OpenAIEncoder()
 route_layer = RouteLayer(encoder=encoder, routes=routes)
 
 
+def route_batch(questions: List[str]) -> List[RouteChoice]:
+    """Routes many questions with a single encoder call.
+
+    Args:
+        questions (List[str]): Input user questions
+
+    Returns:
+        List[RouteChoice]: The route of each question, in the order of `questions`
+    """
+    if not questions:
+        return []
+    vectors = route_layer.encoder(questions)
+    return [route_layer(vector=vector) for vector in vectors]
+
+
 
 if __name__ == "__main__":
 
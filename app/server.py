@@ -1,12 +1,19 @@
-from typing import Dict, List, Tuple
+import asyncio
+import json
+import math
+from typing import Dict, List, Optional, Tuple
 
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from langchain_core.runnables import RunnableLambda, RunnableParallel
 from langserve import CustomUserType, add_routes
-from langserve.pydantic_v1 import Field
-from query_service import QueryService
-from chain import retriever
+from langserve.pydantic_v1 import BaseModel, Field
+from query_service import BATCH_MAX_CONCURRENCY, BATCH_MAX_SIZE, QueryService
+from chain import corpus, retriever
+from corpus import matching_policies, policy_filter
+from admission import DEGRADED_MODE, DEGRADE_QUEUE_DEPTH, AnswerCache, Rejected, RequestAdmission, SessionRateLimiter
+from metrics import export_metrics, record_degraded_request
+from retention import HISTORY_RETENTION, RetentionWorker
 
 app = FastAPI(
     title="Healthcare Insurance Assistant Server",
@@ -50,39 +57,221 @@ class InputChat(CustomUserType):
         description="The human input question to the chatbot.",
     )
 
+    policy_id: Optional[str] = Field(
+        None,
+        description="Only answer from this policy. All the policies are searched without it.",
+    )
+
+    product: Optional[str] = Field(
+        None,
+        description="Only answer from the policies of this product.",
+    )
+
     # reference_documents: List = Field(
     #     ...,
     #     description="The reference documents from which context is extracted.",
     # )
 
 
+class BatchItem(BaseModel):
+    """A question of the /chat/batch endpoint."""
+
+    question: str = Field(
+        ...,
+        description="The human input question to the chatbot.",
+    )
+
+    session_id: Optional[str] = Field(
+        None,
+        description="The session id for chat history. Questions without one are stateless.",
+    )
+
+    policy_id: Optional[str] = Field(
+        None,
+        description="Only answer from this policy. All the policies are searched without it.",
+    )
+
+    product: Optional[str] = Field(
+        None,
+        description="Only answer from the policies of this product.",
+    )
+
+
+class BatchInput(BaseModel):
+    """Input for the /chat/batch endpoint."""
+
+    inputs: List[BatchItem] = Field(
+        ...,
+        description="The questions to answer.",
+        max_items=BATCH_MAX_SIZE,
+    )
+
+    max_concurrency: int = Field(
+        BATCH_MAX_CONCURRENCY,
+        description="The maximum number of concurrent LLM calls.",
+        ge=1,
+        le=BATCH_MAX_CONCURRENCY,
+    )
+
+
+def _policy_filter(policy_id: Optional[str], product: Optional[str]) -> Optional[Dict[str, str]]:
+    """`corpus.policy_filter` of a request, checked against the policies of the corpus.
+
+    Raises:
+        HTTPException: 422 when no policy of the corpus matches the filter
+    """
+    requested = policy_filter(policy_id, product)
+    if requested and not matching_policies(requested, corpus):
+        raise HTTPException(status_code=422, detail=f"No policy of the corpus matches {requested}")
+    return requested
+
+
 def _format_to_dict(input: InputChat) -> Dict:
     """Format the input to a dict to be passed to `QueryService.server_query`."""
 
-    # We only need the question & session_id in the dictionary
-    return {"question": input.question, "session_id": input.session_id}
+    # We only need the question, session_id & the policies to search in the dictionary
+    return {
+        "question": input.question,
+        "session_id": input.session_id,
+        "policy_filter": _policy_filter(input.policy_id, input.product),
+    }
 
 
-# Create Query Service instance
-query_service = QueryService()
+# Create Query Service instance, its answers are only cached for the degraded mode
+query_service = QueryService(answer_cache=None if DEGRADED_MODE else AnswerCache(max_size=0))
+
+# Admission control of the /chat requests
+admission = RequestAdmission()
+session_rate_limiter = SessionRateLimiter()
+
+
+def _http_exception(error: Rejected) -> HTTPException:
+    """HTTP error of a request refused by admission control, with a `Retry-After` header when known."""
+    headers = {"Retry-After": str(math.ceil(error.retry_after))} if error.retry_after else None
+    return HTTPException(status_code=error.status_code, detail=error.reason, headers=headers)
+
+
+async def admitted_query(params: Dict) -> str:
+    """`query_service.server_query` behind the session rate limits & the admission queue.
+
+    In degraded mode, once the admission queue is `DEGRADE_QUEUE_DEPTH` deep, questions recently
+    answered without chat history get the same answer right away, the others are answered
+    without loading or extending the chat history.
+
+    Args:
+        params (Dict): Output of `_format_to_dict`
+
+    Raises:
+        HTTPException: 429 when the session exceeded its rate limit, 503 when the queue is full
+            or the request couldn't start before its deadline
+    """
+    try:
+        session_rate_limiter.check(params["session_id"])
+
+        degraded = DEGRADED_MODE and admission.queued >= DEGRADE_QUEUE_DEPTH
+        if degraded:
+            answer = query_service.cached_answer(params["question"], params.get("policy_filter"))
+            if answer is not None:
+                record_degraded_request("cache")
+                return answer
+            record_degraded_request("no_history")
+
+        return await admission.run(query_service.server_query, {**params, "use_history": not degraded})
+    except Rejected as error:
+        raise _http_exception(error)
 
 # InputChat is the input to RunnableLambda, which formats the Pydantic model to dict & pass it to `query_service.server_query`
 # Final Chain with Chat History displayed on UI 
 # final_chain = RunnableLambda(_format_to_dict).with_types(input_type=InputChat) | RunnableLambda(query_service.server_query)
 
 # Final Chain with Chat History displayed on UI -- & assign the output to `answer` key
+# LangServe invokes it asynchronously, which goes through the admission control
 final_chain = RunnableParallel(
     {"answer": (
-        RunnableLambda(_format_to_dict) | RunnableLambda(query_service.server_query)
+        RunnableLambda(_format_to_dict) | RunnableLambda(query_service.server_query, afunc=admitted_query)
         )
     }
 ).with_types(input_type=InputChat)
 
 
+# Chat history TTL, message cap & compaction in the background
+retention_worker = RetentionWorker()
+
+
+@app.on_event("startup")
+async def start_history_retention():
+    if HISTORY_RETENTION:
+        retention_worker.start()
+
+
+@app.on_event("shutdown")
+async def stop_history_retention():
+    retention_worker.stop()
+
+
 @app.get("/")
 async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: per-stage latency histograms by route, token & cache counters."""
+    content, content_type = export_metrics()
+    return Response(content=content, media_type=content_type)
+
+# Registered before `add_routes` so it takes precedence over LangServe's generic per-item batch
+@app.post("/chat/batch")
+async def chat_batch(batch: BatchInput):
+    """Answers many questions with shared routing & retrieval.
+
+    Streams one JSON line per question as soon as it's answered, containing its `index`
+    in the input, the `question`, its `route` & the `answer` (or an `error`).
+
+    Each question with a `session_id` counts against the rate limit of its session, and the
+    batch runs on one worker of the admission control, like a /chat request. Once admitted,
+    its questions wait for the stage slots up to the queue timeout of the stage each.
+
+    Raises:
+        HTTPException: 422 when no policy matches the `policy_id` & `product` of a question,
+            429 when a session exceeded its rate limit, 503 when the admission queue is full
+            or the batch couldn't start before its deadline
+    """
+    policy_filters = [_policy_filter(item.policy_id, item.product) for item in batch.inputs]
+    try:
+        for item in batch.inputs:
+            if item.session_id:
+                session_rate_limiter.check(item.session_id)
+        await admission.admit()
+    except Rejected as error:
+        raise _http_exception(error)
+
+    loop = asyncio.get_running_loop()
+    results: asyncio.Queue = asyncio.Queue()
+
+    def answer_batch():
+        try:
+            for result in query_service.batch_query(
+                questions=[item.question for item in batch.inputs],
+                session_ids=[item.session_id for item in batch.inputs],
+                max_concurrency=batch.max_concurrency,
+                policy_filters=policy_filters,
+            ):
+                loop.call_soon_threadsafe(results.put_nowait, result)
+        finally:
+            loop.call_soon_threadsafe(results.put_nowait, None)
+
+    # The deadline only bounds the wait for admission: the questions of the batch reach the stages
+    # one after the other, each waiting for its stage slots up to the stage queue timeout
+    answered = admission.submit(None, answer_batch)
+
+    async def lines():
+        while (result := await results.get()) is not None:
+            yield json.dumps(result) + "\n"
+        # Raises if the shared routing or retrieval failed
+        await answered
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 add_routes(
     app,
     final_chain, 
@@ -0,0 +1,99 @@
+import re
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+def normalize_question(question: str) -> str:
+    """Normalizes a question so trivially different spellings share a coalescing key.
+
+    Args:
+        question (str): Input user question
+
+    Returns:
+        str: Lowercased question with collapsed whitespace & no trailing punctuation
+    """
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+class _Call:
+    """An in-flight computation shared by every caller with the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls sharing a key into one in-flight computation.
+
+    The first caller of a key (the leader) runs the function, concurrent callers of the
+    same key wait for the leader & get its result or exception. Nothing is cached: once
+    the computation is done, the next call with the same key runs again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.total = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Runs `func` unless a call with the same `key` is already in flight.
+
+        Args:
+            key (Hashable): Key identifying identical computations
+            func (Callable[[], Any]): The computation
+
+        Returns:
+            Tuple[Any, bool]: The result & whether it was shared from another caller
+        """
+        with self._lock:
+            self.total += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    @property
+    def dedup_ratio(self) -> float:
+        """Fraction of the calls that were served by another caller's computation."""
+        return self.shared / self.total if self.total else 0.0
+
+
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    single_flight = SingleFlight()
+
+    def slow_answer():
+        time.sleep(0.2)
+        return "The provider of the insurance is ..."
+
+    questions = ["Who is the provider of the insurance?", "who is the provider of the  insurance"] * 5
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = list(executor.map(lambda q: single_flight.do(normalize_question(q), slow_answer), questions))
+
+    print(results)
+    print("Dedup ratio: ", single_flight.dedup_ratio)
@@ -0,0 +1,228 @@
+"""Structured storage of the PDF tables with row-level lookup on the coverage & benefit names."""
+import html
+import math
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from context_compression import tokenize
+
+# unstructured.io writes header rows as `<thead><th>…</th></thead>`, without `<tr>`
+_ROW = re.compile(r"<tr(?:\s[^>]*)?>(.*?)</tr>|<thead(?:\s[^>]*)?>((?:(?!<tr).)*?)</thead>", re.S)
+_CELL = re.compile(r"<(td|th)(\s[^>]*)?>(.*?)</\1>", re.S)
+_COLSPAN = re.compile(r"colspan=\"?(\d+)")
+_TAG = re.compile(r"<[^>]+>")
+_DIGIT = re.compile(r"\d")
+
+# Weight of a question term matching the section heading of a row rather than the row name
+_SECTION_WEIGHT = 0.5
+# Rows scoring less than this fraction of the best row are left out
+_RELATIVE_THRESHOLD = 0.5
+
+
+def _parse_rows(text_as_html: str) -> List[Tuple[List[str], bool]]:
+    """Non-empty rows of the table, each with whether all its cells are `<th>` header cells."""
+    rows = []
+    for row, head in _ROW.findall(text_as_html):
+        cells, header_cells = [], True
+        for tag, attributes, content in _CELL.findall(row or head):
+            cell = html.unescape(_TAG.sub("", content)).strip()
+            colspan = _COLSPAN.search(attributes or "")
+            span = int(colspan.group(1)) if colspan else 1
+            # A name spanning the row is a section heading, any other cell fills every column it spans
+            cells.extend([cell] + [""] * (span - 1) if not cells else [cell] * span)
+            header_cells = header_cells and tag == "th"
+        if any(cells):
+            rows.append((cells, header_cells))
+    return rows
+
+
+def parse_html_table(text_as_html: str) -> List[List[str]]:
+    """Parses the `text_as_html` of an unstructured.io table element into rows of cells.
+
+    Cells spanning several columns are repeated in each of them, so values stay aligned with
+    their columns, except a first cell spanning the row, e.g. a section heading.
+
+    Args:
+        text_as_html (str): HTML of the table
+
+    Returns:
+        List[List[str]]: The non-empty rows of the table, header rows included
+    """
+    return [cells for cells, _ in _parse_rows(text_as_html)]
+
+
+class Table:
+    """Column-oriented table, indexed on the first column which holds the coverage or benefit names.
+
+    - Rows without a name continue the previous row & are merged into it.
+    - Rows with a name but no values (e.g. "Section 1 - Personal Accident Benefits") are
+    section headings of the rows below them.
+    - The optional `header` names the columns (e.g. "Table of Losses | Right | | Left") &
+    is printed above the rows of `to_text`.
+    """
+
+    def __init__(self, rows: List[List[str]], header: Optional[List[str]] = None):
+        self.header = header
+        merged: List[List[str]] = []
+        for row in rows:
+            if merged and not row[0]:
+                previous = merged[-1]
+                previous.extend([""] * (len(row) - len(previous)))
+                for i, cell in enumerate(row):
+                    previous[i] = f"{previous[i]} {cell}".strip()
+            else:
+                merged.append(list(row))
+
+        n_columns = max((len(row) for row in merged), default=0)
+        self.columns: List[List[str]] = [
+            [row[i] if i < len(row) else "" for row in merged] for i in range(n_columns)
+        ]
+        self.n_rows = len(merged)
+
+        # Section heading row of every row
+        self.sections: List[Optional[int]] = []
+        section = None
+        for i in range(self.n_rows):
+            if self.is_section(i):
+                section = i
+            self.sections.append(section)
+
+        # Inverted index: term -> rows whose name contains it
+        self._index: Dict[str, Set[int]] = defaultdict(set)
+        for i, name in enumerate(self.columns[0] if self.columns else []):
+            for term in tokenize(name):
+                self._index[term].add(i)
+
+    @classmethod
+    def from_html(cls, text_as_html: str) -> "Table":
+        """Table of the `text_as_html` of an unstructured.io table element.
+
+        unstructured.io also writes rows continuing a table split across pages, or section
+        headings, as header rows: the first row is only taken as the header of the columns if
+        it's made of header cells without any figure, e.g. "Right" & "Left" but not "$100".
+        """
+        rows = _parse_rows(text_as_html)
+        if rows:
+            cells, header_cells = rows[0]
+            if header_cells and any(cells[1:]) and not any(_DIGIT.search(cell) for cell in cells[1:]):
+                return cls([cells for cells, _ in rows[1:]], header=cells)
+        return cls([cells for cells, _ in rows])
+
+    def row(self, i: int) -> List[str]:
+        return [column[i] for column in self.columns]
+
+    def is_section(self, i: int) -> bool:
+        return len(self.columns) > 1 and not any(column[i] for column in self.columns[1:])
+
+    def format_row(self, i: int) -> str:
+        """Compact form of a row: its cells separated by `|`, without the trailing empty ones."""
+        return self._format_cells(self.row(i))
+
+    @staticmethod
+    def _format_cells(cells: List[str]) -> str:
+        cells = list(cells)
+        while len(cells) > 1 and not cells[-1]:
+            cells.pop()
+        return " | ".join(cell or "-" for cell in cells)
+
+    def lookup(self, question: str) -> List[int]:
+        """Rows matching the question, best first.
+
+        Rows are scored by the question terms found in their name, and with a lower
+        weight in their section heading, which selects every row of a matching section.
+        Terms are weighted by their rarity across the row names.
+
+        Args:
+            question (str): Input user question
+
+        Returns:
+            List[int]: Indexes of the matching rows, excluding the section headings
+        """
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(question)):
+            rows = self._index.get(term, ())
+            if not rows:
+                continue
+            weight = math.log(1 + self.n_rows / len(rows))
+            for i in rows:
+                if self.is_section(i):
+                    for row in range(i + 1, self.n_rows):
+                        if self.sections[row] != i:
+                            break
+                        scores[row] += _SECTION_WEIGHT * weight
+                else:
+                    scores[i] += weight
+        if not scores:
+            return []
+        best = max(scores.values())
+        return sorted(
+            (i for i, score in scores.items() if score >= _RELATIVE_THRESHOLD * best),
+            key=lambda i: (-scores[i], i),
+        )
+
+    def to_text(self, rows: Optional[List[int]] = None) -> str:
+        """Compact text of the given rows (all by default) in table order, under the header & their section headings."""
+        rows = range(self.n_rows) if rows is None else sorted(rows)
+        lines = [self._format_cells(self.header)] if self.header else []
+        current_section = None
+        for i in rows:
+            section = self.sections[i]
+            if section is not None and section != current_section and section != i:
+                lines.append(self.format_row(section))
+            current_section = section
+            lines.append(self.format_row(i))
+        return "\n".join(lines)
+
+
+class TableStore:
+    """Tables of the PDF by doc id, answering table hits with their rows relevant to the question."""
+
+    def __init__(self, max_rows: int = 8):
+        self.max_rows = max_rows
+        self._tables: Dict[str, Table] = {}
+
+    def add(self, doc_id: str, text_as_html: str) -> Table:
+        table = self._tables[doc_id] = Table.from_html(text_as_html)
+        return table
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._tables
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+    def get(self, doc_id: str) -> Optional[Table]:
+        return self._tables.get(doc_id)
+
+    def lookup(self, doc_id: str, question: str) -> str:
+        """Compact text of the rows of a table matching the question.
+
+        Args:
+            doc_id (str): Doc id of the table
+            question (str): Input user question
+
+        Returns:
+            str: The best `max_rows` matching rows, or the whole table if no row matches
+        """
+        table = self._tables[doc_id]
+        rows = table.lookup(question)[: self.max_rows]
+        return table.to_text(rows or None)
+
+
+if __name__ == "__main__":
+    import json
+    import timeit
+
+    with open("./data/raw_elements_chunked.json", "r") as file:
+        elements = json.load(file)
+
+    store = TableStore()
+    tables = [el["metadata"]["text_as_html"] for el in elements if el["type"] == "Table"]
+    for i, text_as_html in enumerate(tables):
+        store.add(str(i), text_as_html)
+
+    question = "How much is covered for accidental death?"
+    print(store.lookup("2", question))
+    seconds = timeit.timeit(lambda: store.lookup("2", question), number=10000) / 10000
+    print(f"Lookup took {seconds * 1e6:.1f}µs, vs {len(tables[2])} characters of HTML for the whole table")
@@ -0,0 +1,94 @@
+"""Benchmark of `QueryService.batch_query` against a loop over `QueryService.query`.
+
+Both answer the same stateless questions. Reports wall time, questions per second, the
+number of API calls, the estimated OpenAI cost & questions per dollar.
+
+Usage (from the repository root):
+    python benchmarks/batch.py --questions 200 --max-concurrency 8
+"""
+import argparse
+import os
+import random
+import time
+from typing import Callable, Dict
+
+from fakes import USAGE
+from harness import add_backend_args, boot_app, write_results
+from replay import CHITCHAT_QUESTIONS, INSURANCE_QUESTIONS
+
+
+def measure(name: str, run: Callable[[], int]) -> Dict:
+    """Runs `run` (returning the number of answers) & collects its throughput & usage."""
+    USAGE.reset()
+    start = time.perf_counter()
+    answered = run()
+    duration = time.perf_counter() - start
+    usage = USAGE.snapshot()
+    return {
+        "mode": name,
+        "answered": answered,
+        "duration_s": round(duration, 3),
+        "questions_per_s": round(answered / duration, 3),
+        "questions_per_usd": round(answered / usage["cost_usd"], 1) if usage["cost_usd"] else None,
+        "usage": usage,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=200, help="Number of questions in the batch")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="Concurrent LLM calls of the batch")
+    parser.add_argument("--chitchat-ratio", type=float, default=0.1)
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/batch-<time>.json)")
+    add_backend_args(parser)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    server = boot_app(args)
+    query_service = server.query_service
+    # Distinct sessions can't coalesce, keep the loop a plain loop
+    query_service.coalesce = False
+
+    rng = random.Random(args.seed)
+    questions = [
+        rng.choice(CHITCHAT_QUESTIONS if rng.random() < args.chitchat_ratio else INSURANCE_QUESTIONS)
+        for _ in range(args.questions)
+    ]
+
+    def loop() -> int:
+        for index, question in enumerate(questions):
+            query_service.query(question=question, session_id=f"loop-{index}")
+        return len(questions)
+
+    def batch() -> int:
+        return sum(
+            "answer" in result
+            for result in query_service.batch_query(questions, max_concurrency=args.max_concurrency)
+        )
+
+    modes = [measure("loop", loop), measure("batch", batch)]
+    for mode in modes:
+        print(
+            f"{mode['mode']:<6} answered={mode['answered']:<5} duration={mode['duration_s']:>8.2f}s  "
+            f"{mode['questions_per_s']:>7.2f} q/s  {mode['questions_per_usd'] or 0:>9.1f} q/$  "
+            f"calls={mode['usage']['calls']}"
+        )
+
+    results = {
+        "benchmark": "batch",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "questions": args.questions,
+            "max_concurrency": args.max_concurrency,
+            "llm_latency": args.llm_latency,
+            "embedding_latency": args.embedding_latency,
+            "encoder_latency": args.encoder_latency,
+            "seed": args.seed,
+        },
+        "modes": modes,
+    }
+    print(f"Results written to {write_results(results, output, prefix='batch')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Burst benchmark of question coalescing with concurrent fake-backed requests.
+
+Simulates the peak after a policy email: many new sessions ask the same few questions
+within moments. Runs the burst with coalescing off & on, checks that every session got
+its own history entry, and reports LLM calls, dedup ratio & latency.
+
+Usage (from the repository root):
+    python benchmarks/coalescing.py --sessions 64 --concurrency 32
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from harness import StageRecorder, add_backend_args, boot_app, summarize, write_results
+
+# Spelling variants normalize to the same two questions
+BURST_QUESTIONS = [
+    "What does the travel healthcare insurance policy cover?",
+    "what does the travel healthcare insurance policy cover",
+    "What does the travel  healthcare insurance policy cover ?",
+    "How do I file a claim?",
+    "how do i file a claim",
+]
+
+
+def run_burst(server, recorder: StageRecorder, coalesce: bool, n_sessions: int, concurrency: int) -> Dict:
+    """Sends one question per new session, `concurrency` at a time."""
+    from chat_history import get_session_history
+
+    query_service = server.query_service
+    query_service.coalesce = coalesce
+    recorder.reset()
+    flights_before = (query_service._single_flight.total, query_service._single_flight.shared)
+
+    mode = "coalesced" if coalesce else "independent"
+    requests = [(f"burst-{mode}-{i}", BURST_QUESTIONS[i % len(BURST_QUESTIONS)]) for i in range(n_sessions)]
+    latencies: List[float] = []
+
+    def send(request):
+        session_id, question = request
+        start = time.perf_counter()
+        query_service.query(question=question, session_id=session_id)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, requests))
+    duration = time.perf_counter() - start
+
+    missing_history = [
+        session_id for session_id, _ in requests if len(get_session_history(session_id).messages) != 2
+    ]
+    if missing_history:
+        raise SystemExit(f"Sessions without their own history entry: {missing_history}")
+
+    total = query_service._single_flight.total - flights_before[0]
+    shared = query_service._single_flight.shared - flights_before[1]
+    return {
+        "requests": n_sessions,
+        "llm_calls": len(recorder.samples.get("generate", [])),
+        "retrievals": len(recorder.samples.get("retrieve", [])),
+        "dedup_ratio": round(shared / total, 3) if total else 0.0,
+        "throughput_rps": round(n_sessions / duration, 3),
+        "latency": summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=64, help="Number of new sessions in the burst")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/coalescing-<time>.json)")
+    add_backend_args(parser)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    recorder = StageRecorder()
+    server = boot_app(args, recorder=recorder)
+
+    modes = {
+        "independent": run_burst(server, recorder, False, args.sessions, args.concurrency),
+        "coalesced": run_burst(server, recorder, True, args.sessions, args.concurrency),
+    }
+    for mode, result in modes.items():
+        print(
+            f"{mode:<12} requests={result['requests']:<4} llm_calls={result['llm_calls']:<4} "
+            f"retrievals={result['retrievals']:<4} dedup_ratio={result['dedup_ratio']:.2f}  "
+            f"p50={result['latency']['p50_ms']:.1f}ms  p95={result['latency']['p95_ms']:.1f}ms  "
+            f"throughput={result['throughput_rps']:.2f} req/s"
+        )
+
+    results = {
+        "benchmark": "coalescing",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "sessions": args.sessions,
+            "concurrency": args.concurrency,
+            "llm_latency": args.llm_latency,
+            "embedding_latency": args.embedding_latency,
+            "encoder_latency": args.encoder_latency,
+            "seed": args.seed,
+        },
+        "modes": modes,
+    }
+    print(f"Results written to {write_results(results, output, prefix='coalescing')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark of the context compression: RAG prompt tokens & LLM latency per token budget.
+
+Budget 0 disables the compression, i.e. the full parent chunks fill the prompt.
+
+Usage (from the repository root):
+    python benchmarks/compression.py --budgets 0,2000,1000,500
+"""
+import argparse
+import os
+import time
+from typing import Dict
+
+from fakes import USAGE
+from harness import StageRecorder, add_backend_args, boot_app, summarize, write_results
+from replay import INSURANCE_QUESTIONS
+
+
+def run_budget(server, recorder: StageRecorder, budget: int, rounds: int) -> Dict:
+    """Asks every insurance question `rounds` times from new sessions with the given budget."""
+    import context_compression
+
+    context_compression.CONTEXT_TOKEN_BUDGET = budget
+    recorder.reset()
+    USAGE.reset()
+    for round_index in range(rounds):
+        for index, question in enumerate(INSURANCE_QUESTIONS):
+            server.query_service.query(question=question, session_id=f"budget-{budget}-{round_index}-{index}")
+
+    usage = USAGE.snapshot()
+    llm_calls = usage["calls"]["llm"] or 1
+    return {
+        "budget": budget,
+        "llm_calls": usage["calls"]["llm"],
+        "mean_prompt_tokens": round(usage["tokens"]["llm_prompt"] / llm_calls, 1),
+        "cost_usd": usage["cost_usd"],
+        "generate": summarize(recorder.samples.get("generate", [])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budgets", default="0,2000,1000,500", help="Comma separated token budgets")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/compression-<time>.json)")
+    add_backend_args(parser)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    recorder = StageRecorder()
+    server = boot_app(args, recorder=recorder)
+    # Answers aren't shared between budgets
+    server.query_service.coalesce = False
+
+    budgets = [run_budget(server, recorder, int(b), args.rounds) for b in args.budgets.split(",")]
+    for result in budgets:
+        print(
+            f"budget={result['budget']:<6} prompt_tokens={result['mean_prompt_tokens']:>8.1f}  "
+            f"llm p50={result['generate']['p50_ms']:>7.1f}ms  p95={result['generate']['p95_ms']:>7.1f}ms  "
+            f"cost=${result['cost_usd']:.5f}"
+        )
+
+    results = {
+        "benchmark": "compression",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "rounds": args.rounds,
+            "llm_latency": args.llm_latency,
+            "llm_prompt_latency": args.llm_prompt_latency,
+            "seed": args.seed,
+        },
+        "budgets": budgets,
+    }
+    print(f"Results written to {write_results(results, output, prefix='compression')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Benchmark of retrieval over a growing corpus of synthetic policies, with & without a policy filter.
+
+Each synthetic policy is a copy of the processed travel health insurance policy with its own
+`policy_id` & product. For every corpus size the retriever is built from scratch, then the
+same questions are retrieved from the whole corpus & from one random policy.
+
+With a Qdrant server (`--qdrant-url`), filtered searches go through the `policy_id` payload
+index so their latency follows the size of one policy. Embedded Qdrant (the default) has no
+payload indexes & scans every point, so both latencies grow with the corpus.
+
+Usage (from the repository root):
+    python benchmarks/corpus_scaling.py
+    python benchmarks/corpus_scaling.py --policies 1,10,100 --queries 100
+    python benchmarks/corpus_scaling.py --qdrant-url http://localhost:6333
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List
+
+from fakes import LatencyModel, install_fakes, prepare_workdir
+from harness import summarize, write_results
+from replay import INSURANCE_QUESTIONS
+
+PRODUCTS = ["travel_health", "student_health", "family_health", "senior_health", "dental"]
+
+
+def write_synthetic_corpus(workdir: str, n_policies: int, base_dir: str) -> List[Dict]:
+    """Writes `n_policies` processed policies & the corpus manifest under `workdir`."""
+    from corpus import register_policy
+
+    elements = {}
+    for name in os.listdir(base_dir):
+        with open(os.path.join(base_dir, name), "r") as file:
+            elements[name] = json.load(file)
+
+    os.chdir(workdir)
+    policies = []
+    for i in range(n_policies):
+        policy_id, product = f"policy-{i:04d}", PRODUCTS[i % len(PRODUCTS)]
+        directory = os.path.join("data", "processed", policy_id)
+        os.makedirs(directory)
+        for name, content in elements.items():
+            if name.endswith("summaries.json"):
+                content = [f"Policy {policy_id} ({product}): {summary}" for summary in content]
+            with open(os.path.join(directory, name), "w") as file:
+                json.dump(content, file)
+        policies.append(register_policy(policy_id, product, processed_dir=directory))
+    return policies
+
+
+def run_size(n_policies: int, base_dir: str, queries: int, seed: int) -> Dict:
+    """Builds the retriever over `n_policies` policies & times unfiltered vs policy-filtered retrieval."""
+    from corpus import policy_filter
+    from retriever import build_retriever, to_qdrant_filter, with_policy_filter
+
+    workdir = tempfile.mkdtemp(prefix=f"hia-corpus-{n_policies}-")
+    policies = write_synthetic_corpus(workdir, n_policies, base_dir)
+
+    start = time.perf_counter()
+    retriever = build_retriever(vectorstore_collection_name=f"corpus_scaling_{n_policies}", corpus=policies)
+    build_seconds = time.perf_counter() - start
+    qdrant = retriever.vectorstore
+    points = qdrant.client.count(collection_name=qdrant.collection_name).count
+
+    rng = random.Random(seed)
+    unfiltered, filtered = [], []
+    leaked = 0
+    for _ in range(queries):
+        question = rng.choice(INSURANCE_QUESTIONS)
+        policy_id = rng.choice(policies)["policy_id"]
+        policy_retriever = with_policy_filter(retriever, policy_filter(policy_id=policy_id))
+
+        start = time.perf_counter()
+        retriever.invoke(question)
+        unfiltered.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        policy_retriever.invoke(question)
+        filtered.append(time.perf_counter() - start)
+
+        # Every filtered hit must belong to the requested policy
+        hits = qdrant.similarity_search(question, filter=to_qdrant_filter(retriever, {"policy_id": policy_id}))
+        leaked += sum(1 for hit in hits if hit.metadata.get("policy_id") != policy_id)
+
+    qdrant.client.close()
+    return {
+        "policies": n_policies,
+        "points": points,
+        "build_s": round(build_seconds, 3),
+        "unfiltered": summarize(unfiltered),
+        "filtered": summarize(filtered),
+        "leaked_hits": leaked,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--policies", default="1,10,100,500", help="Comma-separated corpus sizes")
+    parser.add_argument("--queries", type=int, default=50, help="Retrievals per corpus size & mode")
+    parser.add_argument("--qdrant-url", help="Qdrant server to use instead of embedded Qdrant")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/corpus_scaling-<time>.json)")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    sizes = [int(n) for n in args.policies.split(",")]
+
+    if args.qdrant_url:
+        os.environ["QDRANT_URL"] = args.qdrant_url
+
+    # Retrieval itself is measured, so the embedding calls are instantaneous
+    install_fakes(
+        llm_latency=LatencyModel("const:0"),
+        embedding_latency=LatencyModel("const:0"),
+        encoder_latency=LatencyModel("const:0"),
+    )
+    base = tempfile.mkdtemp(prefix="hia-corpus-base-")
+    prepare_workdir(base)
+    base_dir = os.path.join(base, "data", "processed")
+
+    import retriever  # noqa: F401 -- configures logging before it's quieted
+    logging.getLogger().setLevel(logging.WARNING)
+
+    levels = []
+    for n_policies in sizes:
+        level = run_size(n_policies, base_dir, args.queries, args.seed)
+        levels.append(level)
+        print(
+            f"{level['policies']:>4} policies {level['points']:>6} points  build {level['build_s']:>7.2f}s  "
+            f"unfiltered p50 {level['unfiltered']['p50_ms']:>7.2f} ms p95 {level['unfiltered']['p95_ms']:>7.2f} ms  "
+            f"filtered p50 {level['filtered']['p50_ms']:>7.2f} ms p95 {level['filtered']['p95_ms']:>7.2f} ms  "
+            f"leaked hits {level['leaked_hits']}"
+        )
+
+    results = {
+        "benchmark": "corpus_scaling",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "queries": args.queries,
+            "qdrant": args.qdrant_url or "embedded",
+            "seed": args.seed,
+        },
+        "levels": levels,
+    }
+    print(f"Results written to {write_results(results, output, prefix='corpus_scaling')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""Deterministic local stand-ins for the OpenAI backends used by the app.
+
+The fakes replace `ChatOpenAI`, `OpenAIEmbeddings`, `OpenAIEncoder` & the LangChain
+Hub prompt so the real `server.py` app can be exercised offline. Every fake sleeps
+for a latency drawn from a configurable `LatencyModel` to mimic network round trips.
+"""
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.pydantic_v1 import Field
+from semantic_router.encoders import BaseEncoder
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+APP_DIR = os.path.join(REPO_DIR, "app")
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class LatencyModel:
+    """Samples latencies (in seconds) from a distribution described by a spec string.
+
+    Supported specs (all values in milliseconds):
+        - `const:5`          -> always 5ms
+        - `uniform:2,8`      -> uniformly between 2ms & 8ms
+        - `normal:20,5`      -> mean 20ms, std 5ms (clipped at 0)
+        - `lognormal:20,0.5` -> median 20ms, sigma 0.5 (long right tail like real APIs)
+    """
+
+    def __init__(self, spec: str = "const:0", seed: int = 0):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",")] if params else [0.0]
+        if kind not in ("const", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        with self._lock:
+            if self.kind == "const":
+                ms = self.params[0]
+            elif self.kind == "uniform":
+                ms = self._random.uniform(self.params[0], self.params[1])
+            elif self.kind == "normal":
+                ms = max(0.0, self._random.gauss(self.params[0], self.params[1]))
+            else:
+                ms = self.params[0] * math.exp(self._random.gauss(0.0, self.params[1]))
+        return ms / 1000
+
+    def sleep(self) -> None:
+        delay = self.sample()
+        if delay > 0:
+            time.sleep(delay)
+
+    def __repr__(self) -> str:
+        return f"LatencyModel({self.spec!r})"
+
+
+def count_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for relative comparisons."""
+    return max(1, len(text) // 4)
+
+
+# OpenAI list prices in USD per million tokens (gpt-3.5-turbo, text-embedding-3-small & ada-002)
+PRICES_PER_MILLION_TOKENS = {
+    "llm_prompt": 0.5,
+    "llm_completion": 1.5,
+    "embeddings": 0.02,
+    "encoder": 0.10,
+}
+
+
+class UsageMeter:
+    """Counts the API calls & tokens the fakes would have billed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls = {"llm": 0, "embeddings": 0, "encoder": 0}
+            self.tokens = {key: 0 for key in PRICES_PER_MILLION_TOKENS}
+
+    def record(self, backend: str, **tokens: int) -> None:
+        with self._lock:
+            self.calls[backend] += 1
+            for key, count in tokens.items():
+                self.tokens[key] += count
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            cost = sum(self.tokens[key] * price / 1e6 for key, price in PRICES_PER_MILLION_TOKENS.items())
+            return {"calls": dict(self.calls), "tokens": dict(self.tokens), "cost_usd": round(cost, 6)}
+
+
+USAGE = UsageMeter()
+
+
+def hash_embed(text: str, dim: int = 256) -> List[float]:
+    """Deterministic bag-of-words embedding using signed feature hashing.
+
+    Texts sharing words get similar vectors, so routing & retrieval behave plausibly.
+    """
+    vector = [0.0] * dim
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[index] += sign
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeEmbeddings(Embeddings):
+    """Stand-in for `OpenAIEmbeddings`; one latency sample per API call, like a batched request."""
+
+    def __init__(self, latency: Optional[LatencyModel] = None, dim: int = 256, **kwargs: Any):
+        self.latency = latency or LatencyModel()
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.latency.sleep()
+        USAGE.record("embeddings", embeddings=sum(count_tokens(text) for text in texts))
+        return [hash_embed(text, self.dim) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.latency.sleep()
+        USAGE.record("embeddings", embeddings=count_tokens(text))
+        return hash_embed(text, self.dim)
+
+
+class FakeEncoder(BaseEncoder):
+    """Stand-in for semantic-router's `OpenAIEncoder`."""
+
+    name: str = "fake-encoder"
+    # Hashed bag-of-words similarities are much lower than OpenAI's, so is the threshold
+    score_threshold: float = 0.3
+    type: str = "fake"
+    dim: int = 256
+    latency: Any = None
+
+    def __call__(self, docs: List[str]) -> List[List[float]]:
+        if self.latency is not None:
+            self.latency.sleep()
+        USAGE.record("encoder", encoder=sum(count_tokens(doc) for doc in docs))
+        return [hash_embed(doc, self.dim) for doc in docs]
+
+
+class FakeChatModel(BaseChatModel):
+    """Stand-in for `ChatOpenAI` returning a deterministic answer derived from the prompt."""
+
+    model_name: str = Field(default="fake-gpt", alias="model")
+    temperature: float = 0.0
+    latency: Any = None
+    # Extra latency per 1k prompt tokens, as prompt processing grows with the prompt size
+    prompt_latency_ms_per_1k: float = 0.0
+
+    class Config:
+        allow_population_by_field_name = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency is not None:
+            self.latency.sleep()
+        prompt = "\n".join(str(m.content) for m in messages)
+        if self.prompt_latency_ms_per_1k:
+            time.sleep(count_tokens(prompt) / 1000 * self.prompt_latency_ms_per_1k / 1000)
+        digest = hashlib.sha1(prompt.encode()).hexdigest()[:12]
+        content = f"Fake answer {digest} based on {count_tokens(prompt)} prompt tokens."
+        token_usage = {
+            "prompt_tokens": count_tokens(prompt),
+            "completion_tokens": count_tokens(content),
+        }
+        token_usage["total_tokens"] = token_usage["prompt_tokens"] + token_usage["completion_tokens"]
+        USAGE.record(
+            "llm",
+            llm_prompt=token_usage["prompt_tokens"],
+            llm_completion=token_usage["completion_tokens"],
+        )
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))],
+            llm_output={"token_usage": token_usage, "model_name": self.model_name},
+        )
+
+
+def fake_rag_prompt() -> ChatPromptTemplate:
+    """Local equivalent of the `moraouf/simple_semi_structured_rag_qa_with_chat_history` Hub prompt."""
+    return ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "Answer the question based only on the following context, "
+                "which can include text and tables:\n\n{context}",
+            ),
+            MessagesPlaceholder(variable_name="chat_history"),
+            ("human", "{question}"),
+        ]
+    )
+
+
+def prepare_workdir(workdir: str, raw_elements_path: Optional[str] = None) -> None:
+    """Creates the `data/processed/*.json` files expected by `build_retriever` inside `workdir`.
+
+    Summaries are the leading characters of each element instead of LLM summaries, which
+    keeps the setup offline & deterministic.
+    """
+    raw_elements_path = raw_elements_path or os.path.join(REPO_DIR, "data", "raw_elements_chunked.json")
+    with open(raw_elements_path, "r") as file:
+        elements = json.load(file)
+
+    texts = [el["text"] for el in elements if el["type"] != "Table"]
+    tables = [el["text"] for el in elements if el["type"] == "Table"]
+    tables_html = [el["metadata"].get("text_as_html") for el in elements if el["type"] == "Table"]
+
+    processed = os.path.join(workdir, "data", "processed")
+    os.makedirs(processed, exist_ok=True)
+    outputs = {
+        "pdf_texts.json": texts,
+        "pdf_text_summaries.json": [t[:400] for t in texts],
+        "pdf_tables.json": tables,
+        "pdf_table_summaries.json": [t[:400] for t in tables],
+        "pdf_tables_html.json": tables_html,
+    }
+    for name, content in outputs.items():
+        with open(os.path.join(processed, name), "w") as file:
+            json.dump(content, file)
+
+
+def install_fakes(
+    llm_latency: LatencyModel,
+    embedding_latency: LatencyModel,
+    encoder_latency: LatencyModel,
+    llm_prompt_latency_ms_per_1k: float = 0.0,
+) -> None:
+    """Patches the OpenAI backends & LangChain Hub. Must run before any `app` module is imported."""
+    import langchain.hub
+    import langchain_openai
+    import semantic_router.encoders
+
+    langchain_openai.ChatOpenAI = lambda **kwargs: FakeChatModel(
+        latency=llm_latency, prompt_latency_ms_per_1k=llm_prompt_latency_ms_per_1k, **kwargs
+    )
+    langchain_openai.OpenAIEmbeddings = lambda **kwargs: FakeEmbeddings(latency=embedding_latency, **kwargs)
+    semantic_router.encoders.OpenAIEncoder = lambda **kwargs: FakeEncoder(latency=encoder_latency, **kwargs)
+    langchain.hub.pull = lambda *args, **kwargs: fake_rag_prompt()
+
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
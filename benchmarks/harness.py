@@ -0,0 +1,170 @@
+"""Shared plumbing for the offline benchmarks: app boot with fakes, stage timing & reporting."""
+import argparse
+import functools
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from fakes import FakeChatModel, LatencyModel, install_fakes, prepare_workdir
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Stages of `QueryService.query`, in execution order
+STAGES = ["route", "retrieve", "history_load", "generate", "history_write"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    return {
+        "count": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 3) if values else 0.0,
+        "p50_ms": round(1000 * percentile(values, 50), 3),
+        "p95_ms": round(1000 * percentile(values, 95), 3),
+        "p99_ms": round(1000 * percentile(values, 99), 3),
+    }
+
+
+class StageRecorder:
+    """Collects wall-clock durations per stage by wrapping the functions that implement them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.samples = defaultdict(list)
+
+    def wrap(self, owner: Any, attribute: str, stage: str) -> None:
+        """Replaces `owner.attribute` with a timed version of itself, or of its getter for a property."""
+        original = getattr(owner, attribute)
+        if isinstance(vars(owner).get(attribute), property):
+            original = vars(owner)[attribute].fget
+        # LangChain introspects the source & closure of wrapped callables, so avoid closing over `self`
+        record = self.record
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - start)
+
+        setattr(owner, attribute, property(timed) if isinstance(vars(owner).get(attribute), property) else timed)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {stage: summarize(self.samples.get(stage, [])) for stage in STAGES}
+
+
+def add_backend_args(parser: argparse.ArgumentParser) -> None:
+    """Adds the fake backend latency options shared by all benchmarks."""
+    parser.add_argument("--llm-latency", default="lognormal:400,0.35", help="ChatOpenAI latency spec (ms)")
+    parser.add_argument("--llm-prompt-latency", type=float, default=30.0, help="Extra ChatOpenAI latency per 1k prompt tokens (ms)")
+    parser.add_argument("--embedding-latency", default="lognormal:60,0.3", help="OpenAIEmbeddings latency spec (ms)")
+    parser.add_argument("--encoder-latency", default="lognormal:60,0.3", help="OpenAIEncoder latency spec (ms)")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def boot_app(args: argparse.Namespace, recorder: Optional[StageRecorder] = None) -> Any:
+    """Imports the real `server` module on top of fake backends in a throw-away working directory.
+
+    Returns:
+        The imported `server` module.
+    """
+    workdir = tempfile.mkdtemp(prefix="hia-bench-")
+    prepare_workdir(workdir)
+    os.chdir(workdir)
+
+    install_fakes(
+        llm_latency=LatencyModel(args.llm_latency, seed=args.seed),
+        embedding_latency=LatencyModel(args.embedding_latency, seed=args.seed + 1),
+        encoder_latency=LatencyModel(args.encoder_latency, seed=args.seed + 2),
+        llm_prompt_latency_ms_per_1k=args.llm_prompt_latency,
+    )
+
+    from chat_history import InstrumentedSQLChatMessageHistory
+    from retriever import TableAwareMultiVectorRetriever
+
+    if recorder is not None:
+        # The history itself is timed, as the staged queries (speculative or coalesced) don't
+        # go through `RunnableWithMessageHistory`. Each message is written separately.
+        recorder.wrap(InstrumentedSQLChatMessageHistory, "messages", "history_load")
+        recorder.wrap(InstrumentedSQLChatMessageHistory, "add_message", "history_write")
+        # The retriever of `build_retriever` overrides `MultiVectorRetriever._get_relevant_documents`
+        recorder.wrap(TableAwareMultiVectorRetriever, "_get_relevant_documents", "retrieve")
+        recorder.wrap(FakeChatModel, "_generate", "generate")
+
+    import query_service
+    import server
+
+    if recorder is not None:
+        recorder.wrap(query_service, "route_layer", "route")
+
+    # Per-request INFO logs would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Warm up once so table creation & lazy imports are not part of the measurements
+    server.query_service.query(question="How are you?", session_id="warmup")
+    if recorder is not None:
+        recorder.reset()
+
+    return server
+
+
+def write_results(results: Dict, output: Optional[str], prefix: str) -> str:
+    """Writes the results as JSON and returns the output path."""
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    return output
+
+
+def compare_results(current: Dict, baseline_path: str) -> List[str]:
+    """Lines describing the p50/p95 change of every stage against a baseline results file."""
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+
+    baseline_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    lines = []
+    for level in current.get("levels", []):
+        previous = baseline_levels.get(level["concurrency"])
+        if previous is None:
+            continue
+        for stage, stats in level["latency"].items():
+            before = previous["latency"].get(stage)
+            if not before or not before["p50_ms"]:
+                continue
+            lines.append(
+                f"c={level['concurrency']:<4} {stage:<14} "
+                f"p50 {before['p50_ms']:>9.1f} -> {stats['p50_ms']:>9.1f} ms  "
+                f"p95 {before['p95_ms']:>9.1f} -> {stats['p95_ms']:>9.1f} ms"
+            )
+        lines.append(
+            f"c={level['concurrency']:<4} throughput     "
+            f"{previous['throughput_rps']:.2f} -> {level['throughput_rps']:.2f} req/s"
+        )
+    return lines
+
@@ -0,0 +1,185 @@
+"""Benchmark of the chat history writes while the retention job compacts `rag_chat_history.db`.
+
+A database of synthetic sessions is created, half of them expired & some over the message
+cap. Writer threads then keep appending messages to the active sessions while the retention
+sweep deletes the expired & trimmed messages, then while VACUUM rewrites the database. The
+write latency of each phase is compared for several delete batch sizes, 0 deleting each
+step of the sweep in a single transaction.
+
+Usage (from the repository root):
+    python benchmarks/history_retention.py
+    python benchmarks/history_retention.py --sessions 10000 --batch-sizes 100,500,5000,0
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from fakes import APP_DIR
+from harness import summarize, write_results
+
+_ANSWER = (
+    "The policy covers emergency medical expenses, hospitalization & repatriation up to the limits "
+    "shown in the table of benefits, subject to the deductible & the general exclusions. "
+) * 3
+
+
+def populate(path: str, sessions: int, messages: int, expired_share: float, over_share: float,
+             max_messages: int, ttl: float, seed: int) -> List[str]:
+    """Creates the chat history database & returns the ids of its active sessions."""
+    from chat_history import SESSION_ACTIVITY_SCHEMA
+    from langchain_core.messages import AIMessage, HumanMessage, message_to_dict
+
+    rng = random.Random(seed)
+    now = time.time()
+    human = json.dumps(message_to_dict(HumanMessage(content="What is covered in case of emergency medical evacuation?")))
+    ai = json.dumps(message_to_dict(AIMessage(content=_ANSWER)))
+
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE message_store (id INTEGER NOT NULL, session_id TEXT, message TEXT, PRIMARY KEY (id))")
+    for statement in SESSION_ACTIVITY_SCHEMA:
+        connection.execute(statement)
+
+    active = []
+    for index in range(sessions):
+        session_id = f"session-{index}"
+        count = 2 * max_messages + messages if rng.random() < over_share else messages
+        expired = rng.random() < expired_share
+        last_active = now - ttl - 3600 if expired else now - rng.uniform(0, ttl / 2)
+        # Sessions interleave in real databases, which spreads their messages over the pages
+        rows = [(session_id, human if i % 2 == 0 else ai) for i in range(count)]
+        connection.executemany("INSERT INTO message_store (session_id, message) VALUES (?, ?)", rows)
+        connection.execute(
+            "INSERT INTO session_activity (session_id, last_active, message_count) VALUES (?, ?, ?)",
+            (session_id, last_active, count),
+        )
+        if not expired:
+            active.append(session_id)
+    connection.commit()
+    connection.close()
+    return active
+
+
+def run_batch_size(args: argparse.Namespace, batch_size: int) -> Dict:
+    """Writes continuously to the active sessions through a sweep & a VACUUM with the given batch size."""
+    from chat_history import get_session_history
+    from langchain_core.messages import AIMessage
+    from retention import HistoryRetention
+
+    workdir = tempfile.mkdtemp(prefix=f"hia-retention-{batch_size}-")
+    os.chdir(workdir)
+    path = os.path.join(workdir, "rag_chat_history.db")
+    active = populate(
+        path, args.sessions, args.messages, args.expired_share, args.over_share, args.max_messages, args.ttl, args.seed
+    )
+    size_before = os.path.getsize(path)
+
+    retention = HistoryRetention(
+        ttl=args.ttl,
+        max_messages=args.max_messages,
+        batch_size=batch_size or 10**9,
+        batch_pause=args.batch_pause if batch_size else 0.0,
+        archive_dir=os.path.join(workdir, "archive"),
+    )
+
+    phase = {"name": "idle"}
+    latencies: Dict[str, List[float]] = {"idle": [], "sweep": [], "vacuum": []}
+    stopped = threading.Event()
+
+    def writer(seed: int):
+        rng = random.Random(seed)
+        histories = [get_session_history(session_id) for session_id in rng.sample(active, 20)]
+        while not stopped.is_set():
+            name = phase["name"]
+            start = time.perf_counter()
+            rng.choice(histories).add_message(AIMessage(content=_ANSWER))
+            latencies[name].append(time.perf_counter() - start)
+            time.sleep(args.write_interval)
+
+    threads = [threading.Thread(target=writer, args=(args.seed + i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.idle)
+    phase["name"] = "sweep"
+    start = time.perf_counter()
+    stats = retention.sweep()
+    sweep_seconds = time.perf_counter() - start
+
+    phase["name"] = "vacuum"
+    start = time.perf_counter()
+    retention.maintain(force_vacuum=True)
+    vacuum_seconds = time.perf_counter() - start
+    stopped.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        "batch_size": batch_size or "unbatched",
+        "sweep": {**stats, "seconds": round(sweep_seconds, 3)},
+        "vacuum_s": round(vacuum_seconds, 3),
+        "db_mb": {"before": round(size_before / 1e6, 2), "after": round(os.path.getsize(path) / 1e6, 2)},
+        "write_latency": {
+            name: {**summarize(values), "max_ms": round(1000 * max(values), 3) if values else 0.0}
+            for name, values in latencies.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=4000)
+    parser.add_argument("--messages", type=int, default=20, help="Messages of a session under the cap")
+    parser.add_argument("--max-messages", type=int, default=100, help="Per-session message cap")
+    parser.add_argument("--expired-share", type=float, default=0.5, help="Share of expired sessions")
+    parser.add_argument("--over-share", type=float, default=0.1, help="Share of sessions over the message cap")
+    parser.add_argument("--ttl", type=float, default=30 * 24 * 3600, help="Session TTL (s)")
+    parser.add_argument("--batch-sizes", default="100,1000,0", help="Delete batch sizes, 0 for unbatched")
+    parser.add_argument("--batch-pause", type=float, default=0.01, help="Pause between delete batches (s)")
+    parser.add_argument("--writers", type=int, default=4, help="Writer threads")
+    parser.add_argument("--write-interval", type=float, default=0.005, help="Pause between two writes of a writer (s)")
+    parser.add_argument("--idle", type=float, default=2.0, help="Seconds of writes before the sweep")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/history_retention-<time>.json)")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    import retention  # noqa: F401 -- configures logging before it's quieted
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    levels = []
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        level = run_batch_size(args, batch_size)
+        levels.append(level)
+        latency = level["write_latency"]
+        print(
+            f"batch {str(level['batch_size']):>9}  sweep {level['sweep']['seconds']:>6.2f}s "
+            f"({level['sweep']['expired_messages'] + level['sweep']['trimmed_messages']} deleted)  "
+            f"vacuum {level['vacuum_s']:>5.2f}s  db {level['db_mb']['before']} -> {level['db_mb']['after']} MB  "
+            + "  ".join(
+                f"{name} p50 {stats['p50_ms']:>6.2f} p99 {stats['p99_ms']:>7.2f} max {stats['max_ms']:>7.1f} ms"
+                for name, stats in latency.items()
+            )
+        )
+
+    results = {
+        "benchmark": "history_retention",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "levels": levels,
+    }
+    print(f"Results written to {write_results(results, output, prefix='history_retention')}")
+
+
+if __name__ == "__main__":
+    main()
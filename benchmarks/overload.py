@@ -0,0 +1,131 @@
+"""Overload benchmark of the /chat admission control: open-loop traffic above the server capacity.
+
+Requests arrive at a fixed average rate (Poisson arrivals) regardless of how fast they are
+answered, like real users do. Above capacity, without admission control every request joins an
+ever growing backlog & the latency of all of them explodes. With admission control the queue
+& its deadline are bounded, so the admitted requests keep a bounded latency & the others are
+rejected fast with a 503 (or a 429 for the sessions over their rate limit).
+
+Modes:
+    - unbounded: same worker threads, unbounded queue & no rate limit (the former behavior)
+    - admission: bounded queue with a deadline & per-session rate limits
+    - degraded:  admission + degraded mode (answer cache & no chat history under pressure)
+
+Usage (from the repository root):
+    python benchmarks/overload.py --rate 30 --duration 10
+    python benchmarks/overload.py --llm-latency lognormal:1200,0.5 --workers 16 --max-queue 32
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from collections import Counter
+from typing import Dict, List
+
+import httpx
+
+from harness import add_backend_args, boot_app, summarize, write_results
+from replay import CHITCHAT_QUESTIONS, INSURANCE_QUESTIONS
+
+
+async def run_load(app, mode: str, rate: float, duration: float, hot_share: float, seed: int) -> Dict:
+    """Sends Poisson arrivals at `rate` requests per second for `duration` seconds & waits for all answers."""
+    rng = random.Random(seed)
+    questions = INSURANCE_QUESTIONS + CHITCHAT_QUESTIONS
+    results: List[tuple] = []
+
+    async def send(client: httpx.AsyncClient, index: int):
+        session_id = "hot-session" if rng.random() < hot_share else f"{mode}-{index}"
+        payload = {"input": {"session_id": session_id, "chat_history": [], "question": rng.choice(questions)}}
+        start = time.perf_counter()
+        response = await client.post("/chat/invoke", json=payload)
+        results.append((response.status_code, time.perf_counter() - start))
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        tasks = []
+        start = time.perf_counter()
+        index = 0
+        while time.perf_counter() - start < duration:
+            tasks.append(asyncio.create_task(send(client, index)))
+            index += 1
+            await asyncio.sleep(rng.expovariate(rate))
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - start
+
+    statuses = Counter(status for status, _ in results)
+    ok = [seconds for status, seconds in results if status == 200]
+    rejected = [seconds for status, seconds in results if status in (429, 503)]
+    return {
+        "mode": mode,
+        "requests": len(results),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "wall_s": round(wall, 3),
+        "goodput_rps": round(len(ok) / wall, 3) if wall else 0.0,
+        "ok_latency": {**summarize(ok), "max_ms": round(1000 * max(ok), 3) if ok else 0.0},
+        "rejected_latency": summarize(rejected),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=30.0, help="Offered load (requests/s)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of traffic per mode")
+    parser.add_argument("--workers", type=int, default=8, help="Requests answered at the same time")
+    parser.add_argument("--max-queue", type=int, default=16, help="Requests waiting for a worker")
+    parser.add_argument("--queue-timeout", type=float, default=1.0, help="Seconds a request may wait (s)")
+    parser.add_argument("--hot-share", type=float, default=0.1, help="Share of the requests sent by one session")
+    parser.add_argument("--modes", default="unbounded,admission,degraded")
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/overload-<time>.json)")
+    add_backend_args(parser)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    server = boot_app(args)
+    from admission import AnswerCache, RequestAdmission, SessionRateLimiter
+
+    modes = []
+    for mode in args.modes.split(","):
+        if mode == "unbounded":
+            server.admission = RequestAdmission(args.workers, max_queue=10**9, queue_timeout=10**9)
+            server.session_rate_limiter = SessionRateLimiter(rate=0)
+        else:
+            server.admission = RequestAdmission(args.workers, max_queue=args.max_queue, queue_timeout=args.queue_timeout)
+            server.session_rate_limiter = SessionRateLimiter()
+        # `admitted_query` reads these module globals on every request
+        server.DEGRADED_MODE = mode == "degraded"
+        server.DEGRADE_QUEUE_DEPTH = args.max_queue // 4
+        server.query_service.answer_cache = AnswerCache()
+
+        result = asyncio.run(run_load(server.app, mode, args.rate, args.duration, args.hot_share, args.seed))
+        modes.append(result)
+        ok = result["ok_latency"]
+        print(
+            f"{mode:<10} {result['requests']:>5} requests {result['statuses']}  goodput {result['goodput_rps']:>6.2f} req/s  "
+            f"200s p50 {ok['p50_ms']:>8.1f} p99 {ok['p99_ms']:>8.1f} max {ok['max_ms']:>8.1f} ms  "
+            f"rejections p99 {result['rejected_latency']['p99_ms']:>6.1f} ms"
+        )
+
+    results = {
+        "benchmark": "overload",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "rate": args.rate,
+            "duration": args.duration,
+            "workers": args.workers,
+            "max_queue": args.max_queue,
+            "queue_timeout": args.queue_timeout,
+            "hot_share": args.hot_share,
+            "llm_latency": args.llm_latency,
+            "embedding_latency": args.embedding_latency,
+            "encoder_latency": args.encoder_latency,
+            "seed": args.seed,
+        },
+        "modes": modes,
+    }
+    print(f"Results written to {write_results(results, output, prefix='overload')}")
+
+
+if __name__ == "__main__":
+    main()
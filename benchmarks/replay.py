@@ -0,0 +1,181 @@
+"""Offline end-to-end benchmark replaying chat requests against the real `server.py` app.
+
+The OpenAI backends are replaced by the deterministic fakes in `fakes.py`, so runs cost
+nothing and are repeatable. Requests go through the `/chat/invoke` LangServe endpoint.
+
+Usage (from the repository root):
+    python benchmarks/replay.py --sessions 20 --turns 4 --concurrency 1,4,16
+    python benchmarks/replay.py --requests chat_log.jsonl --repeat 5 --llm-latency lognormal:800,0.4
+    python benchmarks/replay.py --compare benchmarks/results/replay-20240301-101500.json
+
+A request log is a JSONL file where each line holds a `question` (or `body`) and an
+optional `session_id`; turns sharing a session id are replayed in order.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+import httpx
+
+from harness import (
+    StageRecorder,
+    add_backend_args,
+    boot_app,
+    compare_results,
+    summarize,
+    write_results,
+)
+
+INSURANCE_QUESTIONS = [
+    "Who is the provider of the insurance?",
+    "What does the travel healthcare insurance policy cover?",
+    "What are the benefits in case of accidental death?",
+    "How do I file a claim?",
+    "Is emergency medical evacuation covered?",
+    "What is the maximum amount covered for medical expenses?",
+    "What are the general exclusions of the policy?",
+    "What happens if my baggage is delayed?",
+]
+
+CHITCHAT_QUESTIONS = [
+    "How are you?",
+    "What is your name?",
+    "How's the weather today?",
+    "Thanks, that was helpful!",
+]
+
+
+def load_request_log(path: str, repeat: int = 1) -> List[List[str]]:
+    """Groups the questions of a JSONL request log into sessions, preserving turn order."""
+    sessions: Dict[str, List[str]] = OrderedDict()
+    with open(path, "r") as file:
+        for line_number, line in enumerate(file):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            question = record.get("question") or record.get("body")
+            if not question:
+                continue
+            session_id = record.get("session_id") or f"line-{line_number}"
+            sessions.setdefault(session_id, []).append(question)
+    return list(sessions.values()) * repeat
+
+
+def synthetic_sessions(n_sessions: int, turns: int, chitchat_ratio: float, seed: int) -> List[List[str]]:
+    """Random sessions mixing insurance & chitchat questions."""
+    rng = random.Random(seed)
+    return [
+        [
+            rng.choice(CHITCHAT_QUESTIONS if rng.random() < chitchat_ratio else INSURANCE_QUESTIONS)
+            for _ in range(turns)
+        ]
+        for _ in range(n_sessions)
+    ]
+
+
+async def run_level(app, sessions: List[List[str]], concurrency: int, run_id: str) -> Dict:
+    """Replays all sessions with `concurrency` sessions in flight at any time."""
+    queue: asyncio.Queue = asyncio.Queue()
+    for index, turns in enumerate(sessions):
+        queue.put_nowait((f"{run_id}-c{concurrency}-{index}", turns))
+
+    latencies: List[float] = []
+    errors = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        while not queue.empty():
+            session_id, turns = queue.get_nowait()
+            for question in turns:
+                payload = {"input": {"session_id": session_id, "chat_history": [], "question": question}}
+                start = time.perf_counter()
+                response = await client.post("/chat/invoke", json=payload)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 3) if duration else 0.0,
+        "latency": {"end_to_end": summarize(latencies)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", help="JSONL request log to replay (default: synthetic sessions)")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the request log this many times")
+    parser.add_argument("--sessions", type=int, default=16, help="Number of synthetic sessions")
+    parser.add_argument("--turns", type=int, default=3, help="Turns per synthetic session")
+    parser.add_argument("--chitchat-ratio", type=float, default=0.25)
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency levels")
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/replay-<time>.json)")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    add_backend_args(parser)
+    args = parser.parse_args()
+
+    # Resolve paths before `boot_app` moves to its working directory
+    request_log = os.path.abspath(args.requests) if args.requests else None
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    if request_log:
+        sessions = load_request_log(request_log, repeat=args.repeat)
+    else:
+        sessions = synthetic_sessions(args.sessions, args.turns, args.chitchat_ratio, args.seed)
+
+    recorder = StageRecorder()
+    server = boot_app(args, recorder=recorder)
+
+    run_id = time.strftime("%H%M%S")
+    levels = []
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        recorder.reset()
+        level = asyncio.run(run_level(server.app, sessions, concurrency, run_id))
+        level["latency"].update(recorder.report())
+        levels.append(level)
+        print(
+            f"concurrency={concurrency:<4} requests={level['requests']:<5} errors={level['errors']:<3} "
+            f"throughput={level['throughput_rps']:.2f} req/s  "
+            f"p50={level['latency']['end_to_end']['p50_ms']:.1f}ms  "
+            f"p95={level['latency']['end_to_end']['p95_ms']:.1f}ms  "
+            f"p99={level['latency']['end_to_end']['p99_ms']:.1f}ms"
+        )
+
+    results = {
+        "benchmark": "replay",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "requests": request_log,
+            "sessions": len(sessions),
+            "llm_latency": args.llm_latency,
+            "embedding_latency": args.embedding_latency,
+            "encoder_latency": args.encoder_latency,
+            "seed": args.seed,
+        },
+        "levels": levels,
+    }
+
+    output = write_results(results, output, prefix="replay")
+    print(f"Results written to {output}")
+
+    if baseline:
+        print("\n".join(compare_results(results, baseline)))
+
+
+if __name__ == "__main__":
+    main()
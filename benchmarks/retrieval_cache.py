@@ -0,0 +1,167 @@
+"""Benchmark of the retrieval cache on repeated & paraphrased questions.
+
+The retriever is built over a synthetic corpus (see `corpus_scaling.py`), then the same stream
+of questions is retrieved without & with the cache. The stream mixes the insurance questions,
+paraphrases of them & questions seen only once. Each retrieval with the cache is checked
+against the documents retrieved without it. Finally the index is rebuilt with the same cache,
+once with the same policies, whose cached retrievals remain valid, then without one policy, to
+check that no retrieval of the previous index is served anymore.
+
+The fake embeddings are hashed bags of words, so a paraphrase here keeps the words of the
+question (case, punctuation, word order or a filler word change). With OpenAI embeddings,
+reworded paraphrases land in the same SimHash buckets as well.
+
+Usage (from the repository root):
+    python benchmarks/retrieval_cache.py
+    python benchmarks/retrieval_cache.py --policies 100 --queries 2000 --min-similarity 0.9
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List
+
+from corpus_scaling import write_synthetic_corpus
+from fakes import LatencyModel, install_fakes, prepare_workdir
+from harness import summarize, write_results
+from replay import INSURANCE_QUESTIONS
+
+
+def paraphrase(question: str, rng: random.Random) -> str:
+    """A rewording of `question` keeping its words, with at most one filler word."""
+    words = question.rstrip("?").split()
+    variants = [
+        question.lower().rstrip("?"),
+        "  ".join(words).upper() + " ?",
+        " ".join(words[1:] + words[:1]) + "?",
+        f"{question} please",
+    ]
+    return rng.choice(variants)
+
+
+def question_stream(n: int, repeat_share: float, paraphrase_share: float, rng: random.Random) -> List[str]:
+    """Questions repeated verbatim, paraphrased, or asked once."""
+    questions = []
+    for i in range(n):
+        draw = rng.random()
+        question = rng.choice(INSURANCE_QUESTIONS)
+        if draw < repeat_share:
+            questions.append(question)
+        elif draw < repeat_share + paraphrase_share:
+            questions.append(paraphrase(question, rng))
+        else:
+            questions.append(f"{question.rstrip('?')} for trip {i} to {rng.choice(['Spain', 'Japan', 'Peru', 'Kenya'])}?")
+    return questions
+
+
+def timed_retrievals(retriever, questions: List[str]) -> Dict:
+    latencies, results = [], []
+    for question in questions:
+        start = time.perf_counter()
+        results.append(retriever.invoke(question))
+        latencies.append(time.perf_counter() - start)
+    return {"latencies": latencies, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--policies", type=int, default=50, help="Policies of the synthetic corpus")
+    parser.add_argument("--queries", type=int, default=1000, help="Questions of the stream")
+    parser.add_argument("--repeat-share", type=float, default=0.4, help="Share of verbatim repeats")
+    parser.add_argument("--paraphrase-share", type=float, default=0.3, help="Share of paraphrases")
+    parser.add_argument("--cache-size", type=int, default=2048)
+    parser.add_argument("--min-similarity", type=float, default=0.95)
+    parser.add_argument("--embedding-latency", default="const:0", help="OpenAIEmbeddings latency spec (ms)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/retrieval_cache-<time>.json)")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    install_fakes(
+        llm_latency=LatencyModel("const:0"),
+        embedding_latency=LatencyModel(args.embedding_latency, seed=args.seed),
+        encoder_latency=LatencyModel("const:0"),
+    )
+    base = tempfile.mkdtemp(prefix="hia-retrieval-cache-base-")
+    prepare_workdir(base)
+    # The Qdrant files & the docstore of the retriever are created in the working directory
+    os.chdir(base)
+    base_dir = os.path.join(base, "data", "processed")
+
+    import retriever as retriever_module  # noqa: F401 -- configures logging before it's quieted
+    from retrieval_cache import RetrievalCache
+    logging.getLogger().setLevel(logging.WARNING)
+
+    policies = write_synthetic_corpus(tempfile.mkdtemp(prefix="hia-retrieval-cache-"), args.policies, base_dir)
+    cache = RetrievalCache(max_size=args.cache_size, min_similarity=args.min_similarity)
+    retriever = retriever_module.build_retriever("retrieval_cache", corpus=policies, cache=None)
+    questions = question_stream(args.queries, args.repeat_share, args.paraphrase_share, random.Random(args.seed))
+
+    uncached = timed_retrievals(retriever, questions)
+    retriever.cache = cache
+    searches = {"count": 0}
+    search_by_vector = retriever.vectorstore.similarity_search_by_vector
+
+    def counted_search(*search_args, **search_kwargs):
+        searches["count"] += 1
+        return search_by_vector(*search_args, **search_kwargs)
+
+    retriever.vectorstore.similarity_search_by_vector = counted_search
+    cached = timed_retrievals(retriever, questions)
+    hits = len(questions) - searches["count"]
+    # Hits whose documents differ from a search of their own question
+    mismatches = sum(1 for a, b in zip(uncached["results"], cached["results"]) if a != b)
+
+    def rebuilt_hits(corpus: List[Dict]) -> int:
+        """Insurance questions answered from the cache by a retriever rebuilt over `corpus`."""
+        rebuilt = retriever_module.build_retriever("retrieval_cache", corpus=corpus, cache=cache)
+        search_by_vector = rebuilt.vectorstore.similarity_search_by_vector
+        misses = {"count": 0}
+
+        def counted_search(*search_args, **search_kwargs):
+            misses["count"] += 1
+            return search_by_vector(*search_args, **search_kwargs)
+
+        rebuilt.vectorstore.similarity_search_by_vector = counted_search
+        for question in INSURANCE_QUESTIONS:
+            rebuilt.invoke(question)
+        # Embedded Qdrant allows one client per storage folder
+        rebuilt.vectorstore.client.close()
+        return len(INSURANCE_QUESTIONS) - misses["count"]
+
+    retriever.vectorstore.client.close()
+    # The same policies keep their doc ids & the index its version, the cached retrievals remain valid
+    same_corpus_hits = rebuilt_hits(policies)
+    # Without a policy, the retrievals of the previous index must not be served anymore
+    changed_corpus_hits = rebuilt_hits(policies[:-1])
+
+    results = {
+        "benchmark": "retrieval_cache",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "hit_ratio": round(hits / len(questions), 4),
+        "qdrant_searches": {"uncached": len(questions), "cached": searches["count"]},
+        "mismatched_results": mismatches,
+        "hits_after_same_corpus_rebuild": same_corpus_hits,
+        "hits_after_changed_corpus_rebuild": changed_corpus_hits,
+        "uncached": summarize(uncached["latencies"]),
+        "cached": summarize(cached["latencies"]),
+    }
+    print(
+        f"{args.policies} policies, {len(questions)} questions: hit ratio {results['hit_ratio']:.1%}, "
+        f"{searches['count']} Qdrant searches instead of {len(questions)}, {mismatches} results differing from an uncached search"
+    )
+    for mode in ("uncached", "cached"):
+        stats = results[mode]
+        print(f"{mode:<9} p50 {stats['p50_ms']:>7.2f} ms  p95 {stats['p95_ms']:>7.2f} ms  p99 {stats['p99_ms']:>7.2f} ms  mean {stats['mean_ms']:>7.2f} ms")
+    print(
+        f"After rebuilds: {same_corpus_hits}/{len(INSURANCE_QUESTIONS)} insurance questions served from the cache "
+        f"with the same policies, {changed_corpus_hits} after a policy was removed"
+    )
+    print(f"Results written to {write_results(results, output, prefix='retrieval_cache')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark of speculative routing: sequential vs speculative `QueryService.query`.
+
+In speculative mode retrieval & history loading start at the same time as routing, so on
+the RAG path the router latency overlaps with the retrieval latency instead of adding up.
+
+Usage (from the repository root):
+    python benchmarks/speculative.py --rounds 5
+    python benchmarks/speculative.py --encoder-latency lognormal:150,0.3 --embedding-latency lognormal:150,0.3
+"""
+import argparse
+import os
+import time
+from typing import Dict, List
+
+from harness import add_backend_args, boot_app, summarize, write_results
+from replay import CHITCHAT_QUESTIONS, INSURANCE_QUESTIONS
+
+
+def question_routes(questions: List[str]) -> Dict[str, str]:
+    """Route actually taken by each question, as `QueryService` labels it."""
+    from router import route_layer
+
+    return {
+        question: "healthcare_insurance" if route_layer(question).name == "healthcare_insurance" else "chitchat"
+        for question in questions
+    }
+
+
+def run_mode(query_service, speculative: bool, rounds: int, routes: Dict[str, str]) -> Dict[str, Dict[str, float]]:
+    """Queries every question `rounds` times one after the other & summarizes the latencies per route taken."""
+    query_service.speculative = speculative
+    latencies: Dict[str, List[float]] = {"healthcare_insurance": [], "chitchat": []}
+    for round_index in range(rounds):
+        session_id = f"{'speculative' if speculative else 'sequential'}-{round_index}"
+        for question, route in routes.items():
+            start = time.perf_counter()
+            query_service.query(question=question, session_id=session_id)
+            latencies[route].append(time.perf_counter() - start)
+    return {route: summarize(values) for route, values in latencies.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5, help="Times each question is asked per mode")
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/speculative-<time>.json)")
+    add_backend_args(parser)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    server = boot_app(args)
+    query_service = server.query_service
+    # Insurance questions the router sends to `chitchat` (or no route) don't run the RAG path
+    routes = question_routes(INSURANCE_QUESTIONS + CHITCHAT_QUESTIONS)
+
+    modes = {
+        "sequential": run_mode(query_service, speculative=False, rounds=args.rounds, routes=routes),
+        "speculative": run_mode(query_service, speculative=True, rounds=args.rounds, routes=routes),
+    }
+
+    for route in ("healthcare_insurance", "chitchat"):
+        before, after = modes["sequential"][route], modes["speculative"][route]
+        reduction = 100 * (1 - after["p50_ms"] / before["p50_ms"]) if before["p50_ms"] else 0.0
+        print(
+            f"{route:<22} p50 {before['p50_ms']:>8.1f} -> {after['p50_ms']:>8.1f} ms ({reduction:.1f}% reduction)  "
+            f"p95 {before['p95_ms']:>8.1f} -> {after['p95_ms']:>8.1f} ms"
+        )
+
+    results = {
+        "benchmark": "speculative",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "rounds": args.rounds,
+            "llm_latency": args.llm_latency,
+            "embedding_latency": args.embedding_latency,
+            "encoder_latency": args.encoder_latency,
+            "seed": args.seed,
+        },
+        "routes": routes,
+        "modes": modes,
+    }
+    print(f"Results written to {write_results(results, output, prefix='speculative')}")
+
+
+if __name__ == "__main__":
+    main()
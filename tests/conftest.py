@@ -0,0 +1,29 @@
+"""Boots the real app on the fake OpenAI backends of `benchmarks/fakes.py` for the tests."""
+import argparse
+import os
+import sys
+
+import pytest
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+if BENCHMARKS_DIR not in sys.path:
+    sys.path.insert(0, BENCHMARKS_DIR)
+
+from harness import add_backend_args, boot_app  # noqa: E402
+
+# The app modules build the chains on import, so the app boots in a throw-away working directory
+# with instantaneous fakes before the test modules import them
+_parser = argparse.ArgumentParser()
+add_backend_args(_parser)
+_server = boot_app(_parser.parse_args([
+    "--llm-latency", "const:0",
+    "--llm-prompt-latency", "0",
+    "--embedding-latency", "const:0",
+    "--encoder-latency", "const:0",
+]))
+
+
+@pytest.fixture(scope="session")
+def server():
+    """The imported `server` module."""
+    return _server
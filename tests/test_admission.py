@@ -0,0 +1,284 @@
+import asyncio
+import threading
+import time
+import uuid
+
+import httpx
+import pytest
+
+from admission import Rejected, RequestAdmission, SessionRateLimiter, StageLimiter, TokenBucket
+
+QUESTION = "Who is the provider of the insurance?"
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=2.0, burst=3)
+    bucket.updated = 100.0
+
+    assert [bucket.take(100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(100.0) == pytest.approx(0.5)
+    # Half a token refilled after 0.25s, the next one comes 0.25s later
+    assert bucket.take(100.25) == pytest.approx(0.25)
+    assert bucket.take(100.5) == 0.0
+    # Never more than `burst` tokens, however long the bucket was idle
+    assert [bucket.take(1000.0) for _ in range(4)][-1] == pytest.approx(0.5)
+
+
+def test_session_rate_limiter_rejects_each_session_separately():
+    limiter = SessionRateLimiter(rate=1.0, burst=2)
+    limiter.check("a")
+    limiter.check("a")
+
+    with pytest.raises(Rejected) as rejected:
+        limiter.check("a")
+    limiter.check("b")
+
+    assert (rejected.value.status_code, rejected.value.reason) == (429, "rate_limited")
+    assert 0 < rejected.value.retry_after <= 1.0
+
+
+def test_stage_limiter_rejects_when_its_queue_is_full():
+    limiter = StageLimiter("generate", max_concurrency=1, max_queue=0, queue_timeout=5.0)
+    limiter.acquire()
+
+    with pytest.raises(Rejected) as rejected:
+        limiter.acquire()
+
+    assert (rejected.value.status_code, rejected.value.reason, rejected.value.retry_after) == (503, "queue_full", 5.0)
+    limiter.release()
+    with limiter.slot():
+        assert limiter.in_flight == 1
+    assert limiter.in_flight == 0
+
+
+def test_stage_limiter_times_out_waiting_for_a_slot():
+    limiter = StageLimiter("generate", max_concurrency=1, max_queue=1, queue_timeout=0.1)
+    limiter.acquire()
+
+    start = time.monotonic()
+    with pytest.raises(Rejected) as rejected:
+        limiter.acquire()
+
+    assert rejected.value.reason == "queue_timeout"
+    assert 0.1 <= time.monotonic() - start < 1.0
+    assert limiter.queued == 0
+
+
+def test_stage_limiter_admits_a_waiting_thread_once_a_slot_is_released():
+    limiter = StageLimiter("generate", max_concurrency=1, max_queue=1, queue_timeout=5.0)
+    limiter.acquire()
+    waiting = threading.Thread(target=limiter.acquire)
+    waiting.start()
+    while limiter.queued == 0:
+        time.sleep(0.001)
+
+    limiter.release()
+    waiting.join(timeout=5)
+
+    assert not waiting.is_alive()
+    assert (limiter.in_flight, limiter.queued) == (1, 0)
+
+
+def test_request_deadline_bounds_the_stage_queues():
+    # The stage would wait 10s for a slot, the request only has 0.2s left
+    limiter = StageLimiter("generate", max_concurrency=1, max_queue=1, queue_timeout=10.0)
+    limiter.acquire()
+    admission = RequestAdmission(max_in_flight=1, max_queue=0, queue_timeout=0.2)
+
+    start = time.monotonic()
+    with pytest.raises(Rejected) as rejected:
+        asyncio.run(admission.run(limiter.acquire))
+
+    assert rejected.value.reason == "queue_timeout"
+    assert time.monotonic() - start < 1.0
+
+
+def test_request_admission_rejects_when_full_or_too_late():
+    admission = RequestAdmission(max_in_flight=1, max_queue=1, queue_timeout=0.1)
+    release = threading.Event()
+
+    async def scenario():
+        busy = asyncio.ensure_future(admission.run(release.wait, 10))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(admission.run(lambda: "queued"))
+        await asyncio.sleep(0)
+        rejections = []
+        for request in (admission.run(lambda: "full"), queued):
+            try:
+                await request
+            except Rejected as error:
+                rejections.append(error.reason)
+        release.set()
+        return rejections, await busy, await admission.run(lambda: "after")
+
+    rejections, busy, after = asyncio.run(scenario())
+
+    assert rejections == ["queue_full", "queue_timeout"]
+    assert (busy, after) == (True, "after")
+    assert (admission.in_flight, admission.queued) == (0, 0)
+
+
+async def invoke_all(app, session_ids) -> list:
+    """Sends a /chat/invoke per session id at once, returns their responses & latencies."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        async def invoke(session_id):
+            start = time.perf_counter()
+            payload = {"input": {"question": QUESTION, "session_id": session_id, "chat_history": []}}
+            response = await client.post("/chat/invoke", json=payload)
+            return response, time.perf_counter() - start
+
+        return await asyncio.gather(*(invoke(session_id) for session_id in session_ids))
+
+
+@pytest.fixture
+def slow_llm(monkeypatch):
+    """Fake LLM answering in `latency["seconds"]`, 0.3s unless changed by the test."""
+    from fakes import FakeChatModel
+
+    generate = FakeChatModel._generate
+    latency = {"seconds": 0.3}
+
+    def slow_generate(self, *args, **kwargs):
+        time.sleep(latency["seconds"])
+        return generate(self, *args, **kwargs)
+
+    monkeypatch.setattr(FakeChatModel, "_generate", slow_generate)
+    return latency
+
+
+def test_chat_rate_limited_session_gets_429(server, monkeypatch):
+    monkeypatch.setattr(server, "session_rate_limiter", SessionRateLimiter(rate=0.5, burst=1))
+    monkeypatch.setattr(server, "admission", RequestAdmission(max_in_flight=2, max_queue=2, queue_timeout=1.0))
+    session_id = f"rate-limited-{uuid.uuid4().hex}"
+
+    (first, _), = asyncio.run(invoke_all(server.app, [session_id]))
+    (second, _), = asyncio.run(invoke_all(server.app, [session_id]))
+
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert second.json()["detail"] == "rate_limited"
+    assert second.headers["Retry-After"] == "2"
+
+
+def test_chat_burst_is_shed_with_503_and_bounded_latency(server, monkeypatch, slow_llm):
+    queue_timeout = 1.0
+    slow_llm["seconds"] = 0.2
+    monkeypatch.setattr(server, "session_rate_limiter", SessionRateLimiter(rate=1.0, burst=1))
+    monkeypatch.setattr(server, "admission", RequestAdmission(max_in_flight=2, max_queue=2, queue_timeout=queue_timeout))
+    monkeypatch.setattr(server.query_service, "speculative", False)
+
+    results = asyncio.run(invoke_all(server.app, [f"burst-{uuid.uuid4().hex}" for _ in range(10)]))
+
+    answered = [latency for response, latency in results if response.status_code == 200]
+    rejected = [response for response, _ in results if response.status_code == 503]
+    # 2 requests run, 2 wait for them: less than the queue timeout
+    assert len(answered) == 4
+    assert len(rejected) == 6
+    assert {response.json()["detail"] for response in rejected} == {"queue_full"}
+    assert {response.headers["Retry-After"] for response in rejected} == {"1"}
+    # Queued requests waited less than the queue timeout on top of the time of an unqueued one,
+    # rejected ones didn't wait
+    assert max(answered) - min(answered) < queue_timeout
+    assert max(latency for response, latency in results if response.status_code == 503) < min(answered)
+
+
+def test_chat_queued_past_the_timeout_gets_503(server, monkeypatch, slow_llm):
+    queue_timeout = 0.2
+    slow_llm["seconds"] = 1.0
+    monkeypatch.setattr(server, "session_rate_limiter", SessionRateLimiter(rate=1.0, burst=1))
+    monkeypatch.setattr(server, "admission", RequestAdmission(max_in_flight=1, max_queue=1, queue_timeout=queue_timeout))
+    monkeypatch.setattr(server.query_service, "speculative", False)
+
+    results = asyncio.run(invoke_all(server.app, [f"timeout-{uuid.uuid4().hex}" for _ in range(2)]))
+
+    statuses = sorted(response.status_code for response, _ in results)
+    timed_out = next((response, latency) for response, latency in results if response.status_code == 503)
+    assert statuses == [200, 503]
+    assert timed_out[0].json()["detail"] == "queue_timeout"
+    assert queue_timeout <= timed_out[1] < slow_llm["seconds"]
+
+
+def wait_for_waiters(limiter: StageLimiter, waiters: int) -> None:
+    while limiter.queued < waiters:
+        time.sleep(0.001)
+
+
+def test_stage_limiter_serves_waiters_first_come_first_served():
+    limiter = StageLimiter("generate", max_concurrency=1, max_queue=3, queue_timeout=5.0)
+    limiter.acquire()
+    order = []
+
+    def wait(name):
+        with limiter.slot():
+            order.append(name)
+
+    threads = []
+    for name in ("first", "second", "third"):
+        threads.append(threading.Thread(target=wait, args=(name,)))
+        threads[-1].start()
+        wait_for_waiters(limiter, len(threads))
+    limiter.release()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == ["first", "second", "third"]
+
+
+def test_stage_limiter_new_thread_queues_behind_the_waiters():
+    limiter = StageLimiter("generate", max_concurrency=1, max_queue=2, queue_timeout=0.2)
+    limiter.acquire()
+    release = threading.Event()
+
+    def hold():
+        with limiter.slot():
+            release.wait(5)
+
+    waiter = threading.Thread(target=hold)
+    waiter.start()
+    wait_for_waiters(limiter, 1)
+
+    # The freed slot goes to the waiter, not to the thread arriving right after the release
+    limiter.release()
+    with pytest.raises(Rejected) as rejected:
+        limiter.acquire()
+    release.set()
+    waiter.join(timeout=5)
+
+    assert rejected.value.reason == "queue_timeout"
+    assert (limiter.in_flight, limiter.queued) == (0, 0)
+
+
+@pytest.fixture
+def query_service_factory(server):
+    from query_service import QueryService
+
+    def factory(**kwargs):
+        return QueryService(**{"speculative": False, "coalesce": False, "stage_limiters": {}, **kwargs})
+    return factory
+
+
+@pytest.mark.parametrize("speculative", [False, True])
+def test_retrieve_limit_applies_without_staged_modes(query_service_factory, speculative):
+    # The only retrieval slot is taken & nobody may wait for it
+    limiter = StageLimiter("retrieve", max_concurrency=1, max_queue=0, queue_timeout=1.0)
+    limiter.acquire()
+    query_service = query_service_factory(speculative=speculative, stage_limiters={"retrieve": limiter})
+
+    with pytest.raises(Rejected) as rejected:
+        query_service.query(question=QUESTION, session_id=f"retrieve-limit-{uuid.uuid4().hex}")
+
+    assert rejected.value.reason == "queue_full"
+
+
+def test_chain_answers_of_sessions_without_history_fill_the_answer_cache(query_service_factory):
+    query_service = query_service_factory()
+    session_id = f"answer-cache-{uuid.uuid4().hex}"
+
+    answer = query_service.query(question=QUESTION, session_id=session_id)
+    query_service.query(question="What are the general exclusions of the policy?", session_id=session_id)
+
+    assert query_service.cached_answer(QUESTION) == answer
+    # The second answer depended on the history of the session
+    assert query_service.cached_answer("What are the general exclusions of the policy?") is None
+    assert len(query_service.answer_cache) == 1
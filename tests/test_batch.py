@@ -0,0 +1,110 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+
+from admission import RequestAdmission, SessionRateLimiter, StageLimiter
+from query_service import BATCH_MAX_CONCURRENCY, BATCH_MAX_SIZE
+
+QUESTIONS = ["Who is the provider of the insurance?", "How are you?", "What are the general exclusions of the policy?"]
+
+
+async def post(app, path: str, payload: dict) -> httpx.Response:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        return await client.post(path, json=payload)
+
+
+def requests_total(route: str) -> float:
+    return REGISTRY.get_sample_value("hia_requests_total", {"route": route}) or 0.0
+
+
+@pytest.fixture
+def batch_server(server, monkeypatch):
+    monkeypatch.setattr(server, "admission", RequestAdmission(max_in_flight=2, max_queue=2, queue_timeout=1.0))
+    monkeypatch.setattr(server, "session_rate_limiter", SessionRateLimiter(rate=1.0, burst=2))
+    return server
+
+
+def test_batch_answers_every_question(batch_server):
+    routes = ("chitchat", "healthcare_insurance", "batch")
+    before = {route: requests_total(route) for route in routes}
+
+    response = asyncio.run(post(batch_server.app, "/chat/batch", {"inputs": [{"question": q} for q in QUESTIONS]}))
+
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(result["index"] for result in results) == [0, 1, 2]
+    assert all("answer" in result for result in results)
+    # One query per question, none for the shared routing & retrieval
+    counted = {route: requests_total(route) - before[route] for route in routes}
+    assert counted["chitchat"] + counted["healthcare_insurance"] == len(QUESTIONS)
+    assert counted["batch"] == 0
+
+
+@pytest.mark.parametrize("payload", [
+    {"inputs": [{"question": "How are you?"}] * (BATCH_MAX_SIZE + 1)},
+    {"inputs": [{"question": "How are you?"}], "max_concurrency": BATCH_MAX_CONCURRENCY + 1},
+    {"inputs": [{"question": "How are you?"}], "max_concurrency": 0},
+])
+def test_batch_size_and_concurrency_are_bounded(batch_server, payload):
+    assert asyncio.run(post(batch_server.app, "/chat/batch", payload)).status_code == 422
+
+
+def test_batch_questions_count_against_the_session_rate_limit(batch_server):
+    inputs = [{"question": "How are you?", "session_id": "batch-rate-limited"}] * 3
+
+    response = asyncio.run(post(batch_server.app, "/chat/batch", {"inputs": inputs}))
+
+    assert response.status_code == 429
+    assert response.json()["detail"] == "rate_limited"
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_batch_is_rejected_when_the_admission_queue_is_full(batch_server, monkeypatch):
+    monkeypatch.setattr(batch_server, "admission", RequestAdmission(max_in_flight=1, max_queue=0, queue_timeout=1.0))
+    release = threading.Event()
+
+    async def scenario():
+        # Hold the only worker
+        deadline = await batch_server.admission.admit()
+        busy = batch_server.admission.submit(deadline, release.wait, 10)
+        try:
+            return await post(batch_server.app, "/chat/batch", {"inputs": [{"question": "How are you?"}]})
+        finally:
+            release.set()
+            await busy
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 503
+    assert response.json()["detail"] == "queue_full"
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_batch_questions_are_not_bound_by_the_admission_deadline(batch_server, monkeypatch):
+    from fakes import FakeChatModel
+
+    generate = FakeChatModel._generate
+
+    def slow_generate(self, *args, **kwargs):
+        time.sleep(0.2)
+        return generate(self, *args, **kwargs)
+
+    monkeypatch.setattr(FakeChatModel, "_generate", slow_generate)
+    monkeypatch.setattr(batch_server, "admission", RequestAdmission(max_in_flight=1, max_queue=1, queue_timeout=0.5))
+    monkeypatch.setattr(
+        batch_server.query_service, "stage_limiters", {"generate": StageLimiter("generate", max_concurrency=2, queue_timeout=5.0)}
+    )
+    inputs = [{"question": QUESTIONS[i % len(QUESTIONS)]} for i in range(8)]
+
+    response = asyncio.run(post(batch_server.app, "/chat/batch", {"inputs": inputs, "max_concurrency": 4}))
+
+    results = [json.loads(line) for line in response.text.splitlines()]
+    # 8 LLM calls of 0.2s, 2 at a time, outlast the 0.5s admission timeout
+    assert len(results) == len(inputs)
+    assert [result.get("error") for result in results] == [None] * len(inputs)
@@ -0,0 +1,80 @@
+from langchain.schema.document import Document
+
+from context_compression import estimate_tokens, pack_context, score_units, split_units
+
+QUESTION = "Who is the provider of the insurance?"
+ANSWER = "The insurer of this plan is Acme Global Ltd."
+FILLER = "Claims must be filed within thirty days of the return date with all receipts attached."
+
+
+def test_split_units_splits_sentences_and_keeps_table_rows_whole():
+    text = "Cover starts on departure. It ends on return!\nAccidental Death | $150,000 | $25,000. Per trip\n\n(a) Excess applies."
+
+    assert split_units(text) == [
+        "Cover starts on departure.",
+        "It ends on return!",
+        "Accidental Death | $150,000 | $25,000. Per trip",
+        "(a) Excess applies.",
+    ]
+
+
+def test_split_units_keeps_html_rows_whole():
+    text = "<table><tr><td>Mugging. Theft</td><td>$100</td></tr><tr><td>Excess</td><td>$50</td></tr></table>"
+
+    assert split_units(text) == [
+        "<tr><td>Mugging. Theft</td><td>$100</td></tr>",
+        "<tr><td>Excess</td><td>$50</td></tr>",
+    ]
+
+
+def test_score_units_ranks_matching_units():
+    units = ["Contact the provider for help.", "The insurance provider is Acme.", ANSWER]
+
+    scores = score_units(QUESTION, units)
+
+    assert scores[1] > scores[0] > 0
+    assert scores[2] == 0.0
+    assert score_units("the of", units) == [0.0, 0.0, 0.0]
+
+
+def test_docs_under_the_budget_are_unchanged():
+    docs = [Document(page_content=ANSWER, metadata={"doc_id": "1"})]
+
+    assert pack_context(QUESTION, docs, token_budget=100) is docs
+    assert pack_context(QUESTION, docs * 50, token_budget=0) == docs * 50
+
+
+def test_room_left_after_the_matches_is_filled_in_document_order():
+    first = " ".join([FILLER] * 40 + ["Contact the provider for help.", ANSWER])
+    second = " ".join([FILLER] * 40)
+    budget = (estimate_tokens(first) + estimate_tokens(second)) // 2
+
+    packed = pack_context(QUESTION, [first, second], token_budget=budget)
+
+    assert ANSWER in packed[0]
+    assert "Contact the provider for help." in packed[0]
+    used = sum(estimate_tokens(unit) for text in packed for unit in split_units(text))
+    assert budget - estimate_tokens(FILLER) < used <= budget
+
+
+def test_matches_are_kept_first_in_their_original_order():
+    units = [f"Sentence number {i} about luggage." for i in range(30)] + ["The insurance provider is Acme."]
+    docs = [Document(page_content=" ".join(units), metadata={"doc_id": "1"})]
+
+    packed = pack_context(QUESTION, docs, token_budget=20)
+
+    lines = packed[0].page_content.splitlines()
+    assert "The insurance provider is Acme." in lines
+    assert lines == [line for line in units if line in lines]
+    assert packed[0].metadata == {"doc_id": "1"}
+
+
+def test_table_rows_are_kept_whole():
+    rows = [f"Benefit {i} | ${i * 100} | ${i * 50}. Per claim" for i in range(40)]
+    text = "\n".join(rows + ["Mugging cover | $100 | -"])
+
+    packed = pack_context("How much is the mugging cover?", [text], token_budget=30)
+
+    lines = packed[0].splitlines()
+    assert lines[-1] == "Mugging cover | $100 | -"
+    assert all(line in rows + ["Mugging cover | $100 | -"] for line in lines)
@@ -0,0 +1,146 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+
+import metrics
+from metrics import RequestTrace, start_trace, stage
+
+INSURANCE_QUESTION = "What are the general exclusions of the policy?"
+CHITCHAT_QUESTION = "How are you?"
+
+
+def stage_count(stage: str, route: str) -> float:
+    return REGISTRY.get_sample_value("hia_stage_latency_seconds_count", {"stage": stage, "route": route}) or 0.0
+
+
+def requests(route: str) -> float:
+    return REGISTRY.get_sample_value("hia_requests_total", {"route": route}) or 0.0
+
+
+def test_trace_buffers_spans_until_finished_with_the_final_route():
+    name = f"test_{uuid.uuid4().hex}"
+    trace = RequestTrace(sampled=True)
+    with trace.span(name):
+        pass
+    trace.add_span(name, 0.2)
+
+    # Nothing exported before the route is known
+    assert stage_count(name, "chitchat") == 0
+    trace.route = "chitchat"
+    trace.finish()
+
+    assert stage_count(name, "chitchat") == 2
+    assert REGISTRY.get_sample_value("hia_stage_latency_seconds_sum", {"stage": name, "route": "chitchat"}) >= 0.2
+    # Spans are exported once
+    trace.finish()
+    assert stage_count(name, "chitchat") == 2
+
+
+def test_trace_without_route_is_labelled_none():
+    name = f"test_{uuid.uuid4().hex}"
+    unrouted = requests("none")
+    trace = RequestTrace(sampled=True)
+    trace.add_span(name, 0.01)
+
+    trace.finish()
+
+    assert stage_count(name, "none") == 1
+    assert requests("none") == unrouted + 1
+
+
+def test_trace_not_counted_as_a_request():
+    name = f"test_{uuid.uuid4().hex}"
+    trace = RequestTrace(sampled=True, count_request=False)
+    trace.route = "chitchat"
+    chitchat = requests("chitchat")
+    trace.add_span(name, 0.01)
+
+    trace.finish()
+
+    assert stage_count(name, "chitchat") == 1
+    assert requests("chitchat") == chitchat
+
+
+def test_unsampled_trace_only_counts_the_request(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_SAMPLE_RATE", 0.0)
+    name = f"test_{uuid.uuid4().hex}"
+    chitchat = requests("chitchat")
+
+    trace = start_trace()
+    with stage(name):
+        pass
+    trace.add_span(name, 0.01)
+    trace.route = "chitchat"
+    trace.finish()
+
+    assert not trace.sampled
+    assert trace.callbacks == []
+    assert stage_count(name, "chitchat") == 0
+    assert requests("chitchat") == chitchat + 1
+    assert metrics.current_trace() is None
+
+
+def test_stage_times_the_current_trace(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_SAMPLE_RATE", 1.0)
+    name = f"test_{uuid.uuid4().hex}"
+
+    trace = start_trace()
+    with stage(name):
+        pass
+    trace.route = "healthcare_insurance"
+    trace.finish()
+    # No current trace anymore
+    with stage(name):
+        pass
+
+    assert stage_count(name, "healthcare_insurance") == 1
+
+
+async def invoke_and_scrape(app, questions) -> str:
+    """Sends each question in a new session, returns the /metrics page scraped afterwards."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        for question in questions:
+            payload = {"input": {"question": question, "session_id": f"metrics-{uuid.uuid4().hex}", "chat_history": []}}
+            response = await client.post("/chat/invoke", json=payload)
+            assert response.status_code == 200
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        return response.text
+
+
+def stage_counts(page: str) -> dict:
+    """`(stage, route)` -> number of observations of `hia_stage_latency_seconds` in a /metrics page."""
+    return {
+        (sample.labels["stage"], sample.labels["route"]): sample.value
+        for family in text_string_to_metric_families(page)
+        if family.name == "hia_stage_latency_seconds"
+        for sample in family.samples
+        if sample.name == "hia_stage_latency_seconds_count"
+    }
+
+
+@pytest.mark.parametrize("speculative", [False, True])
+def test_metrics_endpoint_exposes_stage_latencies_by_route(server, monkeypatch, speculative):
+    monkeypatch.setattr(metrics, "METRICS_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(server.query_service, "speculative", speculative)
+    before = stage_counts(asyncio.run(invoke_and_scrape(server.app, [])))
+
+    after = stage_counts(asyncio.run(invoke_and_scrape(server.app, [CHITCHAT_QUESTION, INSURANCE_QUESTION])))
+
+    def delta(stage, route):
+        return after.get((stage, route), 0) - before.get((stage, route), 0)
+
+    assert delta("route", "chitchat") == 1
+    assert delta("generate", "chitchat") == 1
+    assert delta("retrieve", "chitchat") == 0
+    assert delta("route", "healthcare_insurance") == 1
+    assert delta("retrieve", "healthcare_insurance") == 1
+    assert delta("generate", "healthcare_insurance") == 1
+    # Every stage is labelled with the route of its query
+    assert delta("route", "none") == 0
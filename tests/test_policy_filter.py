@@ -0,0 +1,50 @@
+import asyncio
+
+import httpx
+import pytest
+
+from corpus import DEFAULT_POLICY_ID, DEFAULT_PRODUCT, matching_policies
+
+CORPUS = [
+    {"policy_id": "travel-2024", "product": "travel_health"},
+    {"policy_id": "family-2024", "product": "family_health"},
+    {"policy_id": "travel-2023", "product": "travel_health"},
+]
+
+
+async def post(app, path: str, payload: dict) -> httpx.Response:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        return await client.post(path, json=payload)
+
+
+def test_matching_policies():
+    assert matching_policies(None, CORPUS) == CORPUS
+    assert matching_policies({"product": "travel_health"}, CORPUS) == [CORPUS[0], CORPUS[2]]
+    assert matching_policies({"policy_id": "family-2024", "product": "family_health"}, CORPUS) == [CORPUS[1]]
+    assert matching_policies({"policy_id": "family-2024", "product": "travel_health"}, CORPUS) == []
+
+
+@pytest.mark.parametrize("policy", [
+    {"policy_id": "unknown-policy"},
+    {"product": "unknown_product"},
+    {"policy_id": DEFAULT_POLICY_ID, "product": "unknown_product"},
+])
+def test_unknown_policies_are_rejected(server, policy):
+    question = {"question": "Who is the provider of the insurance?", **policy}
+
+    chat = asyncio.run(post(server.app, "/chat/invoke", {"input": {**question, "session_id": "unknown-policy", "chat_history": []}}))
+    batch = asyncio.run(post(server.app, "/chat/batch", {"inputs": [{"question": "How are you?"}, question]}))
+
+    for response in (chat, batch):
+        assert response.status_code == 422
+        assert response.json()["detail"].startswith("No policy of the corpus matches")
+
+
+def test_known_policy_is_answered(server):
+    question = {"question": "Who is the provider of the insurance?", "policy_id": DEFAULT_POLICY_ID, "product": DEFAULT_PRODUCT}
+
+    response = asyncio.run(post(server.app, "/chat/invoke", {"input": {**question, "session_id": "known-policy", "chat_history": []}}))
+
+    assert response.status_code == 200
+    assert response.json()["output"]["answer"]
@@ -0,0 +1,105 @@
+import gzip
+import json
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+from sqlalchemy import text
+
+from chat_history import InstrumentedSQLChatMessageHistory
+from retention import HistoryRetention
+
+TTL = 3600
+
+
+def archived_records(archive_dir) -> list:
+    records = []
+    for path in sorted(archive_dir.iterdir()):
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            records += [json.loads(line) for line in file]
+    return records
+
+
+def test_session_resumed_during_its_archive_is_archived_once(tmp_path, monkeypatch):
+    connection_string = f"sqlite:///{tmp_path / 'history.db'}"
+    retention = HistoryRetention(connection_string=connection_string, ttl=TTL, max_messages=0, archive_dir=str(tmp_path / "archive"))
+    history = InstrumentedSQLChatMessageHistory(session_id="resumed", connection_string=connection_string)
+    history.add_message(HumanMessage(content="What is covered?"))
+    history.add_message(AIMessage(content="Emergency medical expenses."))
+    with retention.engine.begin() as connection:
+        connection.execute(text("UPDATE session_activity SET last_active = 0"))
+
+    archive = retention._archive
+
+    def archive_then_resume(sessions):
+        max_id = archive(sessions)
+        # The session is written to between its archive & the delete
+        history.add_message(HumanMessage(content="And repatriation?"))
+        return max_id
+
+    monkeypatch.setattr(retention, "_archive", archive_then_resume)
+    stats = retention.sweep()
+
+    assert stats["expired_messages"] == 2
+    assert history.messages == [HumanMessage(content="And repatriation?")]
+    with retention.engine.connect() as connection:
+        assert connection.execute(text("SELECT message_count FROM session_activity")).scalar() == 1
+
+    # Once it expires again, only the message written after the archive is archived
+    monkeypatch.setattr(retention, "_archive", archive)
+    retention.sweep(now=time.time() + 2 * TTL)
+
+    records = archived_records(tmp_path / "archive")
+    assert [len(record["messages"]) for record in records] == [2, 1]
+    assert history.messages == []
+
+
+def add_messages(history, count: int) -> None:
+    for i in range(count):
+        history.add_message(HumanMessage(content=f"Question {i}"))
+
+
+def message_counts(retention) -> dict:
+    with retention.engine.connect() as connection:
+        return dict(connection.execute(text("SELECT session_id, message_count FROM session_activity")).all())
+
+
+def test_sessions_over_the_cap_keep_their_latest_messages(tmp_path):
+    connection_string = f"sqlite:///{tmp_path / 'history.db'}"
+    retention = HistoryRetention(connection_string=connection_string, ttl=0, max_messages=3, batch_size=2, archive_dir=None)
+    long = InstrumentedSQLChatMessageHistory(session_id="long", connection_string=connection_string)
+    short = InstrumentedSQLChatMessageHistory(session_id="short", connection_string=connection_string)
+    add_messages(long, 8)
+    add_messages(short, 3)
+
+    stats = retention.sweep()
+
+    assert stats == {"expired_sessions": 0, "expired_messages": 0, "trimmed_messages": 5}
+    assert [message.content for message in long.messages] == ["Question 5", "Question 6", "Question 7"]
+    assert len(short.messages) == 3
+    assert message_counts(retention) == {"long": 3, "short": 3}
+    # Nothing left to trim
+    assert retention.sweep()["trimmed_messages"] == 0
+
+
+def test_inactive_sessions_are_archived_then_deleted(tmp_path):
+    connection_string = f"sqlite:///{tmp_path / 'history.db'}"
+    retention = HistoryRetention(connection_string=connection_string, ttl=TTL, max_messages=0, archive_dir=str(tmp_path / "archive"))
+    inactive = InstrumentedSQLChatMessageHistory(session_id="inactive", connection_string=connection_string)
+    active = InstrumentedSQLChatMessageHistory(session_id="active", connection_string=connection_string)
+    add_messages(inactive, 2)
+    add_messages(active, 1)
+    with retention.engine.begin() as connection:
+        connection.execute(
+            text("UPDATE session_activity SET last_active = :last_active WHERE session_id = 'inactive'"),
+            {"last_active": time.time() - 2 * TTL},
+        )
+
+    stats = retention.sweep()
+
+    assert stats == {"expired_sessions": 1, "expired_messages": 2, "trimmed_messages": 0}
+    assert inactive.messages == []
+    assert len(active.messages) == 1
+    assert message_counts(retention) == {"active": 1}
+    records = archived_records(tmp_path / "archive")
+    assert [record["session_id"] for record in records] == ["inactive"]
+    assert [message["data"]["content"] for message in records[0]["messages"]] == ["Question 0", "Question 1"]
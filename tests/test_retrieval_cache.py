@@ -0,0 +1,45 @@
+import numpy as np
+
+from retrieval_cache import RetrievalCache
+
+
+def embeddings(n: int, dimensions: int = 64, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((n, dimensions))
+
+
+def test_paraphrase_reuses_the_ids_of_its_scope_only():
+    cache = RetrievalCache(max_size=8)
+    query, = embeddings(1)
+    paraphrase = query + 0.05 * embeddings(1, seed=1)[0]
+    cache.put(query, "v1", scope="k=4", ids=["doc-1", "doc-2"])
+
+    assert cache.get(paraphrase, "v1", scope="k=4") == ["doc-1", "doc-2"]
+    assert cache.get(query, "v1", scope="k=4,policy_id=dental") is None
+    assert cache.get(embeddings(1, seed=2)[0], "v1", scope="k=4") is None
+
+
+def test_index_versions_share_the_cache_without_sharing_entries():
+    cache = RetrievalCache(max_size=8)
+    query, = embeddings(1)
+    cache.put(query, "collection-a", scope="k=4", ids=["a-1"])
+    cache.put(query, "collection-b", scope="k=4", ids=["b-1"])
+
+    # Alternating lookups of two retrievers don't drop each other's entries
+    for _ in range(2):
+        assert cache.get(query, "collection-a", scope="k=4") == ["a-1"]
+        assert cache.get(query, "collection-b", scope="k=4") == ["b-1"]
+    assert cache.get(query, "collection-c", scope="k=4") is None
+    assert len(cache) == 2
+
+
+def test_entries_of_a_previous_index_are_evicted_first():
+    cache = RetrievalCache(max_size=2)
+    old, new, newer = embeddings(3)
+    cache.put(old, "v1", scope="k=4", ids=["old"])
+    cache.put(new, "v2", scope="k=4", ids=["new"])
+    cache.put(newer, "v2", scope="k=4", ids=["newer"])
+
+    assert len(cache) == 2
+    assert cache.get(old, "v1", scope="k=4") is None
+    assert cache.get(new, "v2", scope="k=4") == ["new"]
+    assert cache.get(newer, "v2", scope="k=4") == ["newer"]
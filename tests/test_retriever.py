@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import retriever as retriever_module
+from corpus import PROCESSED_DIR
+
+
+def policy(policy_id: str) -> dict:
+    return {"policy_id": policy_id, "product": "travel_health", "processed_dir": os.path.abspath(PROCESSED_DIR)}
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+    """`build_retriever` on its own embedded Qdrant & docstore, closing the client of the previous build."""
+    monkeypatch.setattr(retriever_module, "QDRANT_PATH", str(tmp_path / "qdrant"))
+    monkeypatch.setattr(retriever_module, "DOCSTORE_CONNECTION_STRING", f"sqlite:///{tmp_path / 'docstore.db'}")
+    built = []
+
+    def build(corpus):
+        if built:
+            built[-1].vectorstore.client.close()
+        built.append(retriever_module.build_retriever("test_index", corpus=corpus, cache=None))
+        return built[-1]
+
+    yield build
+    if built:
+        built[-1].vectorstore.client.close()
+
+
+def points(retriever, policy_id: str) -> int:
+    qdrant = retriever.vectorstore
+    return qdrant.client.count(
+        collection_name=qdrant.collection_name,
+        count_filter=retriever_module.to_qdrant_filter(retriever, {"policy_id": policy_id}),
+        exact=True,
+    ).count
+
+
+def test_rebuild_keeps_the_index_and_its_version(build):
+    first = build([policy("a")])
+    indexed, version = points(first, "a"), first.index_version
+
+    second = build([policy("a")])
+
+    assert indexed > 0
+    assert points(second, "a") == indexed
+    assert second.index_version == version
+    assert second.invoke("Who is the provider of the insurance?")
+
+
+def test_policies_missing_from_the_corpus_are_only_removed_by_prune(build):
+    build([policy("a"), policy("b")])
+    # E.g. a replica still running the previous manifest in a rolling deploy
+    retriever = build([policy("a")])
+    indexed = points(retriever, "b")
+    doc_ids = [point.payload["metadata"]["doc_id"] for point in retriever.vectorstore.client.scroll(
+        collection_name="test_index", scroll_filter=retriever_module.to_qdrant_filter(retriever, {"policy_id": "b"}), limit=1000,
+    )[0]]
+
+    assert indexed > 0
+    assert retriever_module.prune_index(retriever, [policy("a")]) == indexed
+    assert points(retriever, "b") == 0
+    assert points(retriever, "a") == indexed
+    assert retriever.docstore.mget(doc_ids) == [None] * len(doc_ids)
+
+
+def test_prune_refuses_an_empty_corpus(build):
+    retriever = build([policy("a")])
+
+    with pytest.raises(ValueError):
+        retriever_module.prune_index(retriever, [])
+    assert points(retriever, "a") > 0
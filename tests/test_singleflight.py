@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from singleflight import SingleFlight, normalize_question
+
+CALLERS = 8
+
+
+def wait_for_callers(single_flight: SingleFlight, callers: int, timeout: float = 5.0) -> None:
+    """Blocks the leader until every caller joined the flight, so all of them share it."""
+    deadline = time.monotonic() + timeout
+    while single_flight.total < callers:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Only {single_flight.total} of {callers} callers joined")
+        time.sleep(0.001)
+
+
+def concurrent_calls(single_flight: SingleFlight, key, func, callers: int = CALLERS):
+    """Calls `single_flight.do(key, func)` from `callers` threads, returns their results or exceptions."""
+    barrier = threading.Barrier(callers)
+
+    def call():
+        barrier.wait()
+        try:
+            return single_flight.do(key, func)
+        except Exception as error:
+            return error
+
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        return list(executor.map(lambda _: call(), range(callers)))
+
+
+def test_followers_share_the_leader_result():
+    single_flight = SingleFlight()
+    calls = []
+
+    def answer():
+        calls.append(threading.get_ident())
+        wait_for_callers(single_flight, CALLERS)
+        return "answer"
+
+    results = concurrent_calls(single_flight, "question", answer)
+
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ["answer"] * CALLERS
+    assert sorted(shared for _, shared in results) == [False] + [True] * (CALLERS - 1)
+    assert single_flight.dedup_ratio == (CALLERS - 1) / CALLERS
+
+
+def test_followers_get_the_leader_exception():
+    single_flight = SingleFlight()
+    error = ValueError("LLM call failed")
+    calls = []
+
+    def failing():
+        calls.append(threading.get_ident())
+        wait_for_callers(single_flight, CALLERS)
+        raise error
+
+    results = concurrent_calls(single_flight, "question", failing)
+
+    assert len(calls) == 1
+    assert all(result is error for result in results)
+    # The failed flight is forgotten, the next call runs again
+    assert single_flight.do("question", lambda: "retry") == ("retry", False)
+
+
+def test_distinct_keys_run_separately():
+    single_flight = SingleFlight()
+    barrier = threading.Barrier(2)
+
+    def answer(key):
+        # Both computations must be in flight at the same time to pass the barrier
+        return single_flight.do(key, lambda: (barrier.wait(timeout=5), key)[1])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(answer, ["a", "b"]))
+
+    assert results == [("a", False), ("b", False)]
+
+
+def test_nothing_is_cached_after_the_flight():
+    single_flight = SingleFlight()
+    assert single_flight.do("question", lambda: 1) == (1, False)
+    assert single_flight.do("question", lambda: 2) == (2, False)
+
+
+def test_normalize_question():
+    assert normalize_question("  What does the policy   cover ?") == normalize_question("what does the policy cover")
+
+
+@pytest.fixture
+def coalescing_service(server, monkeypatch):
+    monkeypatch.setattr(server.query_service, "coalesce", True)
+    monkeypatch.setattr(server.query_service, "speculative", False)
+    return server.query_service
+
+
+def test_coalesced_sessions_get_their_own_history(coalescing_service, monkeypatch):
+    from chat_history import get_session_history
+    from fakes import FakeChatModel
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    single_flight = coalescing_service._single_flight
+    flights_before, shared_before = single_flight.total, single_flight.shared
+    generate = FakeChatModel._generate
+    llm_calls = []
+
+    def gated_generate(self, *args, **kwargs):
+        llm_calls.append(threading.get_ident())
+        wait_for_callers(single_flight, flights_before + CALLERS)
+        return generate(self, *args, **kwargs)
+
+    monkeypatch.setattr(FakeChatModel, "_generate", gated_generate)
+
+    run_id = uuid.uuid4().hex
+    variants = [
+        "What does the travel healthcare insurance policy cover?",
+        "what does the travel healthcare insurance policy cover",
+    ]
+    requests = [(f"coalesced-{run_id}-{i}", variants[i % len(variants)]) for i in range(CALLERS)]
+    barrier = threading.Barrier(CALLERS)
+
+    def send(request):
+        session_id, question = request
+        barrier.wait()
+        return coalescing_service.query(question=question, session_id=session_id)
+
+    with ThreadPoolExecutor(max_workers=CALLERS) as executor:
+        answers = list(executor.map(send, requests))
+
+    assert len(llm_calls) == 1
+    assert single_flight.shared - shared_before == CALLERS - 1
+    assert len(set(answers)) == 1
+    for (session_id, question), answer in zip(requests, answers):
+        assert get_session_history(session_id).messages == [HumanMessage(content=question), AIMessage(content=answer)]
+
+
+def test_sessions_with_history_are_not_coalesced(coalescing_service):
+    from chat_history import get_session_history
+
+    session_id = f"with-history-{uuid.uuid4().hex}"
+    single_flight = coalescing_service._single_flight
+    coalescing_service.query(question="How do I file a claim?", session_id=session_id)
+    flights = single_flight.total
+
+    coalescing_service.query(question="How do I file a claim?", session_id=session_id)
+
+    assert single_flight.total == flights
+    assert len(get_session_history(session_id).messages) == 4
@@ -0,0 +1,112 @@
+import threading
+import time
+import uuid
+
+import pytest
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from prometheus_client import REGISTRY
+
+INSURANCE_QUESTION = "What are the general exclusions of the policy?"
+CHITCHAT_QUESTION = "How are you?"
+
+
+def speculative_retrievals(result: str) -> float:
+    return REGISTRY.get_sample_value("hia_speculative_retrievals_total", {"result": result}) or 0.0
+
+
+def stage_count(stage: str, route: str) -> float:
+    return REGISTRY.get_sample_value("hia_stage_latency_seconds_count", {"stage": stage, "route": route}) or 0.0
+
+
+@pytest.fixture
+def speculative_service(server):
+    from query_service import QueryService
+
+    return QueryService(speculative=True, coalesce=False, stage_limiters={})
+
+
+@pytest.fixture
+def retrievals(monkeypatch):
+    """Threads of the retrievals run by `TableAwareMultiVectorRetriever`, gated by `retrievals.gate`."""
+    from retriever import TableAwareMultiVectorRetriever
+
+    get_relevant_documents = TableAwareMultiVectorRetriever._get_relevant_documents
+    calls = []
+    gate = threading.Event()
+    gate.set()
+
+    def gated(self, *args, **kwargs):
+        calls.append(threading.get_ident())
+        gate.wait(5)
+        return get_relevant_documents(self, *args, **kwargs)
+
+    monkeypatch.setattr(TableAwareMultiVectorRetriever, "_get_relevant_documents", gated)
+    return {"calls": calls, "gate": gate}
+
+
+def test_insurance_question_uses_the_speculative_retrieval(speculative_service, retrievals):
+    from chat_history import get_session_history
+
+    used, discarded = speculative_retrievals("used"), speculative_retrievals("discarded")
+    retrieved = stage_count("retrieve", "healthcare_insurance")
+    session_id = f"speculative-{uuid.uuid4().hex}"
+
+    answer = speculative_service.query(question=INSURANCE_QUESTION, session_id=session_id)
+
+    assert answer
+    # Retrieved once, in the background
+    assert len(retrievals["calls"]) == 1
+    assert retrievals["calls"][0] != threading.get_ident()
+    assert speculative_retrievals("used") == used + 1
+    assert speculative_retrievals("discarded") == discarded
+    assert stage_count("retrieve", "healthcare_insurance") == retrieved + 1
+    assert len(get_session_history(session_id).messages) == 2
+
+
+def test_chitchat_discards_the_running_retrieval(speculative_service, retrievals):
+    discarded = speculative_retrievals("discarded")
+    retrieved = stage_count("retrieve", "chitchat")
+    retrievals["gate"].clear()
+
+    # Answered while the retrieval is still blocked
+    answer = speculative_service.query(question=CHITCHAT_QUESTION, session_id=f"speculative-{uuid.uuid4().hex}")
+    retrievals["gate"].set()
+
+    assert answer
+    assert speculative_retrievals("discarded") == discarded + 1
+    assert stage_count("retrieve", "chitchat") == retrieved
+
+
+def test_chitchat_cancels_a_retrieval_not_started_yet(speculative_service, retrievals, monkeypatch):
+    from chat_history import InstrumentedSQLChatMessageHistory
+
+    # One background worker, busy loading the history while the question is routed
+    monkeypatch.setattr(speculative_service, "_executor", ContextThreadPoolExecutor(max_workers=1))
+    messages = InstrumentedSQLChatMessageHistory.messages.fget
+
+    def slow_messages(self):
+        time.sleep(0.3)
+        return messages(self)
+
+    monkeypatch.setattr(InstrumentedSQLChatMessageHistory, "messages", property(slow_messages))
+    discarded = speculative_retrievals("discarded")
+
+    speculative_service.query(question=CHITCHAT_QUESTION, session_id=f"speculative-{uuid.uuid4().hex}")
+    speculative_service._executor.shutdown(wait=True)
+
+    assert retrievals["calls"] == []
+    assert speculative_retrievals("discarded") == discarded + 1
+
+
+def test_speculative_query_uses_the_history_loaded_in_the_background(speculative_service):
+    from chat_history import get_session_history
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    session_id = f"speculative-{uuid.uuid4().hex}"
+    speculative_service.query(question=CHITCHAT_QUESTION, session_id=session_id)
+    answer = speculative_service.query(question=INSURANCE_QUESTION, session_id=session_id)
+
+    messages = get_session_history(session_id).messages
+    assert messages[2:] == [HumanMessage(content=INSURANCE_QUESTION), AIMessage(content=answer)]
+    # Answers of sessions with history aren't cached
+    assert speculative_service.cached_answer(INSURANCE_QUESTION) is None
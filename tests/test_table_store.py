@@ -0,0 +1,73 @@
+import json
+import os
+
+import pytest
+
+from table_store import Table, TableStore, parse_html_table
+
+RAW_ELEMENTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "raw_elements_chunked.json")
+
+
+@pytest.fixture(scope="module")
+def tables():
+    """`text_as_html` of the tables of the bundled policy."""
+    with open(RAW_ELEMENTS, "r") as file:
+        elements = json.load(file)
+    return [el["metadata"]["text_as_html"] for el in elements if el["type"] == "Table"]
+
+
+@pytest.fixture(scope="module")
+def store(tables):
+    store = TableStore()
+    for i, text_as_html in enumerate(tables):
+        store.add(str(i), text_as_html)
+    return store
+
+
+def test_header_rows_without_tr_are_parsed(tables):
+    rows = parse_html_table(tables[3])
+
+    assert rows[0] == ["Mugging", "$100", "-", "-"]
+    assert rows[1] == ["Section 5 - Additional Optional Benefits", "", "", ""]
+
+
+def test_colspan_values_fill_their_columns(tables):
+    rows = parse_html_table(tables[4])
+
+    assert ["Accidental Death", "100%", "100%", "100%"] in rows
+    assert ["Total loss of the hand or forearm", "60%", "", "50%"] in rows
+
+
+def test_column_header_is_kept_apart_from_the_rows(tables):
+    losses = Table.from_html(tables[4])
+
+    assert losses.header == ["Table of Losses", "Right", "", "Left"]
+    assert "Table of Losses" not in losses.columns[0]
+    # A continuation row with figures isn't a header
+    assert Table.from_html(tables[3]).header is None
+    assert Table.from_html(tables[2]).header is None
+
+
+def test_lookup_prints_the_header_above_the_matched_rows(store):
+    assert store.lookup("4", "What is paid for the total loss of the right hand?").splitlines()[:2] == [
+        "Table of Losses | Right | - | Left",
+        "Total loss of the hand or forearm | 60% | - | 50%",
+    ]
+
+
+def test_lookup_finds_rows_of_header_row_blocks(store):
+    assert store.lookup("3", "How much is covered for mugging?") == "Mugging | $100 | - | -"
+
+
+def test_section_headings_are_printed_above_their_rows(store):
+    text = store.lookup("2", "How much is covered for accidental death?")
+
+    assert text.splitlines()[0] == "Section 1 - Personal Accident Benefits"
+    assert "Accidental Death | $150,000 | $25,000" in text
+
+
+def test_rows_without_a_name_continue_the_previous_one():
+    table = Table([["Permanent Partial Disability", "% of $150,000", "-"], ["", "per scale", ""]])
+
+    assert table.n_rows == 1
+    assert table.format_row(0) == "Permanent Partial Disability | % of $150,000 per scale | -"